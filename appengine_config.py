@@ -1,4 +1,7 @@
 def webapp_add_wsgi_middleware(app):
     from google.appengine.ext.appstats import recording
     app = recording.appstats_wsgi_middleware(app)
+    # per-endpoint RPC counts and latency histograms, see rpcstats.py
+    import rpcstats
+    app = rpcstats.rpc_stats_middleware(app)
     return app
\ No newline at end of file
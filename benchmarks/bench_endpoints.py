@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+"""bench_endpoints.py
+
+Reproducible benchmark of the public ConferenceApi methods on the
+App Engine testbed stubs.
+
+Seeds profiles, conferences, sessions, wishlists and reviews, calls
+every method --iterations times as the seeded user and reports, per
+method, wall time percentiles and the datastore/memcache RPCs and
+entities read per call (counted with rpcstats). Results are written as
+JSON; with --baseline, methods that got slower or more RPC-hungry than
+the stored run are flagged and the exit status is 1.
+
+usage: python benchmarks/bench_endpoints.py --sdk PATH \\
+           [--conferences 50] [--output results.json] \\
+           [--baseline baseline.json]
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from benchmarks.sdk import APP_ROOT, setup_sdk
+
+BENCH_USER = 'user0@example.com'
+SESSION_TYPES = ['workshop', 'lecture', 'demonstration', 'party']
+CITIES = ['London', 'Chicago', 'Tokyo', 'Paris', 'San Francisco']
+TOPICS = ['Web', 'Programming', 'Movie', 'Health', 'Medical']
+
+
+def setup_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # fully consistent so every run sees the same query results
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_ROOT)
+    bed.init_mail_stub()
+    bed.init_user_stub()
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+    # what endpoints.get_current_user() reads outside the Endpoints server
+    bed.setup_env(ENDPOINTS_AUTH_EMAIL=BENCH_USER,
+                  ENDPOINTS_AUTH_DOMAIN='gmail.com', overwrite=True)
+    return bed
+
+
+def seed(args, rng):
+    """Populate the stub datastore; returns the keys the cases need."""
+    from google.appengine.ext import ndb
+    from migrations import review_stats
+    from models import (Conference, Profile, Review, ReviewEnum, Session,
+                        Wishlist)
+
+    profiles = [Profile(key=ndb.Key(Profile, 'user%d@example.com' % i),
+                        displayName='User %d' % i,
+                        mainEmail='user%d@example.com' % i,
+                        teeShirtSize='NOT_SPECIFIED')
+                for i in range(args.profiles)]
+
+    conferences = []
+    for i in range(args.conferences):
+        owner = profiles[i % len(profiles)]
+        start = datetime.date(2015, 1 + i % 12, 1 + i % 28)
+        conferences.append(Conference(
+            parent=owner.key, name='Conference %d' % i,
+            description='Benchmark conference %d' % i,
+            organizerUserId=owner.key.id(),
+            topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+            startDate=start, month=start.month,
+            endDate=start + datetime.timedelta(days=2),
+            maxAttendees=500, seatsAvailable=rng.randint(1, 500)))
+    ndb.put_multi(profiles + conferences)
+
+    sessions = []
+    for i, conf in enumerate(conferences):
+        for j in range(args.sessions):
+            sessions.append(Session(
+                parent=conf.key, name='Session %d-%d' % (i, j),
+                highlights=['highlight'],
+                speakerDisplayName=rng.choice(profiles).displayName,
+                duration=rng.choice([30, 45, 60, 90]),
+                sessionType=rng.choice(SESSION_TYPES),
+                date=conf.startDate,
+                startTime=datetime.time(rng.randint(8, 19),
+                                        rng.choice([0, 30]))))
+    ndb.put_multi(sessions)
+
+    wishlists = [Wishlist(parent=profile.key, userId=profile.mainEmail,
+                          sessionKeys=[s.key for s in rng.sample(
+                              sessions, min(args.wishlist, len(sessions)))])
+                 for profile in profiles]
+    reviews = []
+    for session in sessions:
+        for _ in range(args.reviews):
+            rating = rng.randint(0, 5)
+            reviews.append(Review(
+                parent=session.key, conference_name='',
+                session_name=session.name,
+                speaker_name=session.speakerDisplayName,
+                review=ReviewEnum.lookup_by_number(rating).name,
+                rating=rating))
+    ndb.put_multi(wishlists + reviews)
+    # what the review_stats migration does, without the task chain
+    review_stats(sessions)
+
+    own = [conf for conf in conferences
+           if conf.organizerUserId == BENCH_USER]
+    return {
+        'conferences': conferences,
+        'own_conference': own[0],
+        'sessions': sessions,
+    }
+
+
+def build_cases(data):
+    """(method name, request factory) for every public API method."""
+    from protorpc import message_types
+    import conference as c
+    from models import (BatchCallForm, BatchForm, ChangesQueryForm,
+                        ConferenceForm, ConferenceQueryForm,
+                        ConferenceQueryForms, ProfileMiniForm, ReviewEnum,
+                        ReviewForm, ReviewQueryForm, ReviewStatsQueryForm,
+                        SessionQueryForm, SessionTimeWindowForm,
+                        SessionTypeEnum, WishlistForm, WishlistFormName)
+
+    confs = data['conferences']
+    sessions = data['sessions']
+    own_key = data['own_conference'].key.urlsafe()
+    void = message_types.VoidMessage
+
+    def conf_key(i):
+        return confs[i % len(confs)].key.urlsafe()
+
+    def session(i):
+        return sessions[i % len(sessions)]
+
+    def window(i):
+        day = session(i).date.isoformat()
+        return SessionTimeWindowForm(windowStart=day + ' 09:00',
+                                     windowEnd=day + ' 13:00')
+
+    def batch(i):
+        # a client's page load: a conference, its schedule and the caller
+        wsck = json.dumps({'websafeConferenceKey': conf_key(i)})
+        return BatchForm(calls=[
+            BatchCallForm(method='getConference', params=wsck),
+            BatchCallForm(method='getConferenceSessions', params=wsck),
+            BatchCallForm(method='getProfile', params='{}'),
+        ])
+
+    return [
+        ('getProfile', lambda i: void()),
+        ('saveProfile', lambda i: ProfileMiniForm(
+            displayName='User 0')),
+        ('getConference', lambda i: c.CONF_GET_CONDITIONAL_REQUEST
+            .combined_message_class(websafeConferenceKey=conf_key(i))),
+        ('getConferencesCreated', lambda i: void()),
+        ('queryConferences', lambda i: ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field='CITY', operator='EQ',
+                                value=CITIES[i % len(CITIES)])])),
+        ('createConference', lambda i: ConferenceForm(
+            name='Created %d' % i, city='London', maxAttendees=100,
+            startDate='2015-11-03', endDate='2015-11-05')),
+        ('updateConference', lambda i: c.CONF_POST_REQUEST
+            .combined_message_class(websafeConferenceKey=own_key,
+                                    description='Updated %d' % i)),
+        ('registerForConference', lambda i: c.CONF_GET_REQUEST
+            .combined_message_class(websafeConferenceKey=conf_key(i))),
+        ('getConferencesToAttend', lambda i: void()),
+        ('unregisterFromConference', lambda i: c.CONF_GET_REQUEST
+            .combined_message_class(websafeConferenceKey=conf_key(i))),
+        ('createSession', lambda i: c.SESSION_POST_REQUEST
+            .combined_message_class(
+                websafeConferenceKey=own_key, name='New session %d' % i,
+                speakerDisplayName='User 0', duration=45,
+                sessionType=SessionTypeEnum.lecture, date='2015-11-03',
+                startTime='14:00')),
+        ('getConferenceSessions', lambda i: c.SESSION_GET_REQUEST
+            .combined_message_class(websafeConferenceKey=conf_key(i))),
+        ('getSessionsInTimeWindow', window),
+        ('getConferenceSessionByType', lambda i: c.SESSION_POST_QUERY_REQUEST
+            .combined_message_class(websafeConferenceKey=conf_key(i),
+                                    query='lecture')),
+        ('getSessionsBySpeaker', lambda i: SessionQueryForm(
+            query=session(i).speakerDisplayName)),
+        ('getConferenceSessionsByTypeAndTimeA',
+         lambda i: c.SESSION_POST_REQUEST_TYPE_TIME.combined_message_class(
+             websafeConferenceKey=conf_key(i), notThisSessionType='workshop',
+             sessionBeforeTime='19:00', sessionAfterTime='09:00')),
+        ('getConferenceSessionsByTypeAndTimeB',
+         lambda i: c.SESSION_POST_REQUEST_TYPE_TIME.combined_message_class(
+             websafeConferenceKey=conf_key(i), notThisSessionType='workshop',
+             sessionBeforeTime='19:00', sessionAfterTime='09:00')),
+        ('addSessionToWishlist', lambda i: WishlistForm(
+            websafeSessionKey=session(i).key.urlsafe())),
+        ('addSessionToWishlistByName', lambda i: WishlistFormName(
+            sessionName=session(i).name)),
+        ('getSessionsInWishlist', lambda i: void()),
+        ('getWishlistCalendarUrl', lambda i: c.CALENDAR_URL_REQUEST
+            .combined_message_class()),
+        ('getAnnouncement', lambda i: c.ANNOUNCEMENT_GET_REQUEST
+            .combined_message_class()),
+        ('getFeaturedSpeaker', lambda i: void()),
+        ('postReview', lambda i: ReviewForm(
+            conference_name='Conference', session_name=session(i).name,
+            review=ReviewEnum.excellent)),
+        ('getReview', lambda i: ReviewQueryForm(
+            websafeSessionKey=session(i).key.urlsafe())),
+        ('getReviewStats', lambda i: ReviewStatsQueryForm(
+            websafeSessionKey=session(i).key.urlsafe())),
+        ('getRecommendedSessions', lambda i: c.RECOMMENDATIONS_GET_REQUEST
+            .combined_message_class(
+                websafeSessionKey=session(i).key.urlsafe())),
+        ('getConferenceChanges', lambda i: ChangesQueryForm()),
+        ('getSessionChanges', lambda i: ChangesQueryForm(
+            websafeConferenceKey=conf_key(i))),
+        ('getReviewChanges', lambda i: ChangesQueryForm(
+            websafeSessionKey=session(i).key.urlsafe())),
+        ('batch', batch),
+        ('get_conference_key', lambda i: SessionQueryForm(
+            query=confs[i % len(confs)].name)),
+        ('get_session_key', lambda i: SessionQueryForm(
+            query=session(i).name)),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_case(name, factory, iterations):
+    import endpoints
+    from google.appengine.ext import ndb
+    import rpcstats
+    from conference import ConferenceApi
+
+    timings, rpcs, reads, hits, misses, errors = [], [], [], [], [], 0
+    for i in range(iterations):
+        request = factory(i)
+        # a new service per call, like the Endpoints server does; the ndb
+        # context cache is per request too
+        api = ConferenceApi()
+        ndb.get_context().clear_cache()
+        started = time.time()
+        with rpcstats.record(name, mode='off') as recorder:
+            try:
+                getattr(api, name)(request)
+            except endpoints.ServiceException:
+                errors += 1
+        timings.append((time.time() - started) * 1000)
+        rpcs.append(recorder.datastore_rpcs)
+        reads.append(recorder.counts['entities_read'])
+        hits.append(recorder.counts['memcache_hit'])
+        misses.append(recorder.counts['memcache_miss'])
+
+    def mean(values):
+        return round(float(sum(values)) / len(values), 2)
+
+    return {
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'mean_ms': mean(timings),
+        'datastore_rpcs': mean(rpcs),
+        'entities_read': mean(reads),
+        'memcache_hits': mean(hits),
+        'memcache_misses': mean(misses),
+        'errors': errors,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return regression messages for results against a stored run."""
+    regressions = []
+    for name, current in sorted(results.iteritems()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.2fms -> %.2fms' % (
+                name, previous['p95_ms'], current['p95_ms']))
+        for metric in ('datastore_rpcs', 'entities_read'):
+            if current[metric] > previous[metric]:
+                regressions.append('%s: %s %s -> %s' % (
+                    name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ConferenceApi methods on testbed stubs.')
+    parser.add_argument('--sdk', help='App Engine SDK path')
+    parser.add_argument('--profiles', type=int, default=20)
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--wishlist', type=int, default=10,
+                        help='sessions per wishlist')
+    parser.add_argument('--reviews', type=int, default=5,
+                        help='reviews per session')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='methods to run')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 slowdown vs. baseline (0.2=20%%)')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    bed = setup_testbed()
+    try:
+        data = seed(args, random.Random(args.seed))
+        results = {}
+        for name, factory in build_cases(data):
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_case(name, factory, args.iterations)
+            print '%-38s p50 %8.2fms  p95 %8.2fms  rpcs %6.1f  read %7.1f' % (
+                name, results[name]['p50_ms'], results[name]['p95_ms'],
+                results[name]['datastore_rpcs'],
+                results[name]['entities_read'])
+    finally:
+        bed.deactivate()
+
+    report = {
+        'config': dict((key, value) for key, value in vars(args).items()
+                       if key not in ('sdk', 'output', 'baseline')),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)
+        if baseline.get('config') != report['config']:
+            print 'warning: baseline was recorded with a different config'
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION', regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""bench_mappers.py
+
+Micro-benchmark: precompiled mappers.FormMapper vs. the per-row
+all_fields()/hasattr/getattr reflection the _copy*ToForm helpers used.
+
+usage: python benchmarks/bench_mappers.py [--sdk PATH] [--rows 1000]
+
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from benchmarks.sdk import setup_sdk
+
+
+def legacy_conference_to_form(conf, displayName):
+    """The reflective copy _copyConferenceToForm used to do."""
+    from models import ConferenceForm
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def legacy_session_to_form(session):
+    """The reflective copy _copySessionToForm used to do."""
+    from models import SessionForm, SessionTypeEnum
+    session_form = SessionForm()
+    for field in session_form.all_fields():
+        if field.name == 'sessionType':
+            value = getattr(session, field.name)
+            try:
+                value = getattr(SessionTypeEnum, value)
+            except (AttributeError, TypeError):
+                value = SessionTypeEnum.NOT_SPECIFIED
+            setattr(session_form, field.name, value)
+        elif field.name == 'date' or field.name == 'startTime':
+            setattr(session_form, field.name,
+                    str(getattr(session, field.name)))
+        else:
+            setattr(session_form, field.name, getattr(session, field.name))
+    return session_form
+
+
+def make_rows(count):
+    from google.appengine.ext import ndb
+    from models import Conference, Profile, Session
+    conferences, sessions = [], []
+    for i in range(count):
+        p_key = ndb.Key(Profile, 'organizer%d@example.com' % (i % 50))
+        c_key = ndb.Key(Conference, i + 1, parent=p_key)
+        conferences.append(Conference(
+            key=c_key, name='Conference %d' % i, description='desc',
+            organizerUserId=p_key.id(), topics=['Web', 'Programming'],
+            city='London', startDate=datetime.date(2015, 11, 3),
+            month=11, endDate=datetime.date(2015, 11, 5),
+            maxAttendees=200, seatsAvailable=150))
+        sessions.append(Session(
+            key=ndb.Key(Session, i + 1, parent=c_key),
+            name='Session %d' % i, highlights=['one', 'two'],
+            speakerDisplayName='Speaker %d' % (i % 30), duration=45,
+            sessionType='lecture', date=datetime.date(2015, 11, 3),
+            startTime=datetime.time(14, 30)))
+    return conferences, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sdk', help='App Engine SDK path')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    setup_sdk(args.sdk)
+
+    from models import Conference, ConferenceForm, Session, SessionForm
+    from mappers import get_mapper
+
+    conferences, sessions = make_rows(args.rows)
+    conf_mapper = get_mapper(Conference, ConferenceForm,
+                             check_initialized=True)
+    session_mapper = get_mapper(Session, SessionForm)
+
+    cases = [
+        ('conference legacy', lambda: [
+            legacy_conference_to_form(c, 'Name') for c in conferences]),
+        ('conference mapper', lambda: [
+            conf_mapper.to_form(c, organizerDisplayName='Name')
+            for c in conferences]),
+        ('session legacy', lambda: [
+            legacy_session_to_form(s) for s in sessions]),
+        ('session mapper', lambda: session_mapper.to_forms(sessions)),
+    ]
+    print '%-20s %12s %12s' % ('case', 'best (ms)', 'us/row')
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print '%-20s %12.2f %12.2f' % (
+            name, best * 1000, best * 1e6 / args.rows)
+
+
+if __name__ == '__main__':
+    main()
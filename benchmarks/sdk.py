@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+"""sdk.py
+
+Puts the App Engine SDK and the application on sys.path so the
+benchmarks can import conference.py, models.py etc. outside of
+dev_appserver.
+
+"""
+
+import os
+import sys
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk(sdk_path=None):
+    """Make google.appengine, endpoints, protorpc and the app importable.
+
+    sdk_path defaults to $APPENGINE_SDK; without either, the SDK must
+    already be importable.
+    """
+    sdk_path = sdk_path or os.environ.get('APPENGINE_SDK')
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    if APP_ROOT not in sys.path:
+        sys.path.insert(0, APP_ROOT)
+    # ndb keys need an application id even without a datastore stub
+    os.environ.setdefault('APPLICATION_ID', 'dev~ttt-conference')
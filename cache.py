@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+In-process and memcache caching helpers shared by the conference API
+and the task handlers in main.py.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Profile
+
+MEMCACHE_DISPLAY_NAME_PREFIX = 'DISPLAY_NAME:'
+DISPLAY_NAME_LOCAL_SIZE = 500       # organisers kept per instance
+DISPLAY_NAME_LOCAL_TTL = 60         # seconds; bounds cross-instance staleness
+DISPLAY_NAME_MEMCACHE_TTL = 6 * 60 * 60
+
+
+class LRUCache(object):
+    """LRUCache -- bounded, thread-safe in-process cache
+
+    Entries expire after `ttl` seconds so that values written by other
+    instances (which cannot invalidate this one) are picked up eventually.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_multi(self, keys):
+        """Return a dict of the keys found (and not expired)."""
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    continue
+                value, expires = entry
+                if expires < now:
+                    continue
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+                found[key] = value
+        return found
+
+    def set_multi(self, mapping):
+        """Store every key/value of mapping, evicting the oldest entries."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._entries.pop(key, None)
+                self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+#########################
+# """ DISPLAY NAMES """ #
+##############################################################################
+
+_display_names = LRUCache(DISPLAY_NAME_LOCAL_SIZE, DISPLAY_NAME_LOCAL_TTL)
+
+
+def get_display_names(user_ids):
+    """Return {user_id: displayName} for the given Profile ids.
+
+    Looks in the per-instance LRU first, then memcache (one get_multi),
+    then the datastore (one get_multi) for whatever is still missing.
+    Ids without a Profile are left out of the result.
+    """
+    wanted = set(user_ids)
+    names = _display_names.get_multi(wanted)
+
+    missing = [user_id for user_id in wanted if user_id not in names]
+    if missing:
+        cached = memcache.get_multi(
+            missing, key_prefix=MEMCACHE_DISPLAY_NAME_PREFIX)
+        _display_names.set_multi(cached)
+        names.update(cached)
+        missing = [user_id for user_id in missing if user_id not in cached]
+
+    if missing:
+        profiles = ndb.get_multi([ndb.Key(Profile, user_id)
+                                  for user_id in missing])
+        loaded = dict((profile.key.id(), profile.displayName)
+                      for profile in profiles if profile)
+        if loaded:
+            memcache.set_multi(loaded,
+                               key_prefix=MEMCACHE_DISPLAY_NAME_PREFIX,
+                               time=DISPLAY_NAME_MEMCACHE_TTL)
+            _display_names.set_multi(loaded)
+            names.update(loaded)
+
+    return names
+
+
+def set_display_name(user_id, display_name):
+    """Write-through a changed displayName after a Profile save."""
+    _display_names.set_multi({user_id: display_name})
+    memcache.set(MEMCACHE_DISPLAY_NAME_PREFIX + user_id, display_name,
+                 time=DISPLAY_NAME_MEMCACHE_TTL)
+
+
+##########################
+# """ VERSION STAMPS """ #
+##############################################################################
+
+MEMCACHE_VERSION_PREFIX = 'VERSION:'
+
+
+def _new_version():
+    # time based, so a stamp recreated after memcache eviction can never
+    # repeat one that was handed out (as an ETag) before the eviction
+    return int(time.time() * 1000)
+
+
+def get_version(name):
+    """Return the current version stamp for name, creating one if needed."""
+    key = MEMCACHE_VERSION_PREFIX + name
+    version = memcache.get(key)
+    if version is None:
+        version = _new_version()
+        if not memcache.add(key, version):
+            # another request created it first; use theirs
+            version = memcache.get(key) or version
+    return version
+
+
+def bump_version(name):
+    """Invalidate everything stamped with the current version of name.
+
+    Inside a transaction the bump is deferred until commit, so readers
+    never pair the new stamp with data from before the write.
+    """
+    def bump():
+        memcache.incr(MEMCACHE_VERSION_PREFIX + name,
+                      initial_value=_new_version())
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(bump)
+    else:
+        bump()
+
+
+##########################
+# """ CHUNKED VALUES """ #
+##############################################################################
+
+MEMCACHE_CHUNK_KEY = '%s:%d'
+
+
+def get_chunks(key):
+    """Return the list of chunks stored under key, or None if any is gone.
+
+    Values too big for one memcache entry (1MB) are stored as a chunk
+    count under key plus one entry per chunk.
+    """
+    count = memcache.get(key)
+    if count is None:
+        return None
+    chunk_keys = [MEMCACHE_CHUNK_KEY % (key, index) for index in range(count)]
+    found = memcache.get_multi(chunk_keys)
+    if len(found) != count:
+        return None
+    return [found[chunk_key] for chunk_key in chunk_keys]
+
+
+def set_chunks(key, chunks, time=0):
+    """Store a list of chunks (each under 1MB) under key in one RPC."""
+    mapping = dict((MEMCACHE_CHUNK_KEY % (key, index), chunk)
+                   for index, chunk in enumerate(chunks))
+    mapping[key] = len(chunks)
+    memcache.set_multi(mapping, time=time)
+
+
+#########################
+# """ SINGLE FLIGHT """ #
+##############################################################################
+
+MEMCACHE_LEASE_PREFIX = 'LEASE:'
+# marks a key whose compute() found nothing, for negative_ttl seconds
+MEMCACHE_NEGATIVE_PREFIX = 'NEG:'
+SINGLE_FLIGHT_LEASE = 10            # seconds one recompute may hold a key
+SINGLE_FLIGHT_STALE_TIME = 10 * 60  # stale values are kept this much longer
+# pauses (seconds) between re-reads while another request recomputes
+SINGLE_FLIGHT_WAITS = (0.02, 0.05, 0.1, 0.15, 0.2)
+
+
+def _unwrap(cached, stale):
+    """(value or None, whether it is still fresh) of a memcache entry."""
+    if not stale:
+        return cached, True
+    if not isinstance(cached, tuple):
+        return None, False
+    value, fresh_until = cached
+    return value, not fresh_until or fresh_until > time.time()
+
+
+@ndb.tasklet
+def _read(key, stale, negative):
+    """(value, fresh, known missing) of key, in one memcache RPC."""
+    context = ndb.get_context()
+    if not negative:
+        cached = yield context.memcache_get(key)
+        raise ndb.Return(_unwrap(cached, stale) + (False,))
+    # the context batches both gets into one get_multi
+    cached, marker = yield (context.memcache_get(key), context.memcache_get(
+        MEMCACHE_NEGATIVE_PREFIX + key))
+    raise ndb.Return(_unwrap(cached, stale) + (marker is not None,))
+
+
+@ndb.tasklet
+def _compute(compute):
+    value = compute()
+    if isinstance(value, ndb.Future):
+        value = yield value
+    raise ndb.Return(value)
+
+
+def set_cached(key, value, ttl=0, stale=True):
+    """Store a value for get_or_compute(), e.g. from a refresh job.
+
+    With stale=True the value is kept SINGLE_FLIGHT_STALE_TIME past its
+    ttl, so that it can still be served while it is recomputed.
+    """
+    if value is None:
+        return
+    if not stale:
+        memcache.set(key, value, time=ttl)
+    elif ttl:
+        memcache.set(key, (value, time.time() + ttl),
+                     time=ttl + SINGLE_FLIGHT_STALE_TIME)
+    else:
+        memcache.set(key, (value, 0))
+
+
+def get_or_compute(key, compute, ttl=0, stale=True, negative_ttl=0):
+    """Return the value cached under key, or compute() and cache it.
+
+    On a miss only the request that wins a short memcache add() lease
+    calls compute(); the others serve the stale value, if stale=True
+    and there is one, or wait briefly for the leaseholder's result.
+    Once the waits run out they compute it themselves rather than fail.
+
+    Caches whose key changes with the data (e.g. a version stamp) have
+    no stale value worth serving and pass stale=False, which stores the
+    bare value.
+
+    compute() returns None when there is nothing to cache (e.g. the
+    entity does not exist). With negative_ttl that outcome is remembered
+    too: for negative_ttl seconds, or until forget_missing(key), the key
+    reads as None without calling compute().
+    """
+    return get_or_compute_async(key, compute, ttl, stale,
+                                negative_ttl).get_result()
+
+
+@ndb.tasklet
+def get_or_compute_async(key, compute, ttl=0, stale=True, negative_ttl=0):
+    """get_or_compute() as a tasklet, so that several lookups (e.g. the
+    calls of a batch) wait on memcache and compute() together; compute
+    may return a Future, e.g. from a tasklet."""
+    context = ndb.get_context()
+    value, fresh, missing = yield _read(key, stale, negative_ttl)
+    if missing:
+        raise ndb.Return(None)
+    if value is not None and fresh:
+        raise ndb.Return(value)
+
+    lease_key = MEMCACHE_LEASE_PREFIX + key
+    leased = yield context.memcache_add(lease_key, 1,
+                                        time=SINGLE_FLIGHT_LEASE)
+    if leased:
+        try:
+            value = yield _compute(compute)
+            if value is not None:
+                set_cached(key, value, ttl, stale)
+            elif negative_ttl:
+                remember_missing(key, negative_ttl)
+        finally:
+            memcache.delete(lease_key)
+        raise ndb.Return(value)
+
+    if value is not None:
+        # being refreshed by the leaseholder
+        raise ndb.Return(value)
+    for delay in SINGLE_FLIGHT_WAITS:
+        yield ndb.sleep(delay)
+        value, _, missing = yield _read(key, stale, negative_ttl)
+        if missing:
+            raise ndb.Return(None)
+        if value is not None:
+            raise ndb.Return(value)
+    # the leaseholder is slow or failed; stop waiting for it
+    value = yield _compute(compute)
+    raise ndb.Return(value)
+
+
+def is_missing(key):
+    """Return True while key is remembered as missing."""
+    return memcache.get(MEMCACHE_NEGATIVE_PREFIX + key) is not None
+
+
+def remember_missing(key, negative_ttl):
+    """Remember key as missing, as get_or_compute() does when compute()
+    finds nothing: for negative_ttl seconds, or until forget_missing(key).
+
+    For lookups whose found value is not worth caching, e.g. an entity
+    that a get by key reads anyway.
+    """
+    memcache.set(MEMCACHE_NEGATIVE_PREFIX + key, 1, time=negative_ttl)
+
+
+def forget_missing(key):
+    """Drop the negative entry of key, e.g. once its entity is created.
+
+    Inside a transaction the entry is dropped once the transaction
+    commits. A reader that missed just before the commit can still write
+    it back, but only for its short negative_ttl.
+    """
+    def forget():
+        memcache.delete(MEMCACHE_NEGATIVE_PREFIX + key)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(forget)
+    else:
+        forget()
@@ -10,16 +10,24 @@ created by wesc on 2014 apr 21
 
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+import random
 import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import app_identity
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
@@ -28,15 +36,30 @@ from models import BooleanMessage
 from models import Conference, ConferenceForm, ConferenceForms,\
     ConferenceQueryForms
 
+from models import SessionSummary, SessionTypeCount
 from models import TeeShirtSize
 from models import StringMessage
+from models import BatchForm, BatchResultForm, BatchResultForms
+from models import Tombstone, ChangesQueryForm, ConferenceChangesForm, \
+    SessionChangesForm, ReviewChangesForm
 from models import SessionForm, Session, SessionQueryForm, \
     SessionTypeEnum, SessionForms, SessionsQueryTypeAndTime
+from models import SessionTimeWindowForm, MAX_SESSION_MINUTES
+from models import SessionRecommendations, RecommendedSessionForm, \
+    RecommendedSessionForms
 
 from models import Wishlist, WishlistForm, WishlistFormName
-from models import Review, ReviewForm, ReviewForms, ReviewQueryForm, ReviewEnum
-
-from utils import getUserId
+from models import Review, ReviewForm, ReviewForms, ReviewQueryForm
+from models import ReviewEnum, ReviewStats, ReviewCountForm, \
+    ReviewStatsForm, ReviewStatsQueryForm
+
+from utils import RequestContext
+from cache import get_display_names, set_display_name
+from cache import get_version, bump_version
+from cache import get_or_compute, get_or_compute_async, set_cached, \
+    forget_missing, is_missing, remember_missing
+from mappers import get_mapper
+from ratelimit import rate_limited
 from settings import WEB_CLIENT_ID
 
 # Author declaration line moved for pep8 compliance
@@ -45,12 +68,103 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+# recomputed on the first read after this; the cron refreshes it too
+ANNOUNCEMENT_TTL = 60 * 60
+# Rendered responses, keyed by websafeConferenceKey and version stamp
+MEMCACHE_CONFERENCE_FORM_KEY = "CONFERENCE_FORM:%s:%s"
+MEMCACHE_CONFERENCE_SESSIONS_KEY = "CONFERENCE_SESSIONS:%s:%s"
+CONFERENCE_CACHE_TTL = 10 * 60
+MEMCACHE_SESSION_KEY_BY_NAME = "SESSION_KEY_BY_NAME:%s"
+SESSION_KEY_BY_NAME_TTL = 60 * 60
+# sessions known to be missing, by websafe key (negative entries only)
+MEMCACHE_SESSION_KEY = "SESSION:%s"
+MEMCACHE_CONFERENCE_KEY_BY_NAME = "CONFERENCE_KEY_BY_NAME:%s"
+CONFERENCE_KEY_BY_NAME_TTL = 60 * 60
+# Lookups that found nothing are answered from memcache for this long,
+# or until an entity they would have found is created
+NEGATIVE_CACHE_TTL = 60
+# Sampled conference read counts; /_ah/warmup primes the hottest ones
+MEMCACHE_HOT_CONFERENCES_KEY = "HOT_CONFERENCES"
+HOT_CONFERENCE_SAMPLE_RATE = 0.1
+HOT_CONFERENCES_TRACKED = 50
+HOT_CONFERENCE_DECAY_AT = 1000  # halve all counts when one reaches this
+WARMUP_CONFERENCES = 10
+# Write-behind review ingestion: postReview only validates and enqueues
+# to a pull queue; the flush worker writes the reviews in batches
+REVIEW_INGEST_BUFFERED = False
+REVIEW_INGEST_QUEUE = 'review-ingest'
+REVIEW_FLUSH_BATCH = 500
+REVIEW_FLUSH_LEASE = 60        # seconds
+# reviews per transaction; with the two ReviewStats it stays under the
+# 500 entities a commit may write
+REVIEW_FLUSH_TRANSACTION_SIZE = 400
+# tasks leased this often without being written go to the dead letters
+REVIEW_FLUSH_MAX_LEASES = 5
+REVIEW_DEAD_LETTER_QUEUE = 'review-ingest-failed'
+REVIEW_PAGE_SIZE = 20
+# Conference confirmation emails are queued here and sent as one
+# digest per organizer by /crons/send_confirmation_digests
+CONFIRMATION_EMAIL_QUEUE = 'confirmation-email'
+REVIEW_MAX_PAGE_SIZE = 100
+SESSION_WINDOW_PAGE_SIZE = 50
+SESSION_WINDOW_MAX_PAGE_SIZE = 200
+# Methods the batch endpoint will dispatch to: reads, and getProfile,
+# which creates the caller's Profile on first use
+BATCH_METHODS = frozenset([
+    'getAnnouncement',
+    'getConference',
+    'getConferenceSessions',
+    'getConferencesCreated',
+    'getConferencesToAttend',
+    'getFeaturedSpeaker',
+    'getProfile',
+    'getRecommendedSessions',
+    'getReviewStats',
+    'getSessionsInWishlist',
+    'queryConferences',
+])
+# batch sub-calls that read the caller's Profile
+BATCH_PROFILE_METHODS = frozenset([
+    'getConferencesCreated',
+    'getConferencesToAttend',
+    'getProfile',
+    'getSessionsInWishlist',
+])
+# batch sub-calls whose datastore work runs as a tasklet, by the helper
+# that returns its Future; they all wait on the datastore together
+BATCH_ASYNC_METHODS = {
+    'getConference': '_getConferenceAsync',
+    'getConferenceSessions': '_getConferenceSessionsAsync',
+    'getConferencesCreated': '_getConferencesCreatedAsync',
+    'getSessionsInWishlist': '_getSessionsInWishlistAsync',
+    'queryConferences': '_queryConferencesAsync',
+}
+BATCH_MAX_CALLS = 10
+# Delta sync: pages of entities ordered by their `updated` stamp
+SYNC_PAGE_SIZE = 100
+SYNC_MAX_PAGE_SIZE = 500
+SYNC_WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# changes are re-sent this far before a watermark: a write is stamped
+# before it commits, and global queries are eventually consistent
+SYNC_SAFETY_MARGIN = timedelta(seconds=60)
+# tombstones are kept this long; older watermarks get a full sync
+TOMBSTONE_RETENTION_DAYS = 30
+TOMBSTONE_PURGE_BATCH = 500
+# Speaker review aggregates are spread over this many entity groups
+SPEAKER_STATS_SHARDS = 4
 
 
 ##################
 # """ FIELDS """ #
 ##############################################################################
 
+# ConferenceForm fields that are computed for output, never stored
+CONFERENCE_OUTPUT_FIELDS = ('websafeKey', 'organizerDisplayName', 'etag',
+                            'sessionSummary', 'notModified')
+# ConferenceForm fields copied unless the session summary is requested
+CONFERENCE_FORM_FIELDS = [field.name for field in ConferenceForm.all_fields()
+                          if field.name != 'sessionSummary']
+
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
@@ -79,6 +193,12 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_GET_CONDITIONAL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -87,6 +207,17 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+CALENDAR_URL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    reset=messages.BooleanField(1),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
 )
 
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
@@ -104,6 +235,11 @@ SESSION_POST_QUERY_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+RECOMMENDATIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),
+)
+
 ##########################
 # """ CONFERENCE API """ #
 ##############################################################################
@@ -115,35 +251,46 @@ SESSION_POST_QUERY_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # set (on the per-request instance) while batch() runs its sub-calls,
+    # whose conditional requests come from their params, never the headers
+    _batching = False
+
+    def initialize_request_state(self, request_state):
+        """Start every API call with a fresh identity/profile context."""
+        super(ConferenceApi, self).initialize_request_state(request_state)
+        self._request_context = RequestContext()
+
+    @property
+    def _context(self):
+        """RequestContext shared by all helpers for the current call."""
+        # instantiated directly (e.g. by task handlers in main.py)
+        # there is no request state, so create the context lazily
+        if getattr(self, '_request_context', None) is None:
+            self._request_context = RequestContext()
+        return self._request_context
+
 ##############################
 # """ CONFERENCE METHODS """ #
 ##############################################################################
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, summary=False):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        # Dates become date strings, websafeKey comes from the entity key;
+        # see mappers.FormMapper
+        mapper = get_mapper(
+            Conference, ConferenceForm,
+            fields=None if summary else CONFERENCE_FORM_FIELDS,
+            check_initialized=True)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+            return mapper.to_form(conf, organizerDisplayName=displayName)
+        return mapper.to_form(conf)
 
     def _createConferenceObject(self, request):
         """Create or update Conference object,
         returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user = self._checkLoggedIn()
+        user_id = self._context.user_id
 
         if not request.name:
             raise endpoints.BadRequestException(
@@ -151,9 +298,8 @@ class ConferenceApi(remote.Service):
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
+                for field in request.all_fields()
+                if field.name not in CONFERENCE_OUTPUT_FIELDS}
 
         # add default values for those missing
         # (both data model & outbound Message)
@@ -188,9 +334,18 @@ class ConferenceApi(remote.Service):
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
         Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email')
+        forget_missing(MEMCACHE_CONFERENCE_KEY_BY_NAME % data['name'])
+        confirmation = {
+            'email': user.email(),
+            'name': request.name,
+            'city': request.city,
+            'startDate': request.startDate,
+            'endDate': request.endDate,
+            'topics': request.topics,
+            'maxAttendees': request.maxAttendees,
+        }
+        taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE).add(taskqueue.Task(
+            payload=json.dumps(confirmation), method='PULL'))
 
         return request
 
@@ -202,10 +357,8 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        self._checkLoggedIn()
+        user_id = self._context.user_id
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
@@ -227,6 +380,8 @@ class ConferenceApi(remote.Service):
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            if field.name in CONFERENCE_OUTPUT_FIELDS:
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -238,7 +393,9 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        self._bumpConferenceETag(conf.key.urlsafe())
+        forget_missing(MEMCACHE_CONFERENCE_KEY_BY_NAME % conf.name)
+        prof = self._context.profile
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference/create',
@@ -247,39 +404,141 @@ class ConferenceApi(remote.Service):
         """Create new conference."""
         return self._createConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    # Version stamp of a conference, bumped whenever the conference,
+    # its sessions or its registrations change; used as ETag
+    def _conferenceETag(self, websafeConferenceKey):
+        return str(get_version('conference:%s' % websafeConferenceKey))
+
+    def _bumpConferenceETag(self, websafeConferenceKey):
+        bump_version('conference:%s' % websafeConferenceKey)
+
+    def _notModified(self, request, etag):
+        """Return True if the client already holds etag.
+
+        The client's ETag comes from the ifNoneMatch request field or the
+        If-None-Match header. Endpoints turns a 304 into a 404, so callers
+        answer True with a 200 carrying only etag and notModified.
+        """
+        presented = getattr(request, 'ifNoneMatch', None)
+        if not presented and not self._batching:
+            try:
+                presented = self.request_state.headers.get('If-None-Match')
+            except AttributeError:
+                # no HTTP request state (service called directly)
+                presented = None
+        return bool(presented) and etag in [tag.strip().strip('"')
+                                            for tag in presented.split(',')]
+
+    @endpoints.method(CONF_GET_CONDITIONAL_REQUEST, ConferenceForm,
                       path='conference/get/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s'
-                % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        return self._getConferenceAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferenceAsync(self, request):
+        wsck = request.websafeConferenceKey
+        self._websafeKey(wsck, Conference)
+        # unchanged polls stop here, after a single memcache read
+        etag = self._conferenceETag(wsck)
+        if self._notModified(request, etag):
+            raise ndb.Return(ConferenceForm(etag=etag, notModified=True))
+
+        cf = yield self._conferenceFormAsync(wsck, etag)
+        self._tallyConferenceHit(wsck)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf.etag = etag
+        raise ndb.Return(cf)
+
+    def _conferenceForm(self, websafeConferenceKey, etag):
+        return self._conferenceFormAsync(
+            websafeConferenceKey, etag).get_result()
+
+    # ConferenceForm for a conference at version etag, rendered once
+    # per version (by one request at a time) and then served from memcache;
+    # a missing conference is remembered as missing for a while
+    @ndb.tasklet
+    def _conferenceFormAsync(self, websafeConferenceKey, etag):
+        @ndb.tasklet
+        def render():
+            conf = yield ndb.Key(urlsafe=websafeConferenceKey).get_async()
+            if not conf:
+                raise ndb.Return(None)
+            organizer_id = conf.key.parent().id()
+            names = get_display_names([organizer_id])
+            raise ndb.Return(protojson.encode_message(
+                self._copyConferenceToForm(conf, names.get(organizer_id))))
+
+        cached = yield get_or_compute_async(
+            MEMCACHE_CONFERENCE_FORM_KEY % (websafeConferenceKey, etag),
+            render, ttl=CONFERENCE_CACHE_TTL, stale=False,
+            negative_ttl=NEGATIVE_CACHE_TTL)
+        # bail if not found
+        if cached is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+        raise ndb.Return(protojson.decode_message(ConferenceForm, cached))
+
+    # Key of a websafe key string; a malformed string, or the key of
+    # another kind, is a 404 without any RPC
+    @staticmethod
+    def _websafeKey(websafeKey, model):
+        try:
+            key = ndb.Key(urlsafe=websafeKey)
+        except Exception:
+            key = None
+        if key is None or key.kind() != model._get_kind():
+            raise endpoints.NotFoundException(
+                'No %s found with key: %s' % (
+                    model._get_kind().lower(), websafeKey))
+        return key
+
+    # Counts a sample of conference reads so /_ah/warmup knows which
+    # conferences are hot; a lost update only skews the sample
+    @staticmethod
+    def _tallyConferenceHit(websafeConferenceKey):
+        if random.random() >= HOT_CONFERENCE_SAMPLE_RATE:
+            return
+        client = memcache.Client()
+        hits = client.gets(MEMCACHE_HOT_CONFERENCES_KEY)
+        if hits is None:
+            client.add(MEMCACHE_HOT_CONFERENCES_KEY,
+                       {websafeConferenceKey: 1})
+            return
+
+        hits[websafeConferenceKey] = hits.get(websafeConferenceKey, 0) + 1
+        if hits[websafeConferenceKey] >= HOT_CONFERENCE_DECAY_AT:
+            # age out past popularity
+            hits = dict((wsck, count // 2) for wsck, count in hits.items()
+                        if count // 2)
+        while len(hits) > HOT_CONFERENCES_TRACKED:
+            coldest = min((wsck for wsck in hits
+                           if wsck != websafeConferenceKey), key=hits.get)
+            del hits[coldest]
+        client.cas(MEMCACHE_HOT_CONFERENCES_KEY, hits)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conference/get/created',
                       http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
+        return self._getConferencesCreatedAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferencesCreatedAsync(self, request):
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        self._checkLoggedIn()
+        user_id = self._context.user_id
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = yield Conference.query(
+            ancestor=ndb.Key(Profile, user_id)).fetch_async()
+        names = get_display_names([user_id])
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
+        raise ndb.Return(ConferenceForms(
             items=[self._copyConferenceToForm(
-                conf, getattr(prof, 'displayName')) for conf in confs]
-        )
+                conf, names.get(user_id)) for conf in confs]
+        ))
 
     def _getQuery(self, request):
         """Return formatted query from the submitted filters."""
@@ -340,33 +599,39 @@ class ConferenceApi(remote.Service):
                       name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return individual ConferenceForm object per Conference
-        return ConferenceForms(
+        return self._queryConferencesAsync(request).get_result()
+
+    # charged here, so that batched queries count against the limit too
+    @rate_limited('query')
+    @ndb.tasklet
+    def _queryConferencesAsync(self, request):
+        # run the query once; it is iterated twice below
+        conferences = yield self._getQuery(request).fetch_async()
+
+        # need to fetch organiser displayName from profiles;
+        # resolved in one batch through the display name cache
+        names = get_display_names(
+            [conf.organizerUserId for conf in conferences])
+
+        # return individual ConferenceForm object per Conference; the
+        # session summary is stored on the Conference, so it is free
+        raise ndb.Return(ConferenceForms(
                 items=[self._copyConferenceToForm(
-                    conf, names[conf.organizerUserId])
-                       for conf in conferences])
+                    conf, names.get(conf.organizerUserId),
+                    summary=bool(request.includeSummary))
+                       for conf in conferences]))
 
 #############################
 # """ WISH LIST METHODS """ #
 ##############################################################################
 
-    # Create a wishlist for the current logged in user
+    # Create a wishlist for the current logged in user, unless they
+    # already have one
     def _makeWishlist(self):
         user = self._getProfileFromUser()
         parent_key = user.key
+        if Wishlist.query(ancestor=parent_key).get(keys_only=True):
+            return
 
         new_wish_list = Wishlist(parent=parent_key)
         # set user_id (mainEmail) for ease of query
@@ -377,30 +642,29 @@ class ConferenceApi(remote.Service):
 
     # Return to current user's id
     def _getCurrentUserID(self):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-        return user_id
+        self._checkLoggedIn()
+        return self._context.user_id
 
     # Adds a session key to the logged in user's wishlist
     # requires session_key
     def _addSessionToWishlist(self, session_key):
         user_id = self._getCurrentUserID()
 
-        key = ndb.Key(Profile, user_id).get()
-        wish_list = Wishlist.query(ancestor=key.key).get()
+        # the wishlist is a child of the profile; no need to load it
+        wish_list = Wishlist.query(ancestor=ndb.Key(Profile, user_id)).get()
         if wish_list and wish_list.sessionKeys:
             wish_list.sessionKeys.append(session_key)
         else:
             wish_list.sessionKeys = [session_key]
         wish_list.put()
+        # invalidates the cached wishlist calendar feed
+        bump_version('wishlist:%s' % user_id)
 
     # Looks up a model session key given a urlsafe key
-    # takes websafeConferenceKey
-    def _convertSessionWebsafeKey(self, websafeConferenceKey):
-        session = ndb.Key(urlsafe=websafeConferenceKey).get()
-        return session.key
+    # takes websafeSessionKey; the session must exist
+    def _convertSessionWebsafeKey(self, websafeSessionKey):
+        return self._getSessionByKey(
+            self._websafeKey(websafeSessionKey, Session)).key
 
     # Finds a session key by session name and calls
     # _addSessionToWishList to add key
@@ -410,18 +674,19 @@ class ConferenceApi(remote.Service):
         self._addSessionToWishlist(session_key=session.key)
 
     # Retrieves logged in user's wishlist
-    # Returns one or more session forms
-    def _getSessionsInWishlist(self):
+    # Returns (a Future of) one or more session forms; charged here, so
+    # that batched reads count against the limit too
+    @rate_limited('wishlist')
+    @ndb.tasklet
+    def _getSessionsInWishlistAsync(self, request):
         user_id = self._getCurrentUserID()
-        wishlist = Wishlist.query(ancestor=ndb.Key(Profile, user_id)).get()
-
-        forms = SessionForms()
+        wishlist = yield Wishlist.query(
+            ancestor=ndb.Key(Profile, user_id)).get_async()
 
-        for key in wishlist.sessionKeys:
-            query = Session.query(Session.key == key).get()
-            forms.items += [self._copySessionToForm(session=query)]
-
-        return forms
+        # one batch get instead of a query per wishlisted session
+        sessions = yield ndb.get_multi_async(wishlist.sessionKeys)
+        raise ndb.Return(self._copyMultipleSessionsToForm(
+            query=[session for session in sessions if session]))
 
     @endpoints.method(WishlistForm, StringMessage,
                       path='conference/session/wishlist/add',
@@ -456,67 +721,26 @@ class ConferenceApi(remote.Service):
                       name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """Get Session from current user wishlist"""
-        return self._getSessionsInWishlist()
+        return self._getSessionsInWishlistAsync(request).get_result()
 
 ###########################
 # """ SESSION METHODS """ #
 ##############################################################################
 
-    # Convert String to associated SessionType Enum from all possible enums
-    #   NOT_SPECIFIED = 1, workshop = 2,
-    # lecture = 3, demonstration = 4, party = 5
-    def _convertStringToSessionType(self, string_field):
-
-        # todo: Finalize generic field loop
-        # enum_list = list(map(str(SessionTypeEnum)))
-        # for enum in SessionTypeEnum:
-        #     print "ENUM = " + str(enum)
-        #
-        #     if string_field == str(enum):
-        #         output = enum
-        #     else:
-        #         output = SessionTypeEnum.NOT_SPECIFIED
-
-        if string_field == 'workshop':
-            output = SessionTypeEnum.workshop
-        elif string_field == 'lecture':
-            output = SessionTypeEnum.lecture
-        elif string_field == 'demonstration':
-            output = SessionTypeEnum.demonstration
-        elif string_field == 'party':
-            output = SessionTypeEnum.party
-        else:
-            output = SessionTypeEnum.NOT_SPECIFIED
-        return output
-
     # Copies relevant session information to form for return
     # Takes session query
     # Returns form
     def _copySessionToForm(self, session):
         """Copy relevant fields from Session to SessionForm."""
-        session_form = SessionForm()
-        for field in session_form.all_fields():
-            if field.name == 'sessionType':
-                value = self._convertStringToSessionType(
-                    string_field=getattr(session, field.name))
-                setattr(session_form, field.name, value)
-            elif field.name == 'websafeKey':
-                setattr(session_form, field.name, session.key.urlsafe())
-            elif field.name == 'date' or field.name == 'startTime':
-                setattr(session_form, field.name,
-                        str(getattr(session, field.name)))
-            else:
-                setattr(session_form, field.name,
-                        getattr(session, field.name))
-
-        return session_form
+        # sessionType string -> SessionTypeEnum (NOT_SPECIFIED if unknown),
+        # date and startTime -> strings; see mappers.FormMapper
+        return get_mapper(Session, SessionForm).to_form(session)
 
     # Sends query with possible multiple sessions to _copySessionToForm
     # Returns list of forms
     def _copyMultipleSessionsToForm(self, query):
             session_forms = SessionForms(
-                items=[self._copySessionToForm(session=session)
-                       for session in query])
+                items=get_mapper(Session, SessionForm).to_forms(query))
             return session_forms
 
     # Returns single conference query, get by name
@@ -582,30 +806,57 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No sessions found')
 
-    # Returns all session associated with a conference
-    # Takes conference name or websafeConferenceKey
-    def _getConferenceSessionsByKey(self, websafeConferenceKey):
-        try:
-            query_sessions = Session.query(
-                ancestor=ndb.Key(urlsafe=websafeConferenceKey))
-            return self._copyMultipleSessionsToForm(query=query_sessions)
-        except:
-            raise endpoints.NotFoundException(
-                'No sessions found')
-
-    # Returns a session key
+    # Returns a session
     # Requires name of session (session_name)
-    # Returns associated key
+    # Returns the (first) session of that name
     def _getSessionByName(self, session_name):
-        query_session = Session.query(Session.name == session_name)
-        result = query_session.fetch(limit=1)
-        return result[0]
+        session_key = self._getSessionKeyByName(session_name)
+        try:
+            return self._getSessionByKey(session_key)
+        except endpoints.NotFoundException:
+            # the cached key's session was deleted: look the name up
+            # again next time, in case another session has it
+            memcache.delete(MEMCACHE_SESSION_KEY_BY_NAME % session_name)
+            raise endpoints.NotFoundException(
+                'No session found with name: %s' % session_name)
+
+    # Returns the Session of session_key; a missing (e.g. deleted) one is
+    # remembered as missing for a while, so retrying a stale key costs a
+    # memcache read rather than a datastore RPC
+    def _getSessionByKey(self, session_key):
+        missing_key = MEMCACHE_SESSION_KEY % session_key.urlsafe()
+        if not is_missing(missing_key):
+            session = session_key.get()
+            if session:
+                return session
+            remember_missing(missing_key, NEGATIVE_CACHE_TTL)
+        raise endpoints.NotFoundException(
+            'No session found with key: %s' % session_key.urlsafe())
+
+    # Returns the key of the (first) session with the given name; the
+    # global name query runs once, then the key (or its absence, until
+    # a session of that name is created) is served from memcache
+    def _getSessionKeyByName(self, session_name):
+        def lookup():
+            key = Session.query(Session.name == session_name).get(
+                keys_only=True)
+            return key.urlsafe() if key else None
+
+        websafe_key = get_or_compute(
+            MEMCACHE_SESSION_KEY_BY_NAME % session_name, lookup,
+            ttl=SESSION_KEY_BY_NAME_TTL, stale=False,
+            negative_ttl=NEGATIVE_CACHE_TTL)
+        if not websafe_key:
+            raise endpoints.NotFoundException(
+                'No session found with name: %s' % session_name)
+        return ndb.Key(urlsafe=websafe_key)
 
     # Verifies speaker is registered. Speakers have a profile and
     # are identified by Google display name
     def _checkSpeakerProfile(self, displayName):
         try:
-            speaker = Profile.query(Profile.displayName == displayName).get()
+            speaker = Profile.query(
+                Profile.displayName == displayName).get(keys_only=True)
             return True
         except:
             print "No one with displayName: {} has been registered".format(
@@ -615,7 +866,7 @@ class ConferenceApi(remote.Service):
 
     # Check if current user is logged in
     def _checkLoggedIn(self):
-        user = endpoints.get_current_user()
+        user = self._context.user
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         return user
@@ -654,7 +905,7 @@ class ConferenceApi(remote.Service):
     # Delete websafe key in data fields
     # Returns data field without websafekey
     def _dropWebsafeKey(self, data):
-        # del data['websafeKey']
+        data.pop('websafeKey', None)
         if data['websafeConferenceKey']:
             del data['websafeConferenceKey']
         return data
@@ -702,6 +953,11 @@ class ConferenceApi(remote.Service):
         if not request.sessionType:
             raise endpoints.BadRequestException(
                 "Conference session 'sessionType' field required")
+        # time-window queries only look back MAX_SESSION_MINUTES
+        if request.duration and request.duration > MAX_SESSION_MINUTES:
+            raise endpoints.BadRequestException(
+                "Conference session 'duration' may not exceed %d minutes"
+                % MAX_SESSION_MINUTES)
 
         # Check to make sure speaker has a profile: using displayName
         self._checkSpeakerProfile(displayName=request.speakerDisplayName)
@@ -725,7 +981,9 @@ class ConferenceApi(remote.Service):
         # Set session as child of user supplied conference
         # Associate data and put session object
         session = Session(parent=parent_key, **clean_data)
-        session.put()
+        self._putSessionWithSummary(session)
+        self._bumpConferenceETag(parent_key.urlsafe())
+        forget_missing(MEMCACHE_SESSION_KEY_BY_NAME % session.name)
 
         # Update featured speaker key in memcache
         # Get the current speaker
@@ -744,6 +1002,51 @@ class ConferenceApi(remote.Service):
 
         return self._copySessionToForm(session=session)
 
+    # Folds a session into a conference's SessionSummary
+    @staticmethod
+    def _addToSessionSummary(summary, session):
+        summary = summary or SessionSummary()
+        summary.count += 1
+        if session.speakerDisplayName not in summary.speakers:
+            summary.speakers.append(session.speakerDisplayName)
+        for type_count in summary.types:
+            if type_count.sessionType == session.sessionType:
+                type_count.count += 1
+                break
+        else:
+            summary.types.append(SessionTypeCount(
+                sessionType=session.sessionType, count=1))
+        # computed here too: a new session has not been put yet
+        start = session._dateTimes()[0]
+        if start:
+            if not summary.firstStart or start < summary.firstStart:
+                summary.firstStart = start
+            if not summary.lastStart or start > summary.lastStart:
+                summary.lastStart = start
+        return summary
+
+    # Puts a new session and updates its conference's session summary
+    # in one transaction; both are in the conference's entity group
+    @classmethod
+    @ndb.transactional
+    def _putSessionWithSummary(cls, session):
+        conf = session.key.parent().get()
+        conf.sessionSummary = cls._addToSessionSummary(
+            conf.sessionSummary, session)
+        ndb.put_multi([session, conf])
+
+    # Recomputes a conference's session summary from its sessions;
+    # used by the conference_session_summaries migration
+    @classmethod
+    @ndb.transactional
+    def _rebuildSessionSummary(cls, conference_key):
+        conf = conference_key.get()
+        summary = None
+        for session in Session.query(ancestor=conference_key):
+            summary = cls._addToSessionSummary(summary, session)
+        conf.sessionSummary = summary
+        conf.put()
+
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/update/{websafeConferenceKey}',
                       http_method='POST', name='updateConference')
@@ -767,8 +1070,43 @@ class ConferenceApi(remote.Service):
                       name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Get sessions by conference web safe key."""
-        return self._getConferenceSessionsByKey(
-            websafeConferenceKey=request.websafeConferenceKey)
+        return self._getConferenceSessionsAsync(request).get_result()
+
+    @ndb.tasklet
+    def _getConferenceSessionsAsync(self, request):
+        wsck = request.websafeConferenceKey
+        conference_key = self._websafeKey(wsck, Conference)
+        # unchanged polls stop here, after a single memcache read
+        etag = self._conferenceETag(wsck)
+        if self._notModified(request, etag):
+            raise ndb.Return(SessionForms(etag=etag, notModified=True))
+
+        forms = yield self._conferenceSessionFormsAsync(conference_key, etag)
+        self._tallyConferenceHit(wsck)
+        forms.etag = etag
+        raise ndb.Return(forms)
+
+    def _conferenceSessionForms(self, websafeConferenceKey, etag):
+        return self._conferenceSessionFormsAsync(
+            ndb.Key(urlsafe=websafeConferenceKey), etag).get_result()
+
+    # SessionForms (the schedule) of a conference at version etag,
+    # rendered once per version (by one request at a time) and then
+    # served from memcache
+    @ndb.tasklet
+    def _conferenceSessionFormsAsync(self, conference_key, etag):
+        @ndb.tasklet
+        def render():
+            sessions = yield Session.query(
+                ancestor=conference_key).fetch_async()
+            raise ndb.Return(protojson.encode_message(
+                self._copyMultipleSessionsToForm(query=sessions)))
+
+        cached = yield get_or_compute_async(
+            MEMCACHE_CONFERENCE_SESSIONS_KEY % (conference_key.urlsafe(),
+                                                etag),
+            render, ttl=CONFERENCE_CACHE_TTL, stale=False)
+        raise ndb.Return(protojson.decode_message(SessionForms, cached))
 
     @endpoints.method(SESSION_POST_QUERY_REQUEST, SessionForms,
                       path='conference/session/query/'
@@ -789,6 +1127,76 @@ class ConferenceApi(remote.Service):
         """Get all session by speaker display name."""
         return self._getSessionBySpeaker(speaker=request.query)
 
+    # Parses a time window bound, 'YYYY-MM-DD HH:MM' or 'YYYY-MM-DDTHH:MM'
+    def _parseWindowTime(self, value, field):
+        try:
+            return datetime.strptime(value.replace('T', ' '),
+                                     '%Y-%m-%d %H:%M')
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "'%s' must look like 2015-11-03 14:00" % field)
+
+    @endpoints.method(SessionTimeWindowForm, SessionForms,
+                      path='conference/session/query/time_window',
+                      http_method='POST',
+                      name='getSessionsInTimeWindow')
+    def getSessionsInTimeWindow(self, request):
+        """Get a page of sessions, across all conferences, running at any
+        time in [windowStart, windowEnd)."""
+        window_start = self._parseWindowTime(
+            request.windowStart, 'windowStart')
+        window_end = self._parseWindowTime(request.windowEnd, 'windowEnd')
+        if window_end <= window_start:
+            raise endpoints.BadRequestException(
+                "'windowEnd' must be after 'windowStart'")
+
+        # one inequality on the indexed start; a session overlapping the
+        # window started at most MAX_SESSION_MINUTES before it
+        earliest = window_start - timedelta(minutes=MAX_SESSION_MINUTES)
+        query = Session.query(Session.startDateTime >= earliest,
+                              Session.startDateTime < window_end)\
+            .order(Session.startDateTime)
+
+        page_size = min(request.pageSize or SESSION_WINDOW_PAGE_SIZE,
+                        SESSION_WINDOW_MAX_PAGE_SIZE)
+        cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+        page, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=cursor)
+
+        # drop sessions that ended before the window opened; a page can
+        # come back short (even empty) while nextCursor is still set
+        running = [session for session in page
+                   if session.endDateTime > window_start or
+                   session.startDateTime >= window_start]
+        forms = self._copyMultipleSessionsToForm(query=running)
+        if more and next_cursor:
+            forms.nextCursor = next_cursor.urlsafe()
+        return forms
+
+    @staticmethod
+    def _recommendationsKey(session_key):
+        return ndb.Key(SessionRecommendations, 'top', parent=session_key)
+
+    @endpoints.method(RECOMMENDATIONS_GET_REQUEST, RecommendedSessionForms,
+                      path='session/{websafeSessionKey}/recommendations',
+                      http_method='GET',
+                      name='getRecommendedSessions')
+    def getRecommendedSessions(self, request):
+        """Get the sessions most often wishlisted together with a session.
+
+        Precomputed by /crons/build_recommendations; one key get.
+        """
+        recommendations = self._recommendationsKey(
+            self._websafeKey(request.websafeSessionKey, Session)).get()
+        if not recommendations:
+            return RecommendedSessionForms()
+        return RecommendedSessionForms(items=[
+            RecommendedSessionForm(websafeSessionKey=key.urlsafe(),
+                                   name=name, score=score)
+            for key, name, score in zip(recommendations.sessionKeys,
+                                        recommendations.names,
+                                        recommendations.scores)])
+
 #############################
 # """ TASK QUESTION 3.5 """ #
 ##############################################################################
@@ -886,40 +1294,28 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(
-                        TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        # t-shirt string is converted to Enum; others are just copied
+        return get_mapper(
+            Profile, ProfileForm, check_initialized=True).to_form(prof)
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore,
         creating new one if non-existent."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user = self._checkLoggedIn()
 
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        # get Profile from the request context (datastore at most once)
+        profile = self._context.profile
         # create new Profile if not there
         if not profile:
             profile = Profile(
-                key=p_key,
+                key=ndb.Key(Profile, self._context.user_id),
                 displayName=user.nickname(),
                 mainEmail=user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+            self._context.profile = profile
 
         return profile      # return Profile
 
@@ -936,6 +1332,8 @@ class ConferenceApi(remote.Service):
                     if val:
                         setattr(prof, field, str(val))
             prof.put()
+            # keep organiser display names shown on conferences current
+            set_display_name(prof.key.id(), prof.displayName)
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -946,6 +1344,20 @@ class ConferenceApi(remote.Service):
         """Return user profile."""
         return self._doProfile()
 
+    @endpoints.method(CALENDAR_URL_REQUEST, StringMessage,
+                      path='profile/calendar', http_method='GET',
+                      name='getWishlistCalendarUrl')
+    def getWishlistCalendarUrl(self, request):
+        """Return the iCalendar feed URL of the user's wishlist; reset=true
+        issues a new URL and revokes the old one."""
+        prof = self._getProfileFromUser()
+        if request.reset or not prof.calendarToken:
+            prof.calendarToken = os.urandom(16).encode('hex')
+            prof.put()
+        return StringMessage(data='https://%s/calendar/wishlist/%s/%s.ics' % (
+            app_identity.get_default_version_hostname(),
+            prof.key.urlsafe(), prof.calendarToken))
+
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile/save',
                       http_method='POST',
@@ -987,6 +1399,7 @@ class ConferenceApi(remote.Service):
 
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
+            prof.conferenceKeys.append(conf.key)
             conf.seatsAvailable -= 1
             retval = True
 
@@ -997,6 +1410,8 @@ class ConferenceApi(remote.Service):
 
                 # unregister user, add back one seat
                 prof.conferenceKeysToAttend.remove(wsck)
+                if conf.key in prof.conferenceKeys:
+                    prof.conferenceKeys.remove(conf.key)
                 conf.seatsAvailable += 1
                 retval = True
             else:
@@ -1005,6 +1420,8 @@ class ConferenceApi(remote.Service):
         # write things back to the datastore & return
         prof.put()
         conf.put()
+        # seatsAvailable changed
+        self._bumpConferenceETag(conf.key.urlsafe())
         return BooleanMessage(data=retval)
 
     # todo: This supplied method is not working properly
@@ -1022,20 +1439,15 @@ class ConferenceApi(remote.Service):
                      prof.conferenceKeysToAttend]
         conferences = ndb.get_multi(conf_keys)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # get organizer display names in one batch
+        names = get_display_names(
+            [conf.organizerUserId for conf in conferences])
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(
-                conf, names[conf.organizerUserId]) for conf in conferences])
+                conf, names.get(conf.organizerUserId))
+                for conf in conferences])
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/register/{websafeConferenceKey}',
@@ -1056,92 +1468,239 @@ class ConferenceApi(remote.Service):
 ##############################################################################
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
+    def _announcement():
+        """Announcement of nearly sold out conferences, or ''."""
         confs = Conference.query(ndb.AND(
             Conference.seatsAvailable <= 5,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
 
-        # Set MEMCACHE key to RECENT ANNOUNCEMENTS
-        memcache_announcements_key = 'RECENT ANNOUNCEMENTS'
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(memcache_announcements_key, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(memcache_announcements_key)
+        if not confs:
+            return ""
+        return '%s %s' % (
+            'Last chance to attend! The following conferences '
+            'are nearly sold out:',
+            ', '.join(conf.name for conf in confs))
 
+    @classmethod
+    def _cacheAnnouncement(cls):
+        """Create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement().
+        """
+        announcement = cls._announcement()
+        set_cached(MEMCACHE_ANNOUNCEMENTS_KEY, announcement,
+                   ttl=ANNOUNCEMENT_TTL)
         return announcement
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        # return an existing announcement from Memcache or an empty string.
-        memcache_announcement = memcache.get('RECENT ANNOUNCEMENTS')
-
-        if memcache_announcement is not None:
-            return StringMessage(data=memcache_announcement)
-        else:
-            announcement = ""
-            return StringMessage(data=announcement)
+        # once it expires one request rebuilds it while the others keep
+        # serving the previous announcement
+        announcement = get_or_compute(MEMCACHE_ANNOUNCEMENTS_KEY,
+                                      self._announcement,
+                                      ttl=ANNOUNCEMENT_TTL)
+
+        # the announcement is already in hand, so its hash is the ETag
+        etag = hashlib.md5(announcement.encode('utf-8')).hexdigest()
+        if self._notModified(request, etag):
+            return StringMessage(data='', etag=etag, notModified=True)
+        return StringMessage(data=announcement, etag=etag)
 
 ##########################
 # """ REVIEW METHODS """ #
 ##############################################################################
 
-    # Takes a string_field for posted review
-    # Returns associated enum
-    def _convertToReviewType(self, string_field):
-
-        if string_field == 'very_unsatisfied':
-            enum = ReviewEnum.very_unsatisfied
-        elif string_field == 'unsatisfied':
-            enum = ReviewEnum.unsatisfied
-        elif string_field == 'satisfied':
-            enum = ReviewEnum.satisfied
-        elif string_field == 'very_satisfied':
-            enum = ReviewEnum.very_satisfied
-        elif string_field == 'excellent':
-            enum = ReviewEnum.excellent
-        else:
-            enum = ReviewEnum.NO_OPINION
-        return enum
-
     # Takes a review and copies field to review form
     # Returns review form
     def _copyReviewToReviewForm(self, review):
         """Copy relevant fields from Review to ReviewForm."""
-        review_form = ReviewForm()
-        for field in review_form.all_fields():
-            if field.name == 'review':
-                value = self._convertToReviewType(
-                    string_field=getattr(review, field.name))
-                setattr(review_form, field.name, value)
-            else:
-                setattr(review_form, field.name, getattr(review, field.name))
-        return review_form
+        # review string -> ReviewEnum (NO_OPINION if unknown)
+        return get_mapper(Review, ReviewForm).to_form(review)
 
     # Allows for copying multiple reviews to review form
     # Returns list of review forms
     def _copyMutipleReivewsToReviewForm(self, query):
         review_forms = ReviewForms(
-            items=[self._copyReviewToReviewForm(
-                review=review)for review in query])
+            items=get_mapper(Review, ReviewForm).to_forms(query))
         return review_forms
 
+    # Number of stars for a stored review string; NO_OPINION is 0
+    @staticmethod
+    def _reviewRating(review):
+        try:
+            return ReviewEnum.lookup_by_name(review).number
+        except KeyError:
+            return ReviewEnum.NO_OPINION.number
+
+    @staticmethod
+    def _sessionStatsKey(session_key):
+        return ndb.Key(ReviewStats, 'session', parent=session_key)
+
+    @staticmethod
+    def _speakerStatsKeys(speaker):
+        return [ndb.Key(ReviewStats, 'speaker:%s:%d' % (speaker, shard))
+                for shard in range(SPEAKER_STATS_SHARDS)]
+
+    @staticmethod
+    def _newReviewStats(key):
+        return ReviewStats(key=key, histogram=[0] * len(ReviewEnum))
+
+    @staticmethod
+    def _addRatings(stats, ratings):
+        for rating in ratings:
+            stats.histogram[rating] += 1
+            # NO_OPINION is counted in the histogram but not the average
+            if rating:
+                stats.count += 1
+                stats.total += rating
+
+    @classmethod
+    def _applyReviewStats(cls, session_key, speaker, ratings):
+        """Add ratings to the session's and speaker's aggregates.
+
+        Call inside the (xg) transaction that puts the reviews. The session
+        aggregate lives in the Session's entity group, like its Reviews; the
+        speaker aggregate goes to a random shard to keep it off one group.
+        """
+        keys = [cls._sessionStatsKey(session_key)]
+        if speaker:
+            keys.append(random.choice(cls._speakerStatsKeys(speaker)))
+        stats = [entity or cls._newReviewStats(key)
+                 for key, entity in zip(keys, ndb.get_multi(keys))]
+        for entity in stats:
+            cls._addRatings(entity, ratings)
+        ndb.put_multi(stats)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _putReviewBatch(cls, session_key, speaker, reviews):
+        """Put reviews of one session and update aggregates, atomically.
+
+        Reviews whose key already exists are skipped, so a redelivered
+        batch from the ingest queue is neither stored nor counted twice;
+        reviews without an id yet (a direct postReview) are always new.
+        """
+        keys = [review.key for review in reviews if review.key.id()]
+        existing = set(entity.key for entity in ndb.get_multi(keys)
+                       if entity)
+        new = [review for review in reviews if review.key not in existing]
+        if new:
+            ndb.put_multi(new)
+            cls._applyReviewStats(
+                session_key, speaker, [review.rating for review in new])
+        return len(new)
+
+    def _bufferReview(self, session_key, speaker, data):
+        payload = dict(data, websafeSessionKey=session_key.urlsafe(),
+                       speaker=speaker)
+        taskqueue.Queue(REVIEW_INGEST_QUEUE).add(
+            taskqueue.Task(payload=json.dumps(payload), method='PULL'))
+
+    @classmethod
+    def _flushReviews(cls):
+        """Write buffered reviews with put_multi, one batch at a time.
+
+        Tasks are leased, grouped by session and written with one
+        transaction per REVIEW_FLUSH_TRANSACTION_SIZE reviews of a
+        session; only then are they deleted. Tasks of a failed
+        transaction stay queued and are leased again once their lease
+        expires, and the review id (the task name) makes that replay
+        idempotent. After REVIEW_FLUSH_MAX_LEASES leases they are moved
+        to REVIEW_DEAD_LETTER_QUEUE instead. Returns the number of
+        reviews written.
+        """
+        queue = taskqueue.Queue(REVIEW_INGEST_QUEUE)
+        written = 0
+        while True:
+            tasks = queue.lease_tasks(REVIEW_FLUSH_LEASE, REVIEW_FLUSH_BATCH)
+            by_session = {}
+            for task in tasks:
+                data = json.loads(task.payload)
+                session_key = ndb.Key(urlsafe=data.pop('websafeSessionKey'))
+                speaker = data.pop('speaker')
+                review = Review(key=ndb.Key(Review, task.name,
+                                            parent=session_key), **data)
+                batch = by_session.setdefault(session_key, (speaker, [], []))
+                batch[1].append(review)
+                batch[2].append(task)
+
+            done, dead = [], []
+            for session_key, (speaker, reviews, session_tasks) in \
+                    by_session.iteritems():
+                for start in range(0, len(reviews),
+                                   REVIEW_FLUSH_TRANSACTION_SIZE):
+                    end = start + REVIEW_FLUSH_TRANSACTION_SIZE
+                    try:
+                        written += cls._putReviewBatch(
+                            session_key, speaker, reviews[start:end])
+                        done.extend(session_tasks[start:end])
+                    except Exception:
+                        logging.exception(
+                            'Review flush failed for session %s',
+                            session_key)
+                        dead.extend(
+                            task for task in session_tasks[start:end]
+                            if task.retry_count >= REVIEW_FLUSH_MAX_LEASES)
+            if dead:
+                cls._deadLetterReviews(dead)
+                done.extend(dead)
+            if done:
+                queue.delete_tasks(done)
+            if len(tasks) < REVIEW_FLUSH_BATCH:
+                return written
+
+    # Copies ingest tasks that keep failing to the dead letter queue,
+    # under the same names, for inspection and replay by hand
+    @staticmethod
+    def _deadLetterReviews(tasks):
+        logging.error('Moving %d reviews to %s', len(tasks),
+                      REVIEW_DEAD_LETTER_QUEUE)
+        try:
+            taskqueue.Queue(REVIEW_DEAD_LETTER_QUEUE).add([
+                taskqueue.Task(name=task.name, payload=task.payload,
+                               method='PULL') for task in tasks])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # moved by an earlier run that failed to delete the originals
+            pass
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _rebuildSessionReviewStats(cls, session_key, speaker):
+        """Recompute one session's ReviewStats from its Reviews, atomically.
+
+        Run for every session by the review_stats migration, to backfill
+        aggregates for reviews posted before they existed. The speaker
+        aggregate gets the difference from the stored session aggregate,
+        so a re-run changes nothing and reviews posted meanwhile are
+        counted once. Returns the number of entities written.
+        """
+        key = cls._sessionStatsKey(session_key)
+        stored = key.get() or cls._newReviewStats(key)
+        stats = cls._newReviewStats(key)
+        cls._addRatings(stats, [
+            cls._reviewRating(review.review)
+            for review in Review.query(ancestor=session_key)])
+        if (stats.count, stats.total, stats.histogram) == \
+                (stored.count, stored.total, stored.histogram):
+            return 0
+
+        changed = [stats]
+        if speaker:
+            shard_key = random.choice(cls._speakerStatsKeys(speaker))
+            shard = shard_key.get() or cls._newReviewStats(shard_key)
+            shard.count += stats.count - stored.count
+            shard.total += stats.total - stored.total
+            shard.histogram = [
+                total + new - old for total, new, old in zip(
+                    shard.histogram, stats.histogram, stored.histogram)]
+            changed.append(shard)
+        ndb.put_multi(changed)
+        return len(changed)
+
     @endpoints.method(ReviewForm, StringMessage,
                       path='session/review/post',
                       http_method='POST',
@@ -1172,15 +1731,23 @@ class ConferenceApi(remote.Service):
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+                for field in request.all_fields()
+                if field.name != 'websafeKey'}
 
         # convert review to string for database put
         data = self._convertReview(data)
 
-        # Set session as child of user supplied conference
-        # Associate data and put session object
-        review = Review(parent=parent_key, **data)
-        review.put()
+        data['rating'] = self._reviewRating(data['review'])
+
+        if REVIEW_INGEST_BUFFERED:
+            # durable once add() returns; the flush worker does the write
+            self._bufferReview(parent_key, parent.speakerDisplayName, data)
+        else:
+            # Set session as child of user supplied conference
+            # Associate data and put session object
+            review = Review(parent=parent_key, **data)
+            self._putReviewBatch(
+                parent_key, parent.speakerDisplayName, [review])
 
         msg = "Thank you for your feedback"
 
@@ -1191,12 +1758,67 @@ class ConferenceApi(remote.Service):
                       http_method='POST',
                       name='getReview')
     def getReview(self, request):
-        """Get review for a session"""
+        """Get a page of reviews for a session"""
         self._checkLoggedIn()
 
-        reviews = Review.query(Review.session_name == request.session_name)
+        # reviews are children of their Session: query by ancestor, which
+        # is strongly consistent and unambiguous across conferences
+        if request.websafeSessionKey:
+            session_key = self._websafeKey(request.websafeSessionKey,
+                                           Session)
+        elif request.session_name:
+            session_key = self._getSessionKeyByName(request.session_name)
+        else:
+            raise endpoints.BadRequestException(
+                "'websafeSessionKey' or 'session_name' field required")
+
+        reviews = Review.query(ancestor=session_key)
+        if request.orderByRating:
+            reviews = reviews.order(-Review.rating)
+
+        page_size = min(request.pageSize or REVIEW_PAGE_SIZE,
+                        REVIEW_MAX_PAGE_SIZE)
+        cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+        page, next_cursor, more = reviews.fetch_page(
+            page_size, start_cursor=cursor)
 
-        return self._copyMutipleReivewsToReviewForm(query=reviews)
+        review_forms = self._copyMutipleReivewsToReviewForm(query=page)
+        if more and next_cursor:
+            review_forms.nextCursor = next_cursor.urlsafe()
+        return review_forms
+
+    @endpoints.method(ReviewStatsQueryForm, ReviewStatsForm,
+                      path='session/review/stats',
+                      http_method='POST',
+                      name='getReviewStats')
+    def getReviewStats(self, request):
+        """Get review count, average and histogram for a session or speaker"""
+        if request.websafeSessionKey:
+            keys = [self._sessionStatsKey(
+                self._websafeKey(request.websafeSessionKey, Session))]
+        elif request.speaker_name:
+            keys = self._speakerStatsKeys(request.speaker_name)
+        else:
+            raise endpoints.BadRequestException(
+                "'websafeSessionKey' or 'speaker_name' field required")
+
+        # one batch get, no query; missing shards count as empty
+        totals = self._newReviewStats(None)
+        for stats in ndb.get_multi(keys):
+            if stats:
+                totals.count += stats.count
+                totals.total += stats.total
+                totals.histogram = [a + b for a, b in
+                                    zip(totals.histogram, stats.histogram)]
+
+        return ReviewStatsForm(
+            count=totals.count,
+            average=(float(totals.total) / totals.count
+                     if totals.count else None),
+            histogram=[ReviewCountForm(review=review,
+                                       count=totals.histogram[review.number])
+                       for review in sorted(ReviewEnum,
+                                            key=lambda e: e.number)])
 
 ############################
 # """ FEATURED SPEAKER """ #
@@ -1251,15 +1873,20 @@ class ConferenceApi(remote.Service):
                       name='get_conference_key')
     def get_conference_key(self, request):
         """Retrieve websafe conference key for method testing purposes"""
-        try:
-            conference = Conference.query(
-                Conference.name == request.query).get()
-            msg = str(conference.key.urlsafe())
-            return StringMessage(data=msg)
-        except:
-            raise endpoints.BadRequestException(
-                "No conference with the name: {} has been found").format(
-                request.query)
+        def lookup():
+            key = Conference.query(
+                Conference.name == request.query).get(keys_only=True)
+            return key.urlsafe() if key else None
+
+        msg = get_or_compute(
+            MEMCACHE_CONFERENCE_KEY_BY_NAME % request.query, lookup,
+            ttl=CONFERENCE_KEY_BY_NAME_TTL, stale=False,
+            negative_ttl=NEGATIVE_CACHE_TTL)
+        if not msg:
+            raise endpoints.NotFoundException(
+                "No conference with the name: {} has been found".format(
+                    request.query))
+        return StringMessage(data=msg)
 
     # Method is for testing purposes only
     # Easy way to get generated url safe key for testing methods
@@ -1280,6 +1907,293 @@ class ConferenceApi(remote.Service):
                 "No session with the name: {} has been found").format(
                 request.query)
 
+######################
+# """ DELTA SYNC """ #
+##############################################################################
+
+    # Parses a sync watermark; None asks for a full sync
+    @staticmethod
+    def _parseWatermark(since):
+        if not since:
+            return None
+        for fmt in (SYNC_WATERMARK_FORMAT, '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.strptime(since, fmt)
+            except ValueError:
+                pass
+        raise endpoints.BadRequestException(
+            "'since' must be a watermark returned by a previous sync")
+
+    # One page of the entities of model changed since request.since,
+    # optionally under an ancestor, plus (on the first page) the
+    # websafe keys of those deleted since then.
+    # Returns (entities, deleted, nextCursor, watermark, fullSync)
+    def _changes(self, model, request, ancestor=None):
+        now = datetime.utcnow()
+        since = self._parseWatermark(request.since)
+        full = since is None or (
+            since < now - timedelta(days=TOMBSTONE_RETENTION_DAYS))
+
+        query = model.query(ancestor=ancestor)
+        if not full:
+            query = query.filter(model.updated >= since - SYNC_SAFETY_MARGIN)
+        query = query.order(model.updated)
+        page_size = min(request.pageSize or SYNC_PAGE_SIZE,
+                        SYNC_MAX_PAGE_SIZE)
+        cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+        entities, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=cursor)
+
+        deleted = []
+        if not full and not cursor:
+            tombstones = Tombstone.query(
+                Tombstone.kind == model._get_kind(),
+                Tombstone.deleted >= since - SYNC_SAFETY_MARGIN)
+            if ancestor:
+                tombstones = tombstones.filter(
+                    Tombstone.parentKey == ancestor)
+            deleted = [key.id() for key in tombstones.iter(keys_only=True)]
+
+        return (entities, deleted,
+                next_cursor.urlsafe() if more and next_cursor else None,
+                now.strftime(SYNC_WATERMARK_FORMAT), full)
+
+    @endpoints.method(ChangesQueryForm, ConferenceChangesForm,
+                      path='conference/changes',
+                      http_method='POST',
+                      name='getConferenceChanges')
+    def getConferenceChanges(self, request):
+        """Get conferences changed or deleted since a sync watermark.
+
+        Page through with nextCursor, passing the same since; keep the
+        watermark of the last page for the next sync. With fullSync set
+        the client should replace what it holds.
+        """
+        conferences, deleted, next_cursor, watermark, full = \
+            self._changes(Conference, request)
+        names = get_display_names(
+            [conf.organizerUserId for conf in conferences])
+        return ConferenceChangesForm(
+            items=[self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId), summary=True)
+                for conf in conferences],
+            deleted=deleted, nextCursor=next_cursor, watermark=watermark,
+            fullSync=full)
+
+    @endpoints.method(ChangesQueryForm, SessionChangesForm,
+                      path='conference/session/changes',
+                      http_method='POST',
+                      name='getSessionChanges')
+    def getSessionChanges(self, request):
+        """Get sessions (of all conferences, or of websafeConferenceKey)
+        changed or deleted since a sync watermark; paged like
+        getConferenceChanges."""
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = self._websafeKey(request.websafeConferenceKey,
+                                        Conference)
+        sessions, deleted, next_cursor, watermark, full = \
+            self._changes(Session, request, ancestor)
+        return SessionChangesForm(
+            items=get_mapper(Session, SessionForm).to_forms(sessions),
+            deleted=deleted, nextCursor=next_cursor, watermark=watermark,
+            fullSync=full)
+
+    @endpoints.method(ChangesQueryForm, ReviewChangesForm,
+                      path='session/review/changes',
+                      http_method='POST',
+                      name='getReviewChanges')
+    def getReviewChanges(self, request):
+        """Get reviews (of all sessions, or of websafeSessionKey) changed
+        or deleted since a sync watermark; paged like
+        getConferenceChanges."""
+        ancestor = None
+        if request.websafeSessionKey:
+            ancestor = self._websafeKey(request.websafeSessionKey, Session)
+        reviews, deleted, next_cursor, watermark, full = \
+            self._changes(Review, request, ancestor)
+        return ReviewChangesForm(
+            items=get_mapper(Review, ReviewForm).to_forms(reviews),
+            deleted=deleted, nextCursor=next_cursor, watermark=watermark,
+            fullSync=full)
+
+    # Deletes tombstones older than the sync retention; used by the
+    # /crons/purge_tombstones cron job
+    @staticmethod
+    def _purgeTombstones():
+        cutoff = datetime.utcnow() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        keys = Tombstone.query(Tombstone.deleted < cutoff).iter(
+            keys_only=True, batch_size=TOMBSTONE_PURGE_BATCH)
+        purged = 0
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == TOMBSTONE_PURGE_BATCH:
+                ndb.delete_multi(batch)
+                purged += len(batch)
+                batch = []
+        ndb.delete_multi(batch)
+        return purged + len(batch)
+
+#################
+# """ BATCH """ #
+##############################################################################
+
+    # Gets, with one get_multi, the entities the sub-calls of a batch
+    # would each get from the datastore by key: the caller's Profile,
+    # recommendations and review stats. The sub-calls then find them in
+    # the context cache. getConference and getConferenceSessions are
+    # served from memcache and need nothing. A malformed key is left
+    # for its own sub-call to report. Returns the keys read
+    def _prefetchBatch(self, calls):
+        keys = []
+        if any(method in BATCH_PROFILE_METHODS for method, _ in calls) \
+                and self._context.user_id:
+            keys.append(ndb.Key(Profile, self._context.user_id))
+        for method, request in calls:
+            try:
+                if method == 'getRecommendedSessions':
+                    keys.append(self._recommendationsKey(self._websafeKey(
+                        request.websafeSessionKey, Session)))
+                elif method == 'getReviewStats' and request.websafeSessionKey:
+                    keys.append(self._sessionStatsKey(self._websafeKey(
+                        request.websafeSessionKey, Session)))
+                elif method == 'getReviewStats' and request.speaker_name:
+                    keys.extend(self._speakerStatsKeys(request.speaker_name))
+            except endpoints.NotFoundException:
+                continue
+        if keys:
+            ndb.get_multi(keys)
+        return keys
+
+    @endpoints.method(BatchForm, BatchResultForms,
+                      path='batch', http_method='POST', name='batch')
+    def batch(self, request):
+        """Run several API calls (reads and getProfile) in one request.
+
+        Each call names a method and passes its request as JSON in
+        params; its response (or error) comes back as JSON in result, in
+        call order. The caller is resolved once for all the calls.
+        """
+        if len(request.calls) > BATCH_MAX_CALLS:
+            raise endpoints.BadRequestException(
+                'A batch takes at most %d calls' % BATCH_MAX_CALLS)
+        remote_methods = self.all_remote_methods()
+        calls = []
+        for call in request.calls:
+            if call.method not in BATCH_METHODS:
+                raise endpoints.BadRequestException(
+                    'Method %s cannot be batched' % call.method)
+            request_type = remote_methods[call.method].remote.request_type
+            try:
+                calls.append((call.method, protojson.decode_message(
+                    request_type, call.params or '{}')))
+            except (messages.Error, ValueError) as error:
+                raise endpoints.BadRequestException(
+                    'Bad params for %s: %s' % (call.method, error))
+
+        # the sub-calls answer their own params only: the batch's
+        # If-None-Match is not theirs to match
+        self._batching = True
+        try:
+            # start the tasklet calls first, so that their queries run
+            # while the prefetch and the other calls wait on their RPCs
+            pending = {}
+            for index, (method, call_request) in enumerate(calls):
+                if method in BATCH_ASYNC_METHODS:
+                    pending[index] = self._runBatchCall(
+                        getattr(self, BATCH_ASYNC_METHODS[method]),
+                        call_request)
+            self._prefetchBatch(calls)
+
+            results = BatchResultForms()
+            for index, (method, call_request) in enumerate(calls):
+                result = BatchResultForm(method=method)
+                outcome = pending.get(index)
+                if outcome is None:
+                    outcome = self._runBatchCall(getattr(self, method),
+                                                 call_request)
+                try:
+                    response = outcome.get_result()
+                    result.status = 200
+                    result.result = protojson.encode_message(response)
+                except endpoints.ServiceException as error:
+                    result.status = error.http_status
+                    result.error = str(error)
+                except Exception:
+                    # one broken call must not fail the calls beside it
+                    logging.exception('Batch call %s failed', method)
+                    result.status = 500
+                    result.error = 'Internal error'
+                results.items.append(result)
+        finally:
+            self._batching = False
+        return results
+
+    # Runs method(request); returns a Future of its response or error.
+    # Tasklet helpers return their own Future; a synchronous method (or
+    # a rate limit charged before any Future exists) is wrapped in one
+    @staticmethod
+    def _runBatchCall(method, request):
+        try:
+            outcome = method(request)
+        except Exception as error:
+            outcome = ndb.Future()
+            outcome.set_exception(error)
+            return outcome
+        if not isinstance(outcome, ndb.Future):
+            response, outcome = outcome, ndb.Future()
+            outcome.set_result(response)
+        return outcome
+
+##################
+# """ WARMUP """ #
+##############################################################################
+
+    @classmethod
+    def _warmCaches(cls, deadline):
+        """Prime the caches a new instance would otherwise fill on its
+        first requests; used by the /_ah/warmup handler.
+
+        Stops as soon as time.time() passes deadline. Returns a dict
+        counting what was primed.
+        """
+        primed = {'announcement': 0, 'conferences': 0, 'schedules': 0}
+
+        # compile the form mappers used by the hot read paths
+        get_mapper(Conference, ConferenceForm, fields=CONFERENCE_FORM_FIELDS,
+                   check_initialized=True)
+        get_mapper(Conference, ConferenceForm, check_initialized=True)
+        get_mapper(Profile, ProfileForm, check_initialized=True)
+        get_mapper(Session, SessionForm)
+        get_mapper(Review, ReviewForm)
+
+        if memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+            get_or_compute(MEMCACHE_ANNOUNCEMENTS_KEY, cls._announcement,
+                           ttl=ANNOUNCEMENT_TTL)
+            primed['announcement'] = 1
+
+        hits = memcache.get(MEMCACHE_HOT_CONFERENCES_KEY) or {}
+        hot = sorted(hits, key=hits.get, reverse=True)[:WARMUP_CONFERENCES]
+        # organiser display names into this instance's LRU in one batch
+        get_display_names(
+            [ndb.Key(urlsafe=wsck).parent().id() for wsck in hot])
+
+        api = cls()
+        for wsck in hot:
+            if time.time() > deadline:
+                break
+            etag = api._conferenceETag(wsck)
+            try:
+                api._conferenceForm(wsck, etag)
+                primed['conferences'] += 1
+                api._conferenceSessionForms(wsck, etag)
+                primed['schedules'] += 1
+            except endpoints.NotFoundException:
+                # deleted since it was counted
+                continue
+        return primed
+
 ########################
 # """ Register API """ #
 ##############################################################################
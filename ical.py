@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""ical.py
+
+iCalendar (RFC 5545) rendering of conference sessions.
+
+render_calendar() is a generator: it walks the sessions it is given
+(typically a lazy query iterator or batched gets) and yields the feed in
+chunks of about CHUNK_SIZE bytes, so a large feed is never built up as
+one string.
+
+"""
+
+from datetime import datetime
+
+CRLF = '\r\n'
+PRODID = '-//Conference Central//Sessions//EN'
+CHUNK_SIZE = 64 * 1024
+MAX_LINE_OCTETS = 75
+
+
+def escape_text(value):
+    """Escape a TEXT property value."""
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n')
+            .replace('\n', '\\n'))
+
+
+def fold(line):
+    """Fold a UTF-8 content line at 75 octets, never inside a character."""
+    if len(line) <= MAX_LINE_OCTETS:
+        return line + CRLF
+    parts = []
+    start, limit = 0, MAX_LINE_OCTETS
+    while len(line) - start > limit:
+        end = start + limit
+        # back off to the first byte of a multi-byte sequence
+        while ord(line[end]) & 0xC0 == 0x80:
+            end -= 1
+        parts.append(line[start:end])
+        # continuation lines start with a space, which counts
+        start, limit = end, MAX_LINE_OCTETS - 1
+    parts.append(line[start:])
+    return (CRLF + ' ').join(parts) + CRLF
+
+
+def _property(name, value, escape=True):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return fold('%s:%s' % (name, escape_text(value) if escape else value))
+
+
+def _format_datetime(value):
+    # floating time: sessions are in the conference's local time
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def _event(session, conference, domain, stamp):
+    lines = [
+        'BEGIN:VEVENT' + CRLF,
+        _property('UID', '%s@%s' % (session.key.urlsafe(), domain)),
+        _property('DTSTAMP', stamp, escape=False),
+    ]
+    start, end = session._dateTimes()
+    if session.startTime:
+        lines.append(_property('DTSTART', _format_datetime(start),
+                               escape=False))
+        if end > start:
+            lines.append(_property('DTEND', _format_datetime(end),
+                                   escape=False))
+    else:
+        lines.append(_property('DTSTART;VALUE=DATE',
+                               session.date.strftime('%Y%m%d'),
+                               escape=False))
+    lines.append(_property('SUMMARY', session.name))
+
+    description = ['Speaker: %s' % session.speakerDisplayName,
+                   'Type: %s' % session.sessionType]
+    if session.highlights:
+        description.append('Highlights: %s' % ', '.join(session.highlights))
+    if conference:
+        description.insert(0, conference.name)
+    lines.append(_property('DESCRIPTION', '\n'.join(description)))
+    if conference and conference.city:
+        lines.append(_property('LOCATION', conference.city))
+    lines.append(_property('CATEGORIES', session.sessionType))
+    lines.append('END:VEVENT' + CRLF)
+    return lines
+
+
+def render_calendar(name, sessions, conferences, domain):
+    """Yield an iCalendar feed of sessions in chunks.
+
+    conferences maps a conference key to its Conference, for the event
+    location and description. Sessions without a date are left out.
+    """
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    buffered = [
+        'BEGIN:VCALENDAR' + CRLF,
+        'VERSION:2.0' + CRLF,
+        _property('PRODID', PRODID, escape=False),
+        'CALSCALE:GREGORIAN' + CRLF,
+        _property('X-WR-CALNAME', name),
+    ]
+    size = sum(len(line) for line in buffered)
+    for session in sessions:
+        if not session.date:
+            continue
+        lines = _event(session, conferences.get(session.key.parent()),
+                       domain, stamp)
+        buffered.extend(lines)
+        size += sum(len(line) for line in lines)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffered)
+            buffered, size = [], 0
+    buffered.append('END:VCALENDAR' + CRLF)
+    yield ''.join(buffered)
@@ -1,9 +1,66 @@
 #!/usr/bin/env python
+import cgi
+import datetime
+import hmac
+import json
+import logging
+import time
+
 import webapp2
+from endpoints import api_config
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from conference import CONFIRMATION_EMAIL_QUEUE
+import ratelimit
+import rpcstats
+from cache import get_version, get_chunks, set_chunks
+from ical import render_calendar
+from models import Conference, Profile, Review, Session, Wishlist
+import migrations
+
+DIGEST_LEASE_SECONDS = 60
+DIGEST_BATCH_SIZE = 100
+DIGEST_RETRY_BASE = 60          # seconds; doubled on every retry
+DIGEST_RETRY_MAX = 6 * 60 * 60
+DIGEST_MAX_RETRIES = 10
+
+# Kinds the bulk export handler will stream
+EXPORT_KINDS = {
+    'Conference': Conference,
+    'Session': Session,
+    'Review': Review,
+    'Profile': Profile,
+}
+EXPORT_BATCH_SIZE = 500
+EXPORT_MAX_BATCH_SIZE = 1000
+# stop well short of the 60s request deadline and hand back a cursor
+EXPORT_TIME_BUDGET = 45
+# Rendered iCalendar feeds, keyed by feed and version stamp
+MEMCACHE_CALENDAR_KEY = 'CALENDAR:%s:%s'
+CALENDAR_CACHE_TTL = 24 * 60 * 60
+CALENDAR_MAX_AGE = 5 * 60       # seconds calendar apps may reuse a feed
+CALENDAR_BATCH_SIZE = 100
+# seconds a new instance may spend priming caches before taking traffic
+WARMUP_TIME_BUDGET = 10
+
 
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime a new instance before it serves user traffic."""
+        deadline = time.time() + WARMUP_TIME_BUDGET
+        # importing this module already loaded the API; building its
+        # config loads the message schemas the SPI handler needs
+        try:
+            api_config.ApiConfigGenerator().pretty_print_config_to_json(
+                ConferenceApi)
+        except Exception:
+            logging.exception('Could not generate the API config')
+        primed = ConferenceApi._warmCaches(deadline)
+        logging.info('Warmup primed %s', primed)
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -22,9 +79,135 @@ class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
 
         C_API._setFeaturedSpeaker(featured_speaker, websafeConferenceKey)
 
+class RebuildReviewStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the review_stats migration, which recomputes session
+        and speaker review aggregates a batch of sessions at a time."""
+        if migrations.start('review_stats'):
+            self.response.write('Started the review_stats migration')
+        else:
+            self.response.write('The review_stats migration is running')
+
+class FlushReviewsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Write reviews buffered in the review ingest pull queue."""
+        written = ConferenceApi._flushReviews()
+        self.response.write('Flushed %d reviews' % written)
+
+def _format_conference(conf):
+    """One conference of a confirmation digest, as plain text."""
+    lines = [conf['name']]
+    for label, field in (('City', 'city'), ('Starts', 'startDate'),
+                         ('Ends', 'endDate'), ('Seats', 'maxAttendees')):
+        if conf.get(field):
+            lines.append('  %s: %s' % (label, conf[field]))
+    if conf.get('topics'):
+        lines.append('  Topics: %s' % ', '.join(conf['topics']))
+    return '\r\n'.join(lines)
+
+
+def _send_digest(email, conferences):
+    if len(conferences) == 1:
+        subject = 'You created a new Conference!'
+    else:
+        subject = 'You created %d new Conferences!' % len(conferences)
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id()),     # from
+        email,                                      # to
+        subject,                                    # subj
+        'Hi, you have created the following '       # body
+        'conference(s):\r\n\r\n%s' % '\r\n\r\n'.join(
+            _format_conference(conf) for conf in conferences)
+    )
+
+
+class SendConfirmationDigestsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send one confirmation digest per organizer from the pull queue.
+
+        Tasks are leased in batches and grouped by recipient. A failed
+        send keeps its tasks, pushing their lease out with exponential
+        backoff; tasks that keep failing are dropped after
+        DIGEST_MAX_RETRIES.
+        """
+        queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        sent = 0
+        while True:
+            tasks = queue.lease_tasks(DIGEST_LEASE_SECONDS, DIGEST_BATCH_SIZE)
+            by_recipient = {}
+            for task in tasks:
+                conf = json.loads(task.payload)
+                recipient = by_recipient.setdefault(conf['email'], ([], []))
+                recipient[0].append(task)
+                recipient[1].append(conf)
+
+            done = []
+            for email, (recipient_tasks, confs) in by_recipient.iteritems():
+                try:
+                    _send_digest(email, confs)
+                    done.extend(recipient_tasks)
+                    sent += 1
+                except Exception:
+                    logging.exception('Confirmation digest to %s failed',
+                                      email)
+                    for task in recipient_tasks:
+                        if task.retry_count >= DIGEST_MAX_RETRIES:
+                            logging.error('Dropping confirmation task %s',
+                                          task.name)
+                            done.append(task)
+                        else:
+                            queue.modify_task_lease(task, min(
+                                DIGEST_RETRY_BASE * 2 ** task.retry_count,
+                                DIGEST_RETRY_MAX))
+            if done:
+                queue.delete_tasks(done)
+            if len(tasks) < DIGEST_BATCH_SIZE:
+                break
+        self.response.write('Sent %d digests' % sent)
+
+class RpcStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Per-endpoint RPC counts and latency histograms as JSON."""
+        names = ['ConferenceApi.%s' % method
+                 for method in sorted(ConferenceApi.all_remote_methods())]
+        # plain (non-regex) handler routes of this app
+        names.extend(route.template for route in app.router.match_routes
+                     if '(' not in route.template)
+        names.extend(rpcstats.GROUPED_PATH_PREFIXES)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(rpcstats.get_stats(names),
+                                       indent=2, sort_keys=True))
+
+class RateLimitsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Calls and limited calls per rate limiter as JSON."""
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(ratelimit.get_stats(),
+                                       indent=2, sort_keys=True))
+
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete delta-sync tombstones past their retention."""
+        purged = ConferenceApi._purgeTombstones()
+        self.response.write('Purged %d tombstones' % purged)
+
+class BuildRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the "also wishlisted" session recommendations."""
+        # imported here so only this cron loads numpy
+        import recommendations
+        result = recommendations.build_recommendations()
+        self.response.write('Stored recommendations for %(stored)d of '
+                            '%(wishlisted)d wishlisted sessions' % result)
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation.
+
+        Only drains push tasks queued before confirmations moved to the
+        digest pull queue.
+        """
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -35,9 +218,257 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class RunMigrationHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one batch of a migration (chained task)."""
+        retries = int(self.request.headers.get(
+            'X-AppEngine-TaskRetryCount', 0))
+        migrations.run_batch(self.request.get('name'),
+                             self.request.get('cursor'), retries)
+
+MIGRATIONS_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<title>Migrations</title>
+<meta http-equiv="refresh" content="10">
+</head>
+<body>
+<h1>Migrations</h1>
+<table border="1" cellpadding="4">
+<tr><th>Migration</th><th>Kind</th><th>State</th><th>Processed</th>
+<th>Written</th><th>Updated</th><th>Error</th><th></th></tr>
+%s
+</table>
+</body>
+</html>
+"""
+
+MIGRATION_ROW = """<tr><td><b>%(name)s</b><br>%(description)s</td>
+<td>%(kind)s</td><td>%(state)s</td><td>%(processed)s</td>
+<td>%(written)s</td><td>%(updated)s</td><td>%(error)s</td>
+<td><form method="post"><input type="hidden" name="name" value="%(name)s">
+<button name="action" value="%(action)s">%(action)s</button></form></td></tr>
+"""
+
+class MigrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Progress of every registered migration, with start/stop."""
+        rows = []
+        for migration, status in migrations.get_migrations():
+            state = status.state if status else migrations.IDLE
+            processed = status.processed if status else 0
+            if state == migrations.RUNNING:
+                total = migrations.kind_count(migration.model)
+                if total:
+                    processed = '%d of ~%d' % (processed, total)
+            rows.append(MIGRATION_ROW % dict((key, cgi.escape(
+                str(value), quote=True)) for key, value in {
+                'name': migration.name,
+                'description': migration.description,
+                'kind': migration.model._get_kind(),
+                'state': state,
+                'processed': processed,
+                'written': status.written if status else 0,
+                'updated': status.updated if status else '',
+                'error': status.error or '' if status else '',
+                'action': ('stop' if state == migrations.RUNNING
+                           else 'start'),
+            }.items()))
+        self.response.write(MIGRATIONS_PAGE % ''.join(rows))
+
+    def post(self):
+        """Start (or resume) or stop a migration."""
+        name = self.request.get('name')
+        try:
+            if self.request.get('action') == 'stop':
+                migrations.stop(name)
+            else:
+                migrations.start(name)
+        except KeyError:
+            self.abort(404, 'Unknown migration: %s' % name)
+        self.redirect(self.request.path)
+
+
+def _cache_as_rendered(cache_key, chunks):
+    """Pass chunks through, then cache them all once the last one is out."""
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    set_chunks(cache_key, rendered, time=CALENDAR_CACHE_TTL)
+
+
+def _sessions_by_key(keys):
+    """Get sessions in batches, skipping deleted ones."""
+    for start in range(0, len(keys), CALENDAR_BATCH_SIZE):
+        for session in ndb.get_multi(keys[start:start + CALENDAR_BATCH_SIZE]):
+            if session:
+                yield session
+
+
+class CalendarHandler(webapp2.RequestHandler):
+    def _key(self, websafe_key, kind):
+        try:
+            key = ndb.Key(urlsafe=websafe_key)
+        except Exception:
+            key = None
+        if key is None or key.kind() != kind:
+            self.abort(404)
+        return key
+
+    def _serve(self, feed, version, render):
+        """Serve a feed from memcache, rendering it (streamed) on a miss.
+
+        feed names the feed; version is the stamp its cache entry and
+        ETag are keyed on. render() returns the chunk iterator, or None
+        if there is no such feed.
+        """
+        etag = '"%s"' % version
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = (
+            'private, max-age=%d' % CALENDAR_MAX_AGE)
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.status = 304
+            return
+
+        cache_key = MEMCACHE_CALENDAR_KEY % (feed, version)
+        chunks = get_chunks(cache_key)
+        if chunks is None:
+            chunks = render()
+            if chunks is None:
+                self.abort(404)
+            chunks = _cache_as_rendered(cache_key, chunks)
+        self.response.content_type = 'text/calendar'
+        self.response.charset = 'utf-8'
+        self.response.app_iter = chunks
+
+class ConferenceCalendarHandler(CalendarHandler):
+    def get(self, websafeConferenceKey):
+        """iCalendar feed of a conference's sessions."""
+        conf_key = self._key(websafeConferenceKey, 'Conference')
+
+        def render():
+            conf = conf_key.get()
+            if not conf:
+                return None
+            sessions = Session.query(ancestor=conf_key).iter(
+                batch_size=CALENDAR_BATCH_SIZE)
+            return render_calendar(
+                conf.name, sessions, {conf_key: conf},
+                app_identity.get_default_version_hostname())
+
+        # the conference version moves with every session write
+        self._serve('conference:%s' % websafeConferenceKey,
+                    get_version('conference:%s' % websafeConferenceKey),
+                    render)
+
+class WishlistCalendarHandler(CalendarHandler):
+    def get(self, websafeProfileKey, token):
+        """iCalendar feed of a user's wishlist, authorized by its token."""
+        profile_key = self._key(websafeProfileKey, 'Profile')
+        profile = profile_key.get()
+        if not (profile and profile.calendarToken and
+                hmac.compare_digest(str(profile.calendarToken), str(token))):
+            self.abort(404)
+
+        def render():
+            wishlist = Wishlist.query(ancestor=profile_key).get()
+            keys = wishlist.sessionKeys if wishlist else []
+            conferences = dict(
+                (conf.key, conf) for conf in ndb.get_multi(
+                    list(set(key.parent() for key in keys))) if conf)
+            return render_calendar(
+                '%s - wishlist' % profile.displayName,
+                _sessions_by_key(keys), conferences,
+                app_identity.get_default_version_hostname())
+
+        # the wishlist version moves whenever a session is added
+        self._serve('wishlist:%s:%s' % (profile_key.id(), token),
+                    get_version('wishlist:%s' % profile_key.id()), render)
+
+
+def _json_default(value):
+    """json.dumps fallback for the property types our models use."""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self, kind):
+        """Stream every entity of a kind as newline-delimited JSON.
+
+        Query parameters:
+          cursor      -- resume from the cursor of a previous response
+          ancestor    -- websafe key; only export its descendants
+          keys_only   -- '1' to export websafe keys only
+          batch_size  -- entities per fetch_page (default 500)
+
+        The final line is {"cursor": ..., "more": ...}; while "more" is
+        true, request the same URL again with that cursor.
+        """
+        model = EXPORT_KINDS.get(kind)
+        if model is None:
+            self.abort(404, 'Unknown kind: %s' % kind)
+
+        ancestor = self.request.get('ancestor')
+        try:
+            ancestor = ndb.Key(urlsafe=ancestor) if ancestor else None
+            cursor = self.request.get('cursor')
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+            batch_size = min(int(self.request.get('batch_size') or
+                                 EXPORT_BATCH_SIZE), EXPORT_MAX_BATCH_SIZE)
+        except Exception:
+            self.abort(400, 'Invalid ancestor, cursor or batch_size')
+        keys_only = self.request.get('keys_only') == '1'
+
+        # key order keeps cursors stable while the export is resumed
+        query = model.query(ancestor=ancestor).order(model.key)
+
+        self.response.content_type = 'application/x-ndjson'
+        # hand the body over as an iterator so each batch is serialized
+        # only when it is written out, never the whole export at once
+        self.response.app_iter = self._stream(
+            query, cursor, batch_size, keys_only)
+
+    def _stream(self, query, cursor, batch_size, keys_only):
+        deadline = time.time() + EXPORT_TIME_BUDGET
+        more = True
+        while more and time.time() < deadline:
+            entities, cursor, more = query.fetch_page(
+                batch_size, start_cursor=cursor, keys_only=keys_only)
+            lines = []
+            for entity in entities:
+                if keys_only:
+                    row = {'key': entity.urlsafe()}
+                else:
+                    row = entity.to_dict()
+                    row['key'] = entity.key.urlsafe()
+                lines.append(json.dumps(row, default=_json_default))
+            if lines:
+                yield '\n'.join(lines) + '\n'
+        yield json.dumps({'cursor': cursor.urlsafe() if more and cursor
+                          else None, 'more': more}) + '\n'
+
 
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/rebuild_review_stats', RebuildReviewStatsHandler),
+    ('/crons/flush_reviews', FlushReviewsHandler),
+    ('/crons/send_confirmation_digests', SendConfirmationDigestsHandler),
+    ('/crons/build_recommendations', BuildRecommendationsHandler),
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/admin/flush_reviews', FlushReviewsHandler),
+    ('/admin/export/(\w+)', ExportHandler),
+    ('/admin/migrations', MigrationsHandler),
+    ('/calendar/conference/([\w-]+)\.ics', ConferenceCalendarHandler),
+    ('/calendar/wishlist/([\w-]+)/(\w+)\.ics', WishlistCalendarHandler),
+    ('/tasks/run_migration', RunMigrationHandler),
+    ('/admin/rpcstats', RpcStatsHandler),
+    ('/admin/ratelimits', RateLimitsHandler),
     ], debug=True)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""mappers.py
+
+Precompiled ndb model -> ProtoRPC form mappers.
+
+The _copy*ToForm helpers used to walk form.all_fields() for every entity,
+probing the entity with hasattr/getattr and picking a conversion by field
+name. A FormMapper makes those decisions once per (model, form, fields)
+and keeps a flat list of (form field name, converter) pairs, so copying a
+row is a single pass over precomputed callables.
+
+"""
+
+from operator import attrgetter
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+# ndb property types rendered as str() in outbound forms
+_STRING_CONVERTED = (ndb.DateProperty, ndb.TimeProperty, ndb.DateTimeProperty)
+# ndb property types copied into nested form messages
+_STRUCTURED = (ndb.StructuredProperty, ndb.LocalStructuredProperty)
+
+_mappers = {}
+
+
+def _websafe_key(entity):
+    return entity.key.urlsafe()
+
+
+def _stringify(getter):
+    return lambda entity: str(getter(entity))
+
+
+def _enum_lookup(getter, enum_type):
+    """Map stored enum names to members, defaulting to the lowest value.
+
+    Every enum in models.py puts its NOT_SPECIFIED / NO_OPINION member
+    first, which is what the old if/elif conversion chains fell back to.
+    """
+    by_name = dict((member.name, member) for member in enum_type)
+    default = min(enum_type, key=lambda member: member.number)
+    return lambda entity: by_name.get(getter(entity), default)
+
+
+def _nested(getter, prop, message_type):
+    """Map a structured property through the mapper of its model."""
+    def convert(entity):
+        mapper = get_mapper(prop._modelclass, message_type)
+        value = getter(entity)
+        if prop._repeated:
+            return mapper.to_forms(value)
+        return mapper.to_form(value) if value is not None else None
+    return convert
+
+
+class FormMapper(object):
+    """FormMapper -- copies model entities into form messages"""
+
+    def __init__(self, model, form, fields=None, check_initialized=False):
+        self.model = model
+        self.form = form
+        self.check_initialized = check_initialized
+        self.steps = []
+
+        properties = model._properties
+        for field in form.all_fields():
+            if fields is not None and field.name not in fields:
+                continue
+            if field.name == 'websafeKey':
+                self.steps.append((field.name, _websafe_key))
+                continue
+            prop = properties.get(field.name)
+            if prop is None:
+                # form-only field (e.g. organizerDisplayName)
+                continue
+            getter = attrgetter(field.name)
+            if isinstance(field, messages.EnumField):
+                converter = _enum_lookup(getter, field.type)
+            elif isinstance(prop, _STRUCTURED):
+                converter = _nested(getter, prop, field.type)
+            elif isinstance(prop, _STRING_CONVERTED):
+                converter = _stringify(getter)
+            else:
+                converter = getter
+            self.steps.append((field.name, converter))
+
+    def to_form(self, entity, **extra):
+        """Return a form for entity; extra sets additional form fields."""
+        values = dict((name, convert(entity))
+                      for name, convert in self.steps)
+        values.update(extra)
+        form = self.form(**values)
+        if self.check_initialized:
+            form.check_initialized()
+        return form
+
+    def to_forms(self, entities):
+        """Return a list of forms, one per entity."""
+        return [self.to_form(entity) for entity in entities]
+
+
+def get_mapper(model, form, fields=None, check_initialized=False):
+    """Return the FormMapper for (model, form, fields), compiling it once."""
+    if fields is not None:
+        fields = frozenset(fields)
+    cache_key = (model, form, fields, check_initialized)
+    mapper = _mappers.get(cache_key)
+    if mapper is None:
+        mapper = _mappers[cache_key] = FormMapper(
+            model, form, fields, check_initialized)
+    return mapper
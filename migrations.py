@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Cursor-driven batched data migrations.
+
+A migration is a mapper function registered for a kind with @migration.
+Running it walks the kind's keys in key order with fetch_page and, for
+every key, re-gets the entity, hands it to the mapper and put_multi()s
+the entities the mapper returns, all in one transaction on the entity's
+group: a write committed since the page was read (a registration, a
+session summary update) is seen by the mapper, never overwritten. Each
+batch is one push task. The task for the next batch is enqueued in the
+same transaction that checkpoints the cursor in the migration's
+MigrationStatus, so:
+
+  * a failed batch is retried by the task queue from its checkpoint,
+  * a duplicate task finds the checkpoint moved on and exits,
+  * a stopped (or failed) migration resumes where it left off.
+
+Batches are spaced out so a migration writes at most write_budget
+entities per second. Mappers must be idempotent: a batch can be applied
+twice if a task dies between its writes and its checkpoint. A mapper
+registered with transactional=False is handed the whole page outside
+any transaction and does its own (transactional) writes, returning the
+number of entities it wrote.
+
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import stats
+
+from conference import ConferenceApi
+from models import Conference, MigrationStatus, Profile, Review, Session
+from models import Wishlist, MAX_SESSION_MINUTES
+
+MIGRATION_TASK_URL = '/tasks/run_migration'
+MIGRATION_BATCH_SIZE = 100
+MIGRATION_WRITE_BUDGET = 50     # entities written per second
+MIGRATION_MAX_RETRIES = 5       # task retries of one batch before failing
+
+IDLE, RUNNING, STOPPED, FAILED, DONE = (
+    'idle', 'running', 'stopped', 'failed', 'done')
+
+_migrations = OrderedDict()
+
+
+class Migration(object):
+    """Migration -- a registered mapper over every entity of a kind"""
+
+    def __init__(self, name, model, mapper, batch_size, write_budget,
+                 transactional):
+        self.name = name
+        self.model = model
+        self.mapper = mapper
+        self.batch_size = batch_size
+        self.write_budget = write_budget
+        self.transactional = transactional
+        self.description = (mapper.__doc__ or '').strip()
+
+
+def migration(model, name=None, batch_size=MIGRATION_BATCH_SIZE,
+              write_budget=MIGRATION_WRITE_BUDGET, transactional=True):
+    """Register mapper(entities) -> entities to put as a migration.
+
+    By default the mapper gets one entity at a time, inside a
+    transaction; with transactional=False it gets the whole page and
+    returns the number of entities it wrote itself.
+    """
+    def register(mapper):
+        key = name or mapper.__name__
+        _migrations[key] = Migration(key, model, mapper, batch_size,
+                                     write_budget, transactional)
+        return mapper
+    return register
+
+
+def get_migrations():
+    """Return [(Migration, MigrationStatus or None)] in registration order."""
+    statuses = ndb.get_multi([ndb.Key(MigrationStatus, name)
+                              for name in _migrations])
+    return zip(_migrations.values(), statuses)
+
+
+def kind_count(model):
+    """Approximate entity count from the datastore statistics, or None."""
+    stat = stats.KindStat.query(
+        stats.KindStat.kind_name == model._get_kind()).get()
+    return stat.count if stat else None
+
+
+def _enqueue(name, cursor, countdown=0):
+    taskqueue.add(url=MIGRATION_TASK_URL, countdown=countdown,
+                  params={'name': name, 'cursor': cursor or ''},
+                  transactional=ndb.in_transaction())
+
+
+@ndb.transactional
+def start(name):
+    """Start a migration, or resume it from its checkpoint.
+
+    A finished migration is run again from the beginning. Returns False
+    if it is already running.
+    """
+    if name not in _migrations:
+        raise KeyError(name)
+    status = MigrationStatus.get_by_id(name) or MigrationStatus(id=name)
+    if status.state == RUNNING:
+        return False
+    if status.state in (IDLE, DONE):
+        status.populate(cursor=None, processed=0, written=0, batches=0,
+                        started=datetime.utcnow(), finished=None)
+    status.state = RUNNING
+    status.error = None
+    status.put()
+    _enqueue(name, status.cursor)
+    return True
+
+
+@ndb.transactional
+def stop(name):
+    """Stop a running migration after its current batch."""
+    status = MigrationStatus.get_by_id(name)
+    if status and status.state == RUNNING:
+        status.state = STOPPED
+        status.put()
+
+
+@ndb.transactional
+def _fail(name, cursor, error, give_up):
+    status = MigrationStatus.get_by_id(name)
+    if status and status.state == RUNNING and status.cursor == cursor:
+        status.error = error
+        if give_up:
+            status.state = FAILED
+        status.put()
+
+
+@ndb.transactional
+def _checkpoint(name, cursor, next_cursor, processed, written, countdown):
+    status = MigrationStatus.get_by_id(name)
+    if not status or status.cursor != cursor:
+        return
+    status.cursor = next_cursor
+    status.processed += processed
+    status.written += written
+    status.batches += 1
+    status.error = None
+    if next_cursor is None:
+        status.state = DONE
+        status.finished = datetime.utcnow()
+    elif status.state == RUNNING:
+        _enqueue(name, next_cursor, countdown)
+    status.put()
+
+
+@ndb.transactional
+def _map_entity(mapper, key):
+    """Apply mapper to the current version of key's entity and write
+    what it returns, atomically. Returns the number of entities written."""
+    entity = key.get()
+    if entity is None:
+        return 0
+    changed = mapper([entity]) or []
+    if isinstance(changed, (int, long)):
+        return changed
+    ndb.put_multi(changed)
+    return len(changed)
+
+
+def run_batch(name, cursor, retries=0):
+    """Migrate one batch starting at cursor; called by the task handler."""
+    cursor = cursor or None
+    status = MigrationStatus.get_by_id(name)
+    if (name not in _migrations or not status or
+            status.state != RUNNING or status.cursor != cursor):
+        logging.info('Dropping stale task of migration %s', name)
+        return
+    if retries > MIGRATION_MAX_RETRIES:
+        _fail(name, cursor, status.error or 'Too many retries', True)
+        return
+
+    migration = _migrations[name]
+    started = time.time()
+    try:
+        entities, next_cursor, more = migration.model.query().order(
+            migration.model.key).fetch_page(
+                migration.batch_size, keys_only=migration.transactional,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        if migration.transactional:
+            written = sum(_map_entity(migration.mapper, key)
+                          for key in entities)
+        else:
+            written = migration.mapper(entities)
+    except Exception as error:
+        _fail(name, cursor, '%s: %s' % (type(error).__name__, error), False)
+        raise
+
+    # stay under the write budget, counting the time this batch took
+    countdown = max(0, written / float(migration.write_budget) -
+                    (time.time() - started))
+    _checkpoint(name, cursor,
+                next_cursor.urlsafe() if more and next_cursor else None,
+                len(entities), written, countdown)
+
+
+#################################
+# """ REGISTERED MIGRATIONS """ #
+##############################################################################
+
+@migration(Review)
+def review_ratings(reviews):
+    """Fill Review.rating (ReviewEnum number) for reviews stored before
+    ratings were kept as integers."""
+    changed = []
+    for review in reviews:
+        if review.rating is None:
+            review.rating = ConferenceApi._reviewRating(review.review)
+            changed.append(review)
+    return changed
+
+
+@migration(Session, batch_size=20, transactional=False)
+def review_stats(sessions):
+    """Rebuild every session's ReviewStats from its Reviews, one
+    transaction per session, correcting the speaker aggregates."""
+    return sum(ConferenceApi._rebuildSessionReviewStats(
+        session.key, session.speakerDisplayName) for session in sessions)
+
+
+@migration(Session)
+def session_datetimes(sessions):
+    """Fill (and index) Session.startDateTime and endDateTime, which
+    Session._pre_put_hook computes on every put."""
+    changed = []
+    for session in sessions:
+        if (session.startDateTime, session.endDateTime) != \
+                session._dateTimes():
+            changed.append(session)
+        if (session.duration or 0) > MAX_SESSION_MINUTES:
+            logging.warning('Session %s runs longer than %d minutes; time '
+                            'window queries can miss it', session.key,
+                            MAX_SESSION_MINUTES)
+    return changed
+
+
+@migration(Profile)
+def profile_conference_keys(profiles):
+    """Copy Profile.conferenceKeysToAttend (websafe strings) into
+    Profile.conferenceKeys."""
+    changed = []
+    for profile in profiles:
+        keys = [ndb.Key(urlsafe=wsck)
+                for wsck in profile.conferenceKeysToAttend]
+        if profile.conferenceKeys != keys:
+            profile.conferenceKeys = keys
+            changed.append(profile)
+    return changed
+
+
+@migration(Profile)
+def missing_wishlists(profiles):
+    """Create the Wishlist of profiles that never saved their profile."""
+    lookups = [Wishlist.query(ancestor=profile.key).get_async(
+        keys_only=True) for profile in profiles]
+    return [Wishlist(parent=profile.key, userId=profile.mainEmail or '')
+            for profile, lookup in zip(profiles, lookups)
+            if lookup.get_result() is None]
+
+
+@migration(Conference, batch_size=20, transactional=False)
+def conference_session_summaries(conferences):
+    """Rebuild Conference.sessionSummary from each conference's
+    sessions."""
+    for conf in conferences:
+        ConferenceApi._rebuildSessionSummary(conf.key)
+    return len(conferences)
+
+
+@migration(Conference, name='conference_updated')
+@migration(Session, name='session_updated')
+def sync_timestamps(entities):
+    """Stamp updated (auto_now) on entities stored before delta sync;
+    sync queries, which order by it, cannot see them until then."""
+    return [entity for entity in entities if entity.updated is None]
+
+
+def _reindex(entities):
+    """Re-put every entity, rewriting its index rows to match the
+    model's current indexed= settings."""
+    return entities
+
+
+for _model in (Conference, Session, Review, Profile, Wishlist):
+    migration(_model, name='reindex_%s' % _model._get_kind())(_reindex)
@@ -13,22 +13,55 @@ created/forked from conferences.py by wesc on 2014 may 24
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import httplib
+from datetime import datetime, timedelta
+
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
 
+# Longest session accepted; time-window queries look back this far
+MAX_SESSION_MINUTES = 8 * 60
+
+
+def _write_tombstone(key, future):
+    """_post_delete_hook of synced kinds: record the deletion for the
+    delta-sync endpoints once the delete has succeeded."""
+    if future.get_exception() is not None:
+        return
+    tombstone = Tombstone(id=key.urlsafe(), kind=key.kind(),
+                          parentKey=key.parent())
+    if ndb.in_transaction():
+        # a root entity, outside the deleted entity's group
+        ndb.get_context().call_on_commit(tombstone.put)
+    else:
+        tombstone.put()
+
+
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 403 response"""
+    # Endpoints turns a 429 into a 404; clients tell this 403 apart from
+    # an authorization failure by RATE_LIMITED_MESSAGE
+    http_status = httplib.FORBIDDEN
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    mainEmail = ndb.StringProperty(indexed=False)
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True, indexed=False)
+    # same conferences as keys; dual-written until the profile_conference_keys
+    # migration has run, after which reads can switch over
+    conferenceKeys = ndb.KeyProperty(kind='Conference', repeated=True,
+                                     indexed=False)
+    # secret in the wishlist calendar feed URL (calendar apps can't OAuth)
+    calendarToken = ndb.StringProperty(indexed=False)
 
 
 class ProfileMiniForm(messages.Message):
@@ -47,8 +80,9 @@ class ProfileForm(messages.Message):
 
 # Child of Profile
 class Wishlist(ndb.Model):
-    userId = ndb.StringProperty(required=True)
-    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True)
+    userId = ndb.StringProperty(required=True, indexed=False)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True,
+                                  indexed=False)
 
 
 class WishlistForm(messages.Message):
@@ -67,18 +101,56 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
+class SessionTypeCount(ndb.Model):
+    sessionType         = ndb.StringProperty()
+    count               = ndb.IntegerProperty(default=0)
+
+
+# Denormalized view of a conference's sessions, kept on the Conference
+class SessionSummary(ndb.Model):
+    """SessionSummary -- session count, speakers, types and time span"""
+    count               = ndb.IntegerProperty(default=0)
+    speakers            = ndb.StringProperty(repeated=True)
+    types               = ndb.StructuredProperty(SessionTypeCount,
+                                                 repeated=True)
+    firstStart          = ndb.DateTimeProperty()
+    lastStart           = ndb.DateTimeProperty()
+
+
+# Only queried properties are indexed; tools/index_advisor.py lists them
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
-    description     = ndb.StringProperty()
-    organizerUserId = ndb.StringProperty()
+    description     = ndb.StringProperty(indexed=False)
+    organizerUserId = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
-    startDate       = ndb.DateProperty()
+    startDate       = ndb.DateProperty(indexed=False)
     month           = ndb.IntegerProperty()
-    endDate         = ndb.DateProperty()
+    endDate         = ndb.DateProperty(indexed=False)
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    sessionSummary  = ndb.LocalStructuredProperty(SessionSummary)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        _write_tombstone(key, future)
+
+
+class SessionTypeCountForm(messages.Message):
+    sessionType         = messages.EnumField('SessionTypeEnum', 1)
+    count               = messages.IntegerField(2)
+
+
+class SessionSummaryForm(messages.Message):
+    """SessionSummaryForm -- conference session summary outbound message"""
+    count               = messages.IntegerField(1)
+    speakers            = messages.StringField(2, repeated=True)
+    types               = messages.MessageField(SessionTypeCountForm, 3,
+                                                repeated=True)
+    firstStart          = messages.StringField(4)
+    lastStart           = messages.StringField(5)
 
 
 class ConferenceForm(messages.Message):
@@ -95,6 +167,9 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    sessionSummary  = messages.MessageField(SessionSummaryForm, 14)
+    notModified     = messages.BooleanField(15)
 
 
 class ConferenceForms(messages.Message):
@@ -105,12 +180,30 @@ class ConferenceForms(messages.Message):
 # Child of Conference
 class Session(ndb.Model):
     name                = ndb.StringProperty(required=True)
-    highlights          = ndb.StringProperty(repeated=True)
+    highlights          = ndb.StringProperty(repeated=True, indexed=False)
     speakerDisplayName  = ndb.StringProperty(required=True)
-    duration            = ndb.IntegerProperty()
+    duration            = ndb.IntegerProperty(indexed=False)
     sessionType         = ndb.StringProperty(default='NOT_SPECIFIED', required=True)
-    date                = ndb.DateProperty()
+    date                = ndb.DateProperty(indexed=False)
     startTime           = ndb.TimeProperty()
+    # computed from date, startTime and duration on every put
+    startDateTime       = ndb.DateTimeProperty()
+    endDateTime         = ndb.DateTimeProperty(indexed=False)
+    updated             = ndb.DateTimeProperty(auto_now=True)
+
+    def _dateTimes(self):
+        """(startDateTime, endDateTime) for the current field values."""
+        if not (self.date and self.startTime):
+            return None, None
+        start = datetime.combine(self.date, self.startTime)
+        return start, start + timedelta(minutes=self.duration or 0)
+
+    def _pre_put_hook(self):
+        self.startDateTime, self.endDateTime = self._dateTimes()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        _write_tombstone(key, future)
 
 
 class SessionForm(messages.Message):
@@ -121,20 +214,64 @@ class SessionForm(messages.Message):
     sessionType         = messages.EnumField('SessionTypeEnum', 5)
     date                = messages.StringField(6)
     startTime           = messages.StringField(7)
-    # websafeKey          = messages.StringField(8)
+    websafeKey          = messages.StringField(8)
 
 
 class SessionForms(messages.Message):
     """SessionForms -- multiple Conference outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    nextCursor = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+
+
+# Child of Session, id 'top'; rebuilt from all wishlists by
+# /crons/build_recommendations (recommendations.py)
+class SessionRecommendations(ndb.Model):
+    """SessionRecommendations -- sessions most often wishlisted together
+    with the parent session, best first"""
+    sessionKeys         = ndb.KeyProperty(kind='Session', repeated=True,
+                                          indexed=False)
+    names               = ndb.StringProperty(repeated=True, indexed=False)
+    scores              = ndb.FloatProperty(repeated=True, indexed=False)
+    updated             = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class RecommendedSessionForm(messages.Message):
+    websafeSessionKey   = messages.StringField(1)
+    name                = messages.StringField(2)
+    score               = messages.FloatField(3)
+
+
+class RecommendedSessionForms(messages.Message):
+    """RecommendedSessionForms -- "also wishlisted" outbound form message"""
+    items = messages.MessageField(RecommendedSessionForm, 1, repeated=True)
+
+
+class SessionTimeWindowForm(messages.Message):
+    """SessionTimeWindowForm -- sessions running in [windowStart, windowEnd)
+
+    Times are 'YYYY-MM-DD HH:MM' (or with a 'T' separator).
+    """
+    windowStart         = messages.StringField(1, required=True)
+    windowEnd           = messages.StringField(2, required=True)
+    pageSize            = messages.IntegerField(3)
+    cursor              = messages.StringField(4)
 
 
 # Child of Session
 class Review(ndb.Model):
-    conference_name     = ndb.StringProperty()
-    session_name        = ndb.StringProperty()
-    speaker_name        = ndb.StringProperty()
-    review              = ndb.StringProperty()
+    conference_name     = ndb.StringProperty(indexed=False)
+    session_name        = ndb.StringProperty(indexed=False)
+    speaker_name        = ndb.StringProperty(indexed=False)
+    review              = ndb.StringProperty(indexed=False)
+    rating              = ndb.IntegerProperty()  # ReviewEnum number
+    # reviews stored before delta sync get it (indexed) from reindex_Review
+    updated             = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        _write_tombstone(key, future)
 
 
 class ReviewForm(messages.Message):
@@ -142,15 +279,111 @@ class ReviewForm(messages.Message):
     session_name        = messages.StringField(2, required=True)
     speaker_name        = messages.StringField(3)
     review              = messages.EnumField('ReviewEnum', 4, required=True)
+    websafeKey          = messages.StringField(5)
 
 
 class ReviewForms(messages.Message):
     """ReviewForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ReviewForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
 
 
 class ReviewQueryForm(messages.Message):
     session_name        = messages.StringField(1)
+    websafeSessionKey   = messages.StringField(2)
+    pageSize            = messages.IntegerField(3)
+    cursor              = messages.StringField(4)
+    orderByRating       = messages.BooleanField(5)
+
+
+# Running aggregate of Reviews. Per session: child of Session, id 'session'.
+# Per speaker: root entity sharded over ids 'speaker:<name>:<shard>'.
+class ReviewStats(ndb.Model):
+    """ReviewStats -- review count, star sum and per-ReviewEnum histogram"""
+    count               = ndb.IntegerProperty(default=0, indexed=False)
+    total               = ndb.IntegerProperty(default=0, indexed=False)
+    histogram           = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+# Progress of a migrations.py migration, keyed by migration name
+class MigrationStatus(ndb.Model):
+    """MigrationStatus -- checkpoint of a batched data migration"""
+    state               = ndb.StringProperty(default='idle', indexed=False)
+    cursor              = ndb.StringProperty(indexed=False)
+    processed           = ndb.IntegerProperty(default=0, indexed=False)
+    written             = ndb.IntegerProperty(default=0, indexed=False)
+    batches             = ndb.IntegerProperty(default=0, indexed=False)
+    started             = ndb.DateTimeProperty(indexed=False)
+    finished            = ndb.DateTimeProperty(indexed=False)
+    updated             = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    error               = ndb.TextProperty()
+
+
+# Deleted Conference, Session or Review, keyed by its websafe key; written
+# by their _post_delete_hook and purged by /crons/purge_tombstones
+class Tombstone(ndb.Model):
+    """Tombstone -- deletion record for the delta-sync endpoints"""
+    kind                = ndb.StringProperty()
+    parentKey           = ndb.KeyProperty()
+    deleted             = ndb.DateTimeProperty(auto_now=True)
+
+
+class ChangesQueryForm(messages.Message):
+    """ChangesQueryForm -- delta-sync request; since is the watermark
+    of the previous sync (empty for a full sync)"""
+    since               = messages.StringField(1)
+    cursor              = messages.StringField(2)
+    pageSize            = messages.IntegerField(3)
+    websafeConferenceKey = messages.StringField(4)
+    websafeSessionKey   = messages.StringField(5)
+
+
+class ConferenceChangesForm(messages.Message):
+    """ConferenceChangesForm -- conferences changed and deleted since a
+    watermark"""
+    items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    deleted = messages.StringField(2, repeated=True)
+    nextCursor = messages.StringField(3)
+    watermark = messages.StringField(4)
+    fullSync = messages.BooleanField(5)
+
+
+class SessionChangesForm(messages.Message):
+    """SessionChangesForm -- sessions changed and deleted since a
+    watermark"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    deleted = messages.StringField(2, repeated=True)
+    nextCursor = messages.StringField(3)
+    watermark = messages.StringField(4)
+    fullSync = messages.BooleanField(5)
+
+
+class ReviewChangesForm(messages.Message):
+    """ReviewChangesForm -- reviews changed and deleted since a
+    watermark"""
+    items = messages.MessageField(ReviewForm, 1, repeated=True)
+    deleted = messages.StringField(2, repeated=True)
+    nextCursor = messages.StringField(3)
+    watermark = messages.StringField(4)
+    fullSync = messages.BooleanField(5)
+
+
+class ReviewCountForm(messages.Message):
+    review              = messages.EnumField('ReviewEnum', 1)
+    count               = messages.IntegerField(2)
+
+
+class ReviewStatsForm(messages.Message):
+    """ReviewStatsForm -- aggregated reviews outbound form message"""
+    count               = messages.IntegerField(1)
+    average             = messages.FloatField(2)
+    histogram           = messages.MessageField(ReviewCountForm, 3,
+                                                repeated=True)
+
+
+class ReviewStatsQueryForm(messages.Message):
+    websafeSessionKey   = messages.StringField(1)
+    speaker_name        = messages.StringField(2)
 
 
 class TeeShirtSize(messages.Enum):
@@ -204,11 +437,38 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms --
     multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    includeSummary = messages.BooleanField(2)
 
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+
+class BatchCallForm(messages.Message):
+    """BatchCallForm -- one sub-call of a batch; params and result are
+    the JSON the method takes and returns on its own"""
+    method              = messages.StringField(1, required=True)
+    params              = messages.StringField(2)
+
+
+class BatchForm(messages.Message):
+    """BatchForm -- inbound batch of sub-calls"""
+    calls = messages.MessageField(BatchCallForm, 1, repeated=True)
+
+
+class BatchResultForm(messages.Message):
+    method              = messages.StringField(1)
+    status              = messages.IntegerField(2)
+    result              = messages.StringField(3)
+    error               = messages.StringField(4)
+
+
+class BatchResultForms(messages.Message):
+    """BatchResultForms -- results of a batch, in call order"""
+    items = messages.MessageField(BatchResultForm, 1, repeated=True)
 
 
 class SessionQueryForm(messages.Message):
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Per-caller token-bucket rate limiting of ConferenceApi methods.
+
+Methods share a named limiter (e.g. every conference query counts against
+'query'); @rate_limited(name) charges one token per call to the caller's
+bucket, keyed by user id, or by client address for anonymous calls.
+
+A bucket holds `burst` tokens and refills at `rate` per second. It lives
+in memcache as counters of the tokens taken in fixed windows of
+burst / rate seconds (the time to refill an empty bucket). An add_multi
+creates the current and previous windows' counters, expiring two windows
+later, and one offset_multi per call increments the current counter and
+reads the previous one; the tokens taken during the last burst / rate
+seconds are estimated as
+
+    used(current) + used(previous) * (1 - elapsed(current) / window)
+
+and the call is allowed while that stays within burst: a caller can
+spend the whole bucket at once and then `rate` calls a second. A refused
+call takes no token and gives its increment back. Over-limit calls
+raise TooManyRequestsException: an HTTP 403 with RATE_LIMITED_MESSAGE,
+since Endpoints would turn a 429 into a 404.
+
+RATE_LIMIT_MODE 'log' only logs callers that would be limited; 'off'
+skips limiting altogether. Calls and limited calls per limiter are
+counted in memcache for the /admin/ratelimits page. If memcache is
+unavailable, calls are let through.
+
+"""
+
+import functools
+import logging
+import os
+import time
+from collections import namedtuple
+
+from google.appengine.api import memcache
+
+from models import TooManyRequestsException
+
+# 'off', 'log' or 'enforce'; overridable with an app.yaml env_variables
+# entry
+RATE_LIMIT_MODE = os.environ.get('RATE_LIMIT_MODE', 'enforce')
+MEMCACHE_RATE_LIMIT_PREFIX = 'RATELIMIT:'
+RATE_LIMITED_MESSAGE = 'Rate limit exceeded; retry in a few seconds'
+
+RateLimit = namedtuple('RateLimit', ['burst', 'rate'])
+
+# limiter name -> bucket size and refill rate (tokens per second)
+RATE_LIMITS = {
+    'query': RateLimit(burst=30, rate=1.0),
+    'wishlist': RateLimit(burst=20, rate=0.5),
+}
+
+
+def _caller(api):
+    user_id = api._context.user_id
+    if user_id:
+        return 'user:%s' % user_id
+    request_state = getattr(api, 'request_state', None)
+    address = (getattr(request_state, 'remote_address', None) or
+               os.environ.get('REMOTE_ADDR', 'unknown'))
+    return 'ip:%s' % address
+
+
+def check(name, caller, now=None):
+    """Take a token from caller's bucket of limiter name.
+
+    Returns True if the call may go ahead.
+    """
+    limit = RATE_LIMITS[name]
+    window_seconds = float(limit.burst) / limit.rate
+    now = time.time() if now is None else now
+    window = int(now // window_seconds)
+    current = '%s:%s:%d' % (name, caller, window)
+    previous = '%s:%s:%d' % (name, caller, window - 1)
+    calls = '%s:calls' % name
+
+    # window counters go away on their own once no longer read; add
+    # leaves existing ones (and their expiry) alone
+    memcache.add_multi({current: 0, previous: 0},
+                       time=int(2 * window_seconds) + 1,
+                       key_prefix=MEMCACHE_RATE_LIMIT_PREFIX)
+    counts = memcache.offset_multi(
+        {current: 1, previous: 0, calls: 1},
+        key_prefix=MEMCACHE_RATE_LIMIT_PREFIX, initial_value=0)
+    used = counts.get(current)
+    if used is None:
+        return True
+
+    # the previous window's share of the last window_seconds
+    overlap = 1 - (now - window * window_seconds) / window_seconds
+    if used + (counts.get(previous) or 0) * overlap <= limit.burst:
+        return True
+    memcache.offset_multi({current: -1, '%s:limited' % name: 1},
+                          key_prefix=MEMCACHE_RATE_LIMIT_PREFIX,
+                          initial_value=0)
+    return False
+
+
+def rate_limited(name):
+    """Decorate a ConferenceApi method to charge limiter name per call.
+
+    Goes below @endpoints.method, so that it wraps the method itself, or
+    on the (tasklet) helper behind it that batch() calls as well; a
+    limited call raises before any future is returned.
+    """
+    if name not in RATE_LIMITS:
+        raise KeyError(name)
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(api, request):
+            if RATE_LIMIT_MODE != 'off':
+                caller = _caller(api)
+                if not check(name, caller):
+                    logging.warning('Rate limit %s exceeded by %s',
+                                    name, caller)
+                    if RATE_LIMIT_MODE == 'enforce':
+                        raise TooManyRequestsException(
+                            RATE_LIMITED_MESSAGE)
+            return method(api, request)
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    """Return {limiter: {'calls', 'limited', burst, rate}} for monitoring."""
+    keys = ['%s:%s' % (name, counter)
+            for name in RATE_LIMITS for counter in ('calls', 'limited')]
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_RATE_LIMIT_PREFIX)
+    stats = {}
+    for name, limit in RATE_LIMITS.iteritems():
+        stats[name] = {
+            'calls': int(values.get('%s:calls' % name, 0)),
+            'limited': int(values.get('%s:limited' % name, 0)),
+            'burst': limit.burst,
+            'rate': limit.rate,
+        }
+    return stats
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""recommendations.py
+
+"People who wishlisted this session also wishlisted..." built offline.
+
+build_recommendations() runs from cron. It scans every Wishlist once and
+builds the sparse session co-occurrence matrix with numpy: every ordered
+pair of sessions sharing a wishlist becomes one int64 code
+(row * sessions + column), and np.unique plus bincount over the codes
+counts them. Each pair is scored by cosine similarity,
+
+    together(a, b) / sqrt(wishlists(a) * wishlists(b))
+
+so that sessions on every wishlist do not crowd out everything else. The
+top RECOMMENDATIONS_TOP_K neighbours of each session are stored in one
+SessionRecommendations entity under it. getRecommendedSessions then
+serves them with a single key get.
+
+main.py imports this module only in the cron handler, so the instances
+serving the API, which only read the stored entities, never load numpy.
+
+"""
+
+import logging
+
+import numpy as np
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import SessionRecommendations, Wishlist
+
+RECOMMENDATIONS_TOP_K = 10
+# pairs seen on fewer wishlists than this are noise, not a signal
+RECOMMENDATIONS_MIN_SUPPORT = 2
+# the newest sessions of very long wishlists only; pairs grow as n ** 2
+RECOMMENDATIONS_MAX_WISHLIST = 100
+RECOMMENDATIONS_SCAN_BATCH = 500
+RECOMMENDATIONS_PUT_BATCH = 500
+
+
+def _scan_wishlists():
+    """Return (session keys, owners, items) over every wishlist.
+
+    items holds the column of every wishlisted session and owners the row
+    of the wishlist it is on, grouped by wishlist. Wishlists with fewer
+    than two sessions cannot contribute a pair and are left out.
+    """
+    columns = {}
+    owners, items = [], []
+    cursor, more, rows = None, True, 0
+    while more:
+        wishlists, cursor, more = Wishlist.query().fetch_page(
+            RECOMMENDATIONS_SCAN_BATCH, start_cursor=cursor)
+        for wishlist in wishlists:
+            keys = []
+            for key in reversed(wishlist.sessionKeys):
+                if key not in keys:
+                    keys.append(key)
+            keys = keys[:RECOMMENDATIONS_MAX_WISHLIST]
+            if len(keys) < 2:
+                continue
+            items.extend(columns.setdefault(key, len(columns))
+                         for key in keys)
+            owners.extend([rows] * len(keys))
+            rows += 1
+        more = more and cursor is not None
+    session_keys = [None] * len(columns)
+    for key, column in columns.iteritems():
+        session_keys[column] = key
+    return session_keys, owners, items
+
+
+def cooccurrence(owners, items, sessions):
+    """Return (rows, columns, counts) of the co-occurrence matrix.
+
+    owners and items are int arrays grouped by owner; see _scan_wishlists.
+    The diagonal is left out.
+    """
+    lengths = np.bincount(owners)
+    starts = np.cumsum(lengths) - lengths
+    # pair every item with each item of its wishlist, itself included
+    reps = lengths[owners]
+    firsts = np.repeat(items, reps)
+    offsets = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+    seconds = items[np.repeat(starts[owners], reps) + offsets]
+    keep = firsts != seconds
+    codes = firsts[keep].astype(np.int64) * sessions + seconds[keep]
+
+    codes, inverse = np.unique(codes, return_inverse=True)
+    counts = np.bincount(inverse)
+    return codes // sessions, codes % sessions, counts
+
+
+def top_neighbours(rows, columns, counts, popularity, k, min_support):
+    """Return [(row, columns, scores)] of the k best neighbours per row."""
+    keep = counts >= min_support
+    rows, columns, counts = rows[keep], columns[keep], counts[keep]
+    scores = counts / np.sqrt(
+        popularity[rows].astype(np.float64) * popularity[columns])
+
+    # by row, then best score first; ties go to the more frequent pair
+    order = np.lexsort((-counts, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    top = ranks < k
+    rows, columns, scores = rows[top], columns[top], scores[top]
+
+    bounds = np.flatnonzero(np.diff(rows)) + 1
+    return [(int(group_rows[0]), group_columns.tolist(), group_scores.tolist())
+            for group_rows, group_columns, group_scores in zip(
+                np.split(rows, bounds), np.split(columns, bounds),
+                np.split(scores, bounds))
+            if len(group_rows)]
+
+
+def build_recommendations(k=RECOMMENDATIONS_TOP_K,
+                          min_support=RECOMMENDATIONS_MIN_SUPPORT):
+    """Rebuild every session's SessionRecommendations from the wishlists.
+
+    Sessions that no longer have neighbours lose their stale entity.
+    Returns a dict of counts for the log.
+    """
+    session_keys, owners, items = _scan_wishlists()
+    built = []
+    if items:
+        owners = np.array(owners, dtype=np.int64)
+        items = np.array(items, dtype=np.int64)
+        popularity = np.bincount(items, minlength=len(session_keys))
+        rows, columns, counts = cooccurrence(owners, items,
+                                             len(session_keys))
+        built = top_neighbours(rows, columns, counts, popularity, k,
+                               min_support)
+
+    # names of the neighbours; deleted sessions drop out on both sides
+    wanted = sorted(set(row for row, _, _ in built) |
+                    set(column for _, cols, _ in built for column in cols))
+    sessions = dict(zip(wanted, ndb.get_multi(
+        [session_keys[column] for column in wanted])))
+
+    entities = []
+    for row, cols, scores in built:
+        if not sessions[row]:
+            continue
+        neighbours = [(sessions[column], score)
+                      for column, score in zip(cols, scores)
+                      if sessions[column]]
+        if not neighbours:
+            continue
+        entities.append(SessionRecommendations(
+            key=ConferenceApi._recommendationsKey(session_keys[row]),
+            sessionKeys=[session.key for session, _ in neighbours],
+            names=[session.name for session, _ in neighbours],
+            scores=[round(score, 4) for _, score in neighbours]))
+    for start in range(0, len(entities), RECOMMENDATIONS_PUT_BATCH):
+        ndb.put_multi(entities[start:start + RECOMMENDATIONS_PUT_BATCH])
+
+    current = set(entity.key for entity in entities)
+    stale = [key for key in SessionRecommendations.query().iter(
+        keys_only=True) if key not in current]
+    ndb.delete_multi(stale)
+
+    result = {'wishlisted': len(session_keys), 'stored': len(entities),
+              'deleted': len(stale)}
+    logging.info('Built session recommendations: %s', result)
+    return result
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""rpcstats.py
+
+Per-endpoint datastore/memcache RPC accounting and latency histograms,
+plus an N+1 detector for tests and staging.
+
+An apiproxy post-call hook counts the datastore and memcache RPCs made
+while a recorder is active on the current thread. The WSGI middleware
+(installed from appengine_config.py) runs one recorder per request,
+for the Endpoints SPI and the main.py handlers alike, and folds its
+counts into memcache counters with a single offset_multi. Aggregates
+are read back by get_stats() for the admin stats page.
+
+With RPC_BUDGET_MODE set to 'log' or 'raise' each recorder also checks
+its request against an RPC budget and flags any datastore query (or
+get) shape repeated more than REPEATED_SHAPE_LIMIT times -- the usual
+signature of a per-row lookup loop -- with the stack of the offending
+call.
+
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import Counter
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+RPC_STATS_ENABLED = True
+MEMCACHE_STATS_PREFIX = 'RPCSTATS:'
+SPI_PREFIX = '/_ah/spi/'
+# Paths with per-entity parts, aggregated under these prefixes
+GROUPED_PATH_PREFIXES = (
+    '/admin/export/',
+    '/calendar/conference/',
+    '/calendar/wishlist/',
+)
+
+# N+1 detection: 'off', 'log' or 'raise'; staging can turn it on with
+# an app.yaml env_variables entry
+RPC_BUDGET_MODE = os.environ.get('RPC_BUDGET_MODE', 'off')
+RPC_BUDGET_DEFAULT = 50         # datastore RPCs per request
+# endpoint name -> datastore RPC budget, for handlers whose RPC count
+# must not grow with the size of their result; asserted by
+# tests/test_rpc_budgets.py
+RPC_BUDGETS = {
+    'ConferenceApi.addSessionToWishlistByName': 4,
+    'ConferenceApi.getConferencesToAttend': 4,
+    'ConferenceApi.getSessionsInWishlist': 3,
+    'ConferenceApi.queryConferences': 3,
+}
+REPEATED_SHAPE_LIMIT = 5        # same query/get shape per request
+
+# Upper bounds (ms) of the latency histogram buckets; slower calls go to
+# an overflow bucket
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+COUNTERS = (
+    'calls',
+    'wall_ms',
+    'datastore_get',
+    'datastore_query',
+    'datastore_put',
+    'datastore_delete',
+    'datastore_other',
+    'entities_read',
+    'entities_written',
+    'memcache_hit',
+    'memcache_miss',
+    'memcache_other',
+)
+
+_local = threading.local()
+_hooked_apiproxy = None
+
+
+class RpcBudgetExceeded(Exception):
+    """RpcBudgetExceeded -- raised by the N+1 detector in 'raise' mode"""
+
+
+def _query_shape(query):
+    """Kind, ancestor, filter and order structure of a datastore_pb.Query."""
+    filters = sorted((prop.name(), flt.op())
+                     for flt in query.filter_list()
+                     for prop in flt.property_list())
+    orders = tuple((order.property(), order.direction())
+                   for order in query.order_list())
+    return ('query', query.kind(), query.has_ancestor(),
+            tuple(filters), orders)
+
+
+def _get_shape(request):
+    kinds = sorted(set(key.path().element_list()[-1].type()
+                       for key in request.key_list()))
+    return ('get', tuple(kinds))
+
+
+class RpcRecorder(object):
+    """RpcRecorder -- RPC counts for one request (or any code block)"""
+
+    def __init__(self, name, mode=None, budget=None, repeat_limit=None):
+        self.name = name
+        self.counts = Counter()
+        self.started = time.time()
+        self.wall_ms = None
+        self.mode = RPC_BUDGET_MODE if mode is None else mode
+        self.budget = budget or RPC_BUDGETS.get(name, RPC_BUDGET_DEFAULT)
+        self.repeat_limit = repeat_limit or REPEATED_SHAPE_LIMIT
+        self.shapes = Counter()
+        self.violations = []
+
+    def add(self, service, call, request, response):
+        counts = self.counts
+        if service == 'datastore_v3':
+            if call == 'Get':
+                counts['datastore_get'] += 1
+                counts['entities_read'] += sum(
+                    1 for result in response.entity_list()
+                    if result.has_entity())
+            elif call == 'RunQuery':
+                counts['datastore_query'] += 1
+                counts['entities_read'] += response.result_size()
+            elif call == 'Next':
+                # further batches of a query already counted
+                counts['entities_read'] += response.result_size()
+            elif call == 'Put':
+                counts['datastore_put'] += 1
+                counts['entities_written'] += request.entity_size()
+            elif call == 'Delete':
+                counts['datastore_delete'] += 1
+            else:
+                counts['datastore_other'] += 1
+            if self.mode != 'off' and call != 'Next':
+                self._check(call, request)
+        elif service == 'memcache':
+            if call == 'Get':
+                hits = response.item_size()
+                counts['memcache_hit'] += hits
+                counts['memcache_miss'] += request.key_size() - hits
+            else:
+                counts['memcache_other'] += 1
+
+    @property
+    def datastore_rpcs(self):
+        return sum(self.counts[name] for name in (
+            'datastore_get', 'datastore_query', 'datastore_put',
+            'datastore_delete', 'datastore_other'))
+
+    def _check(self, call, request):
+        if call == 'RunQuery':
+            shape = _query_shape(request)
+        elif call == 'Get':
+            shape = _get_shape(request)
+        else:
+            shape = None
+
+        problems = []
+        if self.datastore_rpcs == self.budget + 1:
+            problems.append('%d datastore RPCs exceeds the budget of %d' % (
+                self.datastore_rpcs, self.budget))
+        if shape is not None:
+            self.shapes[shape] += 1
+            if self.shapes[shape] == self.repeat_limit + 1:
+                problems.append('%r repeated more than %d times' % (
+                    shape, self.repeat_limit))
+
+        for problem in problems:
+            message = '%s: %s' % (self.name, problem)
+            self.violations.append(message)
+            if self.mode == 'raise':
+                raise RpcBudgetExceeded(message)
+            logging.warning('N+1 detector: %s\n%s', message,
+                            ''.join(traceback.format_stack()))
+
+    def finish(self):
+        self.wall_ms = int((time.time() - self.started) * 1000)
+
+
+def _post_call_hook(service, call, request, response, rpc, error):
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is not None and error is None:
+        recorder.add(service, call, request, response)
+
+
+def install():
+    """Register the hook on the current apiproxy (again after testbed)."""
+    global _hooked_apiproxy
+    if _hooked_apiproxy is not apiproxy_stub_map.apiproxy:
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpcstats', _post_call_hook)
+        _hooked_apiproxy = apiproxy_stub_map.apiproxy
+
+
+def current():
+    """The recorder active on this thread, or None."""
+    return getattr(_local, 'recorder', None)
+
+
+@contextlib.contextmanager
+def record(name, flush=False, **detector):
+    """Record the RPCs of the enclosed block in a fresh RpcRecorder.
+
+    With flush=True the counts are added to the memcache aggregates of
+    name when the block exits. mode, budget and repeat_limit override the
+    N+1 detector settings, e.g. for asserting an RPC budget in a test::
+
+        with rpcstats.record('getProfile', mode='raise', budget=2):
+            api.getProfile(message_types.VoidMessage())
+    """
+    install()
+    recorder = RpcRecorder(name, **detector)
+    previous, _local.recorder = current(), recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+        recorder.finish()
+        if flush:
+            flush_recorder(recorder)
+
+
+def _latency_bucket(wall_ms):
+    for index, bound in enumerate(LATENCY_BUCKETS_MS):
+        if wall_ms <= bound:
+            return index
+    return len(LATENCY_BUCKETS_MS)
+
+
+def flush_recorder(recorder):
+    """Add one recorder's counts to the memcache aggregates."""
+    prefix = recorder.name + ':'
+    deltas = dict((prefix + name, count)
+                  for name, count in recorder.counts.iteritems() if count)
+    deltas[prefix + 'calls'] = 1
+    deltas[prefix + 'wall_ms'] = recorder.wall_ms
+    deltas[prefix + 'latency:%d' % _latency_bucket(recorder.wall_ms)] = 1
+    try:
+        memcache.offset_multi(deltas, key_prefix=MEMCACHE_STATS_PREFIX,
+                              initial_value=0)
+    except Exception:
+        # accounting must never fail the request it measured
+        logging.exception('Could not flush RPC stats for %s', recorder.name)
+
+
+def endpoint_name(path):
+    """Name requests by path; Endpoints calls by 'ConferenceApi.method'."""
+    if path.startswith(SPI_PREFIX):
+        return path[len(SPI_PREFIX):]
+    for prefix in GROUPED_PATH_PREFIXES:
+        if path.startswith(prefix):
+            return prefix
+    return path
+
+
+def rpc_stats_middleware(app):
+    """WSGI middleware recording every request under its endpoint name."""
+    def middleware(environ, start_response):
+        if not RPC_STATS_ENABLED:
+            for chunk in app(environ, start_response):
+                yield chunk
+            return
+        # recording spans the body iteration too, so streamed responses
+        # (e.g. the NDJSON export) are accounted in full
+        with record(endpoint_name(environ.get('PATH_INFO', '')),
+                    flush=True):
+            result = app(environ, start_response)
+            try:
+                for chunk in result:
+                    yield chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+    return middleware
+
+
+def get_stats(names):
+    """Return {name: aggregates} for the endpoints in names.
+
+    Averages are per call; the latency histogram is keyed by bucket
+    upper bound in ms ('+inf' for the overflow bucket).
+    """
+    labels = [str(bound) for bound in LATENCY_BUCKETS_MS] + ['+inf']
+    keys = []
+    for name in names:
+        keys.extend('%s:%s' % (name, counter) for counter in COUNTERS)
+        keys.extend('%s:latency:%d' % (name, index)
+                    for index in range(len(labels)))
+    values = memcache.get_multi(keys, key_prefix=MEMCACHE_STATS_PREFIX)
+
+    stats = {}
+    for name in names:
+        calls = int(values.get('%s:calls' % name, 0))
+        if not calls:
+            continue
+        entry = {'calls': calls, 'avg': {}, 'latency_ms': {}}
+        for counter in COUNTERS[1:]:
+            total = int(values.get('%s:%s' % (name, counter), 0))
+            entry['avg'][counter] = round(float(total) / calls, 2)
+        for index, label in enumerate(labels):
+            entry['latency_ms'][label] = int(
+                values.get('%s:latency:%d' % (name, index), 0))
+        stats[name] = entry
+    return stats
@@ -554,42 +554,52 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConference and conference.getProfile methods in one conference.batch call,
+     * sets the returned conference in the $scope and checks whether the user is attending it.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
+        gapi.client.conference.batch({
+            calls: [
+                {
+                    method: 'getConference',
+                    params: JSON.stringify({websafeConferenceKey: $routeParams.websafeConferenceKey})
+                },
+                {method: 'getProfile'}
+            ]
         }).execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
-                    // The request has failed.
+                    // The batch request has failed.
                     var errorMessage = resp.error.message || '';
-                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeKey
-                        + ' ' + errorMessage;
+                    $scope.messages = 'Failed to get the conference : ' + errorMessage;
+                    $scope.alertStatus = 'warning';
+                    $log.error($scope.messages);
+                    return;
+                }
+
+                var conferenceResult = resp.items[0];
+                if (conferenceResult.status != 200) {
+                    // The getConference call has failed.
+                    $scope.messages = 'Failed to get the conference : ' + $routeParams.websafeConferenceKey
+                        + ' ' + (conferenceResult.error || '');
                     $scope.alertStatus = 'warning';
                     $log.error($scope.messages);
                 } else {
-                    // The request has succeeded.
+                    // The getConference call has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
+                    $scope.conference = JSON.parse(conferenceResult.result);
                 }
-            });
-        });
 
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
+                // If the user is attending the conference, updates the status message and available function.
+                var profileResult = resp.items[1];
+                if (profileResult.status == 200) {
+                    var profile = JSON.parse(profileResult.result);
+                    var conferenceKeys = profile.conferenceKeysToAttend || [];
+                    for (var i = 0; i < conferenceKeys.length; i++) {
+                        if ($routeParams.websafeConferenceKey == conferenceKeys[i]) {
                             // The user is attending the conference.
                             $scope.alertStatus = 'info';
                             $scope.messages = 'You are attending this conference';
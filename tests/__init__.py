@@ -0,0 +1,16 @@
+"""Tests of the conference app on the App Engine testbed stubs.
+
+run from the application directory, with the SDK on $APPENGINE_SDK:
+
+    python -m unittest discover -s tests -t .
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from benchmarks.sdk import setup_sdk
+
+setup_sdk()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""base.py
+
+TestCase running every test on fresh testbed stubs, signed in as USER,
+with helpers to seed the entities most tests need and to patch
+attributes for the length of a test.
+
+"""
+
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+from benchmarks.bench_endpoints import BENCH_USER, setup_testbed
+from models import Conference, Profile, Session
+
+
+class TestbedTestCase(unittest.TestCase):
+    USER = BENCH_USER
+
+    def setUp(self):
+        self.testbed = setup_testbed()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def patch(self, target, name, value):
+        """Set target.name to value until the test ends."""
+        # the raw attribute, so a patched classmethod comes back as one
+        attributes = vars(target)
+        original = (attributes[name] if name in attributes
+                    else getattr(target, name))
+        self.addCleanup(setattr, target, name, original)
+        setattr(target, name, value)
+
+    def make_profile(self, email=USER, name=None):
+        profile = Profile(key=ndb.Key(Profile, email),
+                          displayName=name or email.split('@')[0],
+                          mainEmail=email, teeShirtSize='NOT_SPECIFIED')
+        profile.put()
+        return profile
+
+    def make_conference(self, organizer, name='Conference', **fields):
+        start = datetime.date(2015, 11, 3)
+        values = dict(name=name, organizerUserId=organizer.key.id(),
+                      city='London', topics=['Web'], startDate=start,
+                      month=start.month,
+                      endDate=start + datetime.timedelta(days=2),
+                      maxAttendees=100, seatsAvailable=100)
+        values.update(fields)
+        conference = Conference(parent=organizer.key, **values)
+        conference.put()
+        return conference
+
+    def make_session(self, conference, name='Session', **fields):
+        values = dict(name=name, speakerDisplayName='Speaker',
+                      highlights=['highlight'], duration=45,
+                      sessionType='lecture', date=conference.startDate,
+                      startTime=datetime.time(14, 0))
+        values.update(fields)
+        session = Session(parent=conference.key, **values)
+        session.put()
+        return session
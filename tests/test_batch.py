@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""test_batch.py
+
+The batch endpoint: per-call results, conditional headers and the
+by-key prefetch.
+
+"""
+
+import json
+import unittest
+
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import BatchCallForm, BatchForm, Profile, ReviewStatsQueryForm
+from tests.base import TestbedTestCase
+
+
+class RequestState(object):
+    """The HTTP request state batch() sees: just its headers."""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class BatchTest(TestbedTestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.profile = self.make_profile()
+        self.conference = self.make_conference(self.profile)
+        self.session = self.make_session(self.conference)
+
+    def batch(self, *calls, **headers):
+        api = ConferenceApi()
+        api.initialize_request_state(RequestState(headers))
+        return api.batch(BatchForm(calls=[
+            BatchCallForm(method=method, params=json.dumps(params))
+            for method, params in calls]))
+
+    def test_results_in_call_order(self):
+        results = self.batch(
+            ('getConference',
+             {'websafeConferenceKey': self.conference.key.urlsafe()}),
+            ('getProfile', {}),
+        ).items
+        self.assertEqual(['getConference', 'getProfile'],
+                         [result.method for result in results])
+        self.assertEqual([200, 200], [result.status for result in results])
+        self.assertEqual('Conference',
+                         json.loads(results[0].result)['name'])
+
+    def test_malformed_key_fails_only_its_call(self):
+        results = self.batch(
+            ('getReviewStats', {'websafeSessionKey': 'not-a-key'}),
+            ('getRecommendedSessions', {'websafeSessionKey': 'not-a-key'}),
+            ('getReviewStats',
+             {'websafeSessionKey': self.session.key.urlsafe()}),
+        ).items
+        self.assertEqual([404, 404, 200],
+                         [result.status for result in results])
+
+    def test_unexpected_error_fails_only_its_call(self):
+        def broken(api, request):
+            raise ValueError('boom')
+        self.patch(ConferenceApi, 'getProfile', broken)
+        results = self.batch(
+            ('getProfile', {}),
+            ('getConferencesCreated', {}),
+        ).items
+        self.assertEqual([500, 200], [result.status for result in results])
+        self.assertNotIn('boom', results[0].error)
+        self.assertEqual(1, len(json.loads(results[1].result)['items']))
+
+    def test_ignores_batch_if_none_match(self):
+        params = {'websafeConferenceKey': self.conference.key.urlsafe()}
+        first = self.batch(('getConference', params)).items[0]
+        etag = json.loads(first.result)['etag']
+
+        again = self.batch(('getConference', params),
+                           **{'If-None-Match': etag}).items[0]
+        self.assertEqual('Conference', json.loads(again.result)['name'])
+        # a sub-call's own ifNoneMatch still applies
+        params['ifNoneMatch'] = etag
+        mine = self.batch(('getConference', params)).items[0]
+        self.assertTrue(json.loads(mine.result)['notModified'])
+
+    def test_prefetch_reads_only_datastore_keys(self):
+        api = ConferenceApi()
+        calls = [
+            ('getConference', None),
+            ('getProfile', None),
+            ('getReviewStats', ReviewStatsQueryForm(
+                websafeSessionKey=self.session.key.urlsafe())),
+            ('getReviewStats', ReviewStatsQueryForm(
+                websafeSessionKey='not-a-key')),
+        ]
+        keys = api._prefetchBatch(calls)
+        self.assertEqual([ndb.Key(Profile, self.USER),
+                          api._sessionStatsKey(self.session.key)], keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""test_bench_cases.py
+
+The endpoint benchmark covers every public API method, so a new method
+shows up in its results (and its baseline check) from the start.
+
+"""
+
+import unittest
+
+from benchmarks.bench_endpoints import build_cases
+from conference import ConferenceApi
+from tests.base import TestbedTestCase
+
+
+class BenchCasesTest(TestbedTestCase):
+
+    def test_every_api_method_has_a_case(self):
+        conference = self.make_conference(self.make_profile())
+        data = {
+            'conferences': [conference],
+            'own_conference': conference,
+            'sessions': [self.make_session(conference)],
+        }
+        cases = build_cases(data)
+        self.assertEqual(sorted(ConferenceApi.all_remote_methods()),
+                         sorted(name for name, _ in cases))
+        # and every factory builds its request
+        for name, factory in cases:
+            self.assertIsNotNone(factory(0), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
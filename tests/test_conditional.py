@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""test_conditional.py
+
+Conditional reads: a client already holding the current etag gets a 200
+with notModified and no body; Endpoints would turn a 304 into a 404.
+
+"""
+
+import unittest
+
+import endpoints
+
+import conference as c
+from conference import ConferenceApi
+from tests.base import TestbedTestCase
+
+
+class ConditionalReadTest(TestbedTestCase):
+
+    def setUp(self):
+        super(ConditionalReadTest, self).setUp()
+        self.conference = self.make_conference(self.make_profile())
+        self.make_session(self.conference)
+        self.wsck = self.conference.key.urlsafe()
+
+    def test_get_conference(self):
+        request = c.CONF_GET_CONDITIONAL_REQUEST.combined_message_class
+        form = ConferenceApi().getConference(
+            request(websafeConferenceKey=self.wsck))
+        self.assertEqual('Conference', form.name)
+        self.assertFalse(form.notModified)
+
+        again = ConferenceApi().getConference(request(
+            websafeConferenceKey=self.wsck, ifNoneMatch=form.etag))
+        self.assertTrue(again.notModified)
+        self.assertEqual(form.etag, again.etag)
+        self.assertIsNone(again.name)
+
+    def test_get_conference_sessions(self):
+        request = c.SESSION_GET_REQUEST.combined_message_class
+        forms = ConferenceApi().getConferenceSessions(
+            request(websafeConferenceKey=self.wsck))
+        self.assertEqual(1, len(forms.items))
+
+        again = ConferenceApi().getConferenceSessions(request(
+            websafeConferenceKey=self.wsck, ifNoneMatch='"%s"' % forms.etag))
+        self.assertTrue(again.notModified)
+        self.assertEqual([], again.items)
+
+    def test_get_conference_sessions_bad_key(self):
+        request = c.SESSION_GET_REQUEST.combined_message_class
+        for key in ('not-a-key', self.make_profile().key.urlsafe()):
+            with self.assertRaises(endpoints.NotFoundException):
+                ConferenceApi().getConferenceSessions(
+                    request(websafeConferenceKey=key))
+
+    def test_get_announcement(self):
+        request = c.ANNOUNCEMENT_GET_REQUEST.combined_message_class
+        first = ConferenceApi().getAnnouncement(request())
+        again = ConferenceApi().getAnnouncement(
+            request(ifNoneMatch=first.etag))
+        self.assertTrue(again.notModified)
+        self.assertEqual('', again.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""test_conferences.py
+
+createConference and updateConference through the API methods.
+
+"""
+
+import unittest
+
+import conference as c
+from conference import ConferenceApi
+from models import Conference, ConferenceForm
+from tests.base import TestbedTestCase
+
+
+class CreateConferenceTest(TestbedTestCase):
+
+    def setUp(self):
+        super(CreateConferenceTest, self).setUp()
+        self.make_profile()
+
+    def test_create_stores_only_model_fields(self):
+        form = ConferenceApi().createConference(ConferenceForm(
+            name='Created', city='London', maxAttendees=100,
+            startDate='2015-11-03', endDate='2015-11-05'))
+        self.assertEqual('Created', form.name)
+
+        [conf] = Conference.query().fetch()
+        self.assertEqual('Created', conf.name)
+        self.assertEqual(11, conf.month)
+        self.assertEqual(100, conf.seatsAvailable)
+
+    def test_update(self):
+        conf = self.make_conference(self.make_profile())
+        form = ConferenceApi().updateConference(
+            c.CONF_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=conf.key.urlsafe(),
+                description='Updated'))
+        self.assertEqual('Updated', form.description)
+        self.assertEqual('Updated', conf.key.get().description)
+
+
+if __name__ == '__main__':
+    unittest.main()
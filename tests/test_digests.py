@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""test_digests.py
+
+SendConfirmationDigestsHandler: one digest per organizer from the
+confirmation pull queue, with backoff and redelivery on failed sends.
+
+"""
+
+import json
+import unittest
+
+import webapp2
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import testbed
+
+import main
+from conference import CONFIRMATION_EMAIL_QUEUE
+from tests.base import TestbedTestCase
+
+DIGESTS_URL = '/crons/send_confirmation_digests'
+
+
+class SendConfirmationDigestsTest(TestbedTestCase):
+
+    def setUp(self):
+        super(SendConfirmationDigestsTest, self).setUp()
+        self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.failing = set()
+        send_mail = mail.send_mail
+
+        def flaky(sender, to, *args, **kwargs):
+            if to in self.failing:
+                raise mail.Error('send failed')
+            return send_mail(sender, to, *args, **kwargs)
+        self.patch(mail, 'send_mail', flaky)
+
+        self.queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        for email, name in (('a@example.com', 'Alpha'),
+                            ('b@example.com', 'Beta'),
+                            ('a@example.com', 'Gamma')):
+            self.queue.add(taskqueue.Task(payload=json.dumps({
+                'email': email, 'name': name, 'city': 'London',
+                'startDate': '2015-11-03', 'endDate': '2015-11-05',
+                'topics': ['Web'], 'maxAttendees': 100}), method='PULL'))
+
+    def run_handler(self):
+        response = webapp2.Request.blank(DIGESTS_URL).get_response(main.app)
+        self.assertEqual(200, response.status_int)
+        return response
+
+    def sent(self, email):
+        return self.mail_stub.get_sent_messages(to=email)
+
+    def queued(self):
+        """Tasks still in the queue, leased or not."""
+        return self.taskqueue_stub.GetTasks(CONFIRMATION_EMAIL_QUEUE)
+
+    def test_one_digest_per_organizer(self):
+        self.assertIn('Sent 2 digests', self.run_handler().body)
+
+        [alpha] = self.sent('a@example.com')
+        self.assertEqual('You created 2 new Conferences!', alpha.subject)
+        body = alpha.body.decode()
+        self.assertIn('Alpha', body)
+        self.assertIn('Gamma', body)
+        self.assertNotIn('Beta', body)
+        [beta] = self.sent('b@example.com')
+        self.assertEqual('You created a new Conference!', beta.subject)
+        self.assertEqual([], self.queued())
+
+    def test_failed_send_backs_off_and_is_redelivered(self):
+        self.failing.add('a@example.com')
+        leases = []
+        modify_task_lease = taskqueue.Queue.modify_task_lease
+
+        def record(queue, task, lease_seconds):
+            leases.append((task.retry_count, lease_seconds))
+            # hand the task straight back instead of waiting the backoff
+            return modify_task_lease(queue, task, 0)
+        self.patch(taskqueue.Queue, 'modify_task_lease', record)
+
+        self.run_handler()
+        self.assertEqual([], self.sent('a@example.com'))
+        self.assertEqual(1, len(self.sent('b@example.com')))
+        self.assertEqual(2, len(leases))
+        self.assertEqual(2, len(self.queued()))
+        for retry_count, lease_seconds in leases:
+            self.assertEqual(min(main.DIGEST_RETRY_BASE * 2 ** retry_count,
+                                 main.DIGEST_RETRY_MAX), lease_seconds)
+
+        # the next run redelivers both of a@'s tasks as one digest
+        self.failing.clear()
+        self.run_handler()
+        [digest] = self.sent('a@example.com')
+        self.assertEqual('You created 2 new Conferences!', digest.subject)
+        self.assertEqual(1, len(self.sent('b@example.com')))
+        self.assertEqual([], self.queued())
+
+    def test_gives_up_after_max_retries(self):
+        self.patch(main, 'DIGEST_MAX_RETRIES', 0)
+        self.failing.add('a@example.com')
+        self.run_handler()
+        self.assertEqual([], self.sent('a@example.com'))
+        self.assertEqual([], self.queued())
+
+
+if __name__ == '__main__':
+    unittest.main()
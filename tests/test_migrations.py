@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""test_migrations.py
+
+migrations.run_batch against writes that land while a batch runs.
+
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import migrations
+from models import MigrationStatus
+from tests.base import TestbedTestCase
+
+
+class RunBatchTest(TestbedTestCase):
+
+    def setUp(self):
+        super(RunBatchTest, self).setUp()
+        self.profile = self.make_profile()
+        self.conferences = [
+            self.make_conference(self.profile, name='Conference %d' % i)
+            for i in range(2)]
+        self.profile.conferenceKeysToAttend = [
+            self.conferences[0].key.urlsafe()]
+        self.profile.put()
+
+    def register_after_page_read(self):
+        """Register for the second conference right after run_batch has
+        read its page, like a request racing the migration."""
+        fetch_page = ndb.Query.fetch_page
+        profile_key = self.profile.key
+        wsck = self.conferences[1].key.urlsafe()
+
+        def racing(query, *args, **kwargs):
+            page = fetch_page(query, *args, **kwargs)
+            profile = profile_key.get()
+            profile.conferenceKeysToAttend.append(wsck)
+            profile.put()
+            return page
+        self.patch(ndb.Query, 'fetch_page', racing)
+
+    def test_mapper_sees_writes_made_after_the_page_read(self):
+        self.assertTrue(migrations.start('profile_conference_keys'))
+        self.register_after_page_read()
+        migrations.run_batch('profile_conference_keys', None)
+
+        profile = self.profile.key.get(use_cache=False)
+        expected = [conf.key for conf in self.conferences]
+        self.assertEqual(expected, [ndb.Key(urlsafe=wsck) for wsck in
+                                    profile.conferenceKeysToAttend])
+        self.assertEqual(expected, profile.conferenceKeys)
+        status = MigrationStatus.get_by_id('profile_conference_keys')
+        self.assertEqual(migrations.DONE, status.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""test_ratelimit.py
+
+ratelimit.check windows and the error rate-limited calls get.
+
+"""
+
+import httplib
+import unittest
+
+from google.appengine.api import memcache
+
+import ratelimit
+from models import TooManyRequestsException
+from tests.base import TestbedTestCase
+
+
+class RateLimitTest(TestbedTestCase):
+    NOW = 1000000.0
+
+    def test_burst_then_refused(self):
+        burst = ratelimit.RATE_LIMITS['query'].burst
+        allowed = [ratelimit.check('query', 'user:a', now=self.NOW)
+                   for _ in range(burst + 5)]
+        self.assertEqual([True] * burst + [False] * 5, allowed)
+        # other callers have their own bucket
+        self.assertTrue(ratelimit.check('query', 'user:b', now=self.NOW))
+        self.assertEqual(5, ratelimit.get_stats()['query']['limited'])
+
+    def test_refill(self):
+        limit = ratelimit.RATE_LIMITS['query']
+        window_seconds = float(limit.burst) / limit.rate
+        start = (self.NOW // window_seconds) * window_seconds
+        for _ in range(limit.burst):
+            ratelimit.check('query', 'user:a', now=start)
+        self.assertFalse(ratelimit.check('query', 'user:a', now=start + 1))
+        # half a window later, half the bucket is back
+        later = start + window_seconds * 1.5
+        allowed = [ratelimit.check('query', 'user:a', now=later)
+                   for _ in range(limit.burst)]
+        self.assertEqual(limit.burst / 2, allowed.count(True))
+
+    def test_window_counters_expire(self):
+        limit = ratelimit.RATE_LIMITS['query']
+        window_seconds = float(limit.burst) / limit.rate
+        added = []
+        add_multi = memcache.add_multi
+
+        def record(mapping, time=0, **kwargs):
+            added.append(time)
+            return add_multi(mapping, time=time, **kwargs)
+
+        self.patch(memcache, 'add_multi', record)
+        ratelimit.check('query', 'user:a', now=self.NOW)
+        self.assertEqual(1, len(added))
+        self.assertTrue(2 * window_seconds <= added[0] <=
+                        2 * window_seconds + 1)
+
+    def test_limited_call_is_a_403(self):
+        self.assertEqual(httplib.FORBIDDEN,
+                         TooManyRequestsException.http_status)
+
+
+if __name__ == '__main__':
+    unittest.main()
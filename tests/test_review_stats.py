@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""test_review_stats.py
+
+The review_stats migration, which rebuilds ReviewStats from the Reviews.
+
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from migrations import review_stats
+from models import Review, ReviewEnum, ReviewStatsQueryForm
+from tests.base import TestbedTestCase
+
+
+class ReviewStatsMigrationTest(TestbedTestCase):
+
+    def setUp(self):
+        super(ReviewStatsMigrationTest, self).setUp()
+        conference = self.make_conference(self.make_profile())
+        self.sessions = [self.make_session(conference, name='Session %d' % i)
+                         for i in range(3)]
+        # stored before aggregates existed: no ReviewStats yet
+        ndb.put_multi([
+            Review(parent=session.key, review=ReviewEnum.excellent.name,
+                   rating=ReviewEnum.excellent.number)
+            for session in self.sessions for _ in range(2)])
+
+    def stats(self, **request):
+        return ConferenceApi().getReviewStats(ReviewStatsQueryForm(
+            **request))
+
+    def test_backfills_session_and_speaker_stats(self):
+        self.assertEqual(6, review_stats(self.sessions))
+        for session in self.sessions:
+            stats = self.stats(websafeSessionKey=session.key.urlsafe())
+            self.assertEqual(2, stats.count)
+            self.assertEqual(5.0, stats.average)
+        self.assertEqual(6, self.stats(speaker_name='Speaker').count)
+
+    def test_rerun_and_new_reviews_count_once(self):
+        review_stats(self.sessions)
+        self.assertEqual(0, review_stats(self.sessions))
+
+        # a review posted after the backfill updates both aggregates
+        ConferenceApi._putReviewBatch(
+            self.sessions[0].key, 'Speaker',
+            [Review(parent=self.sessions[0].key,
+                    review=ReviewEnum.satisfied.name,
+                    rating=ReviewEnum.satisfied.number)])
+        self.assertEqual(0, review_stats(self.sessions))
+        self.assertEqual(7, self.stats(speaker_name='Speaker').count)
+        self.assertEqual(3, self.stats(
+            websafeSessionKey=self.sessions[0].key.urlsafe()).count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""test_reviews.py
+
+postReview, getReview and the review aggregates postReview maintains.
+
+"""
+
+import unittest
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import testbed
+
+import conference
+from conference import ConferenceApi
+from models import Review, ReviewEnum, ReviewForm, ReviewQueryForm, \
+    ReviewStatsQueryForm
+from tests.base import TestbedTestCase
+
+
+class PostReviewTest(TestbedTestCase):
+
+    def setUp(self):
+        super(PostReviewTest, self).setUp()
+        self.profile = self.make_profile()
+        self.session = self.make_session(
+            self.make_conference(self.profile), name='Keynote')
+
+    def post(self, review):
+        return ConferenceApi().postReview(ReviewForm(
+            conference_name='Conference', session_name='Keynote',
+            review=review))
+
+    def test_unbuffered_post_stores_review_and_stats(self):
+        self.assertFalse(conference.REVIEW_INGEST_BUFFERED)
+        self.post(ReviewEnum.excellent)
+        self.post(ReviewEnum.unsatisfied)
+
+        reviews = Review.query(ancestor=self.session.key).fetch()
+        self.assertEqual(2, len(reviews))
+        self.assertTrue(all(review.key.id() for review in reviews))
+        self.assertEqual([ReviewEnum.unsatisfied.number,
+                          ReviewEnum.excellent.number],
+                         sorted(review.rating for review in reviews))
+
+        stats = ConferenceApi().getReviewStats(ReviewStatsQueryForm(
+            websafeSessionKey=self.session.key.urlsafe()))
+        self.assertEqual(2, stats.count)
+        speaker = ConferenceApi().getReviewStats(ReviewStatsQueryForm(
+            speaker_name='Speaker'))
+        self.assertEqual(2, speaker.count)
+
+    def test_get_review(self):
+        self.post(ReviewEnum.excellent)
+        forms = ConferenceApi().getReview(ReviewQueryForm(
+            websafeSessionKey=self.session.key.urlsafe()))
+        self.assertEqual(1, len(forms.items))
+
+    def test_get_review_bad_key(self):
+        # malformed, and a well-formed key of another kind
+        for key in ('not-a-key', self.profile.key.urlsafe()):
+            with self.assertRaises(endpoints.NotFoundException):
+                ConferenceApi().getReview(ReviewQueryForm(
+                    websafeSessionKey=key))
+
+
+class FlushReviewsTest(TestbedTestCase):
+
+    def setUp(self):
+        super(FlushReviewsTest, self).setUp()
+        self.session = self.make_session(
+            self.make_conference(self.make_profile()), name='Keynote')
+        self.patch(conference, 'REVIEW_FLUSH_TRANSACTION_SIZE', 10)
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        api = ConferenceApi()
+        for _ in range(25):
+            api._bufferReview(self.session.key, 'Speaker', {
+                'conference_name': 'Conference', 'session_name': 'Keynote',
+                'speaker_name': None, 'review': 'excellent',
+                'rating': ReviewEnum.excellent.number})
+
+    def test_one_session_spike_is_split_into_transactions(self):
+        sizes = []
+        put_review_batch = ConferenceApi._putReviewBatch
+
+        def record(session_key, speaker, reviews):
+            sizes.append(len(reviews))
+            return put_review_batch(session_key, speaker, reviews)
+        self.patch(ConferenceApi, '_putReviewBatch', staticmethod(record))
+
+        self.assertEqual(25, ConferenceApi._flushReviews())
+        self.assertEqual([10, 10, 5], sizes)
+        self.assertEqual(
+            25, Review.query(ancestor=self.session.key).count())
+        self.assertEqual([], self.taskqueue_stub.GetTasks(
+            conference.REVIEW_INGEST_QUEUE))
+
+    def test_failing_reviews_go_to_dead_letters(self):
+        def fail(session_key, speaker, reviews):
+            raise ValueError('cannot write')
+        self.patch(ConferenceApi, '_putReviewBatch', staticmethod(fail))
+        self.patch(conference, 'REVIEW_FLUSH_MAX_LEASES', 0)
+
+        self.assertEqual(0, ConferenceApi._flushReviews())
+        self.assertEqual([], self.taskqueue_stub.GetTasks(
+            conference.REVIEW_INGEST_QUEUE))
+        dead = taskqueue.Queue(conference.REVIEW_DEAD_LETTER_QUEUE)
+        self.assertEqual(25, len(dead.lease_tasks(60, 100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
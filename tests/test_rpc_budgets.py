@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""test_rpc_budgets.py
+
+Holds the handlers that used to make an RPC per row -- wishlist
+hydration, organizer profile lookups, global name queries -- to their
+rpcstats.RPC_BUDGETS, with the N+1 detector raising. Every case returns
+more rows than REPEATED_SHAPE_LIMIT, so a per-row get or query is
+caught even within budget.
+
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+import rpcstats
+from conference import ConferenceApi
+from models import ConferenceQueryForms, Wishlist, WishlistFormName
+from tests.base import TestbedTestCase
+
+ROWS = rpcstats.REPEATED_SHAPE_LIMIT + 3
+
+
+class RpcBudgetTest(TestbedTestCase):
+
+    def setUp(self):
+        super(RpcBudgetTest, self).setUp()
+        self.profile = self.make_profile()
+        # one conference per organizer, so every row has its own profile
+        self.conferences = [
+            self.make_conference(self.make_profile(
+                'organizer%d@example.com' % i), name='Conference %d' % i)
+            for i in range(ROWS)]
+        self.sessions = [
+            self.make_session(self.conferences[0], name='Session %d' % i)
+            for i in range(ROWS)]
+        self.profile.conferenceKeysToAttend = [
+            conf.key.urlsafe() for conf in self.conferences]
+        self.profile.put()
+        Wishlist(parent=self.profile.key, userId=self.USER,
+                 sessionKeys=[session.key for session in self.sessions]
+                 ).put()
+
+    def call(self, method, request):
+        """Call method as a fresh request, recorded with the detector
+        raising at its budget; returns (response, recorder)."""
+        name = 'ConferenceApi.%s' % method
+        ndb.get_context().clear_cache()
+        with rpcstats.record(name, mode='raise',
+                             budget=rpcstats.RPC_BUDGETS[name]) as recorder:
+            response = getattr(ConferenceApi(), method)(request)
+        return response, recorder
+
+    def test_get_sessions_in_wishlist(self):
+        forms, _ = self.call('getSessionsInWishlist',
+                             message_types.VoidMessage())
+        self.assertEqual(ROWS, len(forms.items))
+
+    def test_get_conferences_to_attend(self):
+        forms, _ = self.call('getConferencesToAttend',
+                             message_types.VoidMessage())
+        self.assertEqual(ROWS, len(forms.items))
+        self.assertTrue(all(form.organizerDisplayName
+                            for form in forms.items))
+
+    def test_query_conferences(self):
+        forms, _ = self.call('queryConferences', ConferenceQueryForms())
+        self.assertEqual(ROWS, len(forms.items))
+
+    def test_add_session_to_wishlist_by_name(self):
+        request = WishlistFormName(sessionName='Session 1')
+        self.call('addSessionToWishlistByName', request)
+        # the name lookup is cached: only the wishlist query is left
+        _, recorder = self.call('addSessionToWishlistByName', request)
+        self.assertEqual(1, recorder.counts['datastore_query'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""test_sessions.py
+
+Session lookups by websafe key and by name: a missing or deleted session
+is a 404, remembered as missing for a while.
+
+"""
+
+import unittest
+
+import endpoints
+
+from conference import ConferenceApi
+from models import ReviewEnum, ReviewForm, WishlistForm, WishlistFormName
+from tests.base import TestbedTestCase
+
+
+class SessionLookupTest(TestbedTestCase):
+
+    def setUp(self):
+        super(SessionLookupTest, self).setUp()
+        self.profile = self.make_profile()
+        self.conference = self.make_conference(self.profile)
+        self.session = self.make_session(self.conference, name='Keynote')
+
+    def add(self, websafe_key):
+        return ConferenceApi().addSessionToWishlist(
+            WishlistForm(websafeSessionKey=websafe_key))
+
+    def test_add_to_wishlist_bad_key(self):
+        for key in ('not-a-key', self.conference.key.urlsafe()):
+            with self.assertRaises(endpoints.NotFoundException):
+                self.add(key)
+
+    def test_deleted_session_is_remembered_as_missing(self):
+        websafe_key = self.session.key.urlsafe()
+        self.session.key.delete()
+        with self.assertRaises(endpoints.NotFoundException):
+            self.add(websafe_key)
+
+        # restored behind the cache's back: still missing until the
+        # negative entry expires, as no datastore get is made
+        self.session.put()
+        with self.assertRaises(endpoints.NotFoundException):
+            self.add(websafe_key)
+
+    def test_cached_name_of_deleted_session(self):
+        api = ConferenceApi()
+        # caches the name's key
+        api.addSessionToWishlistByName(WishlistFormName(sessionName='Keynote'))
+        self.session.key.delete()
+
+        with self.assertRaises(endpoints.NotFoundException):
+            api.postReview(ReviewForm(
+                conference_name='Conference', session_name='Keynote',
+                review=ReviewEnum.excellent))
+
+        # the name is looked up again and finds its new session
+        replacement = self.make_session(self.conference, name='Keynote')
+        api.addSessionToWishlistByName(WishlistFormName(sessionName='Keynote'))
+        self.assertEqual(replacement.key,
+                         api._getSessionByName('Keynote').key)
+
+
+if __name__ == '__main__':
+    unittest.main()
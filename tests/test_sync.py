@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""test_sync.py
+
+Review delta sync: changed reviews, then tombstones of deleted ones.
+
+"""
+
+import unittest
+
+from conference import ConferenceApi
+from models import ChangesQueryForm, Review, ReviewEnum, ReviewForm
+from tests.base import TestbedTestCase
+
+
+class ReviewChangesTest(TestbedTestCase):
+
+    def setUp(self):
+        super(ReviewChangesTest, self).setUp()
+        conference = self.make_conference(self.make_profile())
+        self.session = self.make_session(conference, name='Keynote')
+        self.other = self.make_session(conference, name='Closing')
+
+    def post(self, session_name):
+        ConferenceApi().postReview(ReviewForm(
+            conference_name='Conference', session_name=session_name,
+            review=ReviewEnum.excellent))
+
+    def changes(self, **request):
+        return ConferenceApi().getReviewChanges(ChangesQueryForm(**request))
+
+    def test_full_then_delta_sync(self):
+        self.post('Keynote')
+        self.post('Closing')
+
+        full = self.changes()
+        self.assertTrue(full.fullSync)
+        self.assertEqual(2, len(full.items))
+        self.assertTrue(all(form.websafeKey for form in full.items))
+
+        mine = self.changes(websafeSessionKey=self.session.key.urlsafe())
+        [review] = mine.items
+        self.assertEqual('Keynote', review.session_name)
+
+        Review.query(ancestor=self.session.key).get().key.delete()
+        delta = self.changes(since=mine.watermark,
+                             websafeSessionKey=self.session.key.urlsafe())
+        self.assertFalse(delta.fullSync)
+        self.assertEqual([review.websafeKey], delta.deleted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+"""index_advisor.py
+
+Index advisor for the conference datastore models.
+
+Reads the code instead of trusting the auto-generated index.yaml:
+
+  * enumerates every query shape ConferenceApi._getQuery can build from
+    the FIELDS table in conference.py (any subset of equality filters,
+    at most one inequality field, sorted by the inequality field and
+    then by name),
+  * collects the properties each kind is actually filtered, sorted or
+    projected on anywhere in the app (Model.prop references inside
+    query/filter/order/fetch calls),
+  * computes the minimal composite index set covering those shapes,
+    relying on the datastore's merge join: an equality-only query, or
+    one whose inequality/sort suffix is P, is served by merging one
+    (equality property, P...) index per equality filter, so the indexes
+    needed are exactly (e, P...) for every equality field e and suffix
+    P, plus (P...) itself,
+  * prices a put of each kind in datastore write operations with the
+    current models.py/index.yaml and with the proposal.
+
+usage:
+  python tools/index_advisor.py [--repeated 3] [--write]
+
+--write rewrites the manual section of index.yaml with the proposal.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import ast
+import glob
+import itertools
+import os
+import sys
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY_CALLS = ('query', 'filter', 'order', 'AND', 'OR', 'IN',
+               'fetch', 'fetch_page', 'iter', 'get', 'count')
+# ConferenceApi._changes(Model, ...) filters and orders Model.updated
+SYNC_CALLS = ('_changes',)
+SYNC_PROPERTY = 'updated'
+AUTOGENERATED = '# AUTOGENERATED'
+
+# Legacy datastore write pricing
+NEW_ENTITY_OPS = 2              # entity + EntitiesByKind row
+NEW_INDEX_VALUE_OPS = 2         # ascending and descending built-in rows
+NEW_COMPOSITE_ROW_OPS = 1
+UPDATE_ENTITY_OPS = 1
+UPDATE_INDEX_VALUE_OPS = 4      # delete + write, ascending and descending
+UPDATE_COMPOSITE_ROW_OPS = 2    # delete + write
+
+# Updates worth pricing on their own: (kind, changed properties)
+HOT_UPDATES = (
+    ('Conference', ('seatsAvailable',)),    # every (un)registration
+)
+
+
+def load_models(path):
+    """Return {kind: {prop: (repeated, indexed)}} for ndb models."""
+    with open(path) as source:
+        tree = ast.parse(source.read(), path)
+    kinds = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        if not any(getattr(base, 'attr', None) == 'Model'
+                   for base in node.bases):
+            continue
+        props = {}
+        for stmt in node.body:
+            if not (isinstance(stmt, ast.Assign) and
+                    isinstance(stmt.value, ast.Call) and
+                    getattr(stmt.value.func, 'attr', '').endswith(
+                        'Property')):
+                continue
+            options = dict((kw.arg, getattr(kw.value, 'id', None))
+                           for kw in stmt.value.keywords)
+            unindexed = stmt.value.func.attr in (
+                'TextProperty', 'BlobProperty', 'JsonProperty',
+                'PickleProperty', 'LocalStructuredProperty')
+            props[stmt.targets[0].id] = (
+                options.get('repeated') == 'True',
+                options.get('indexed') != 'False' and not unindexed)
+        kinds[node.name] = props
+    # models used only as the type of a structured property are not kinds
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Call) and
+                getattr(node.func, 'attr', '').endswith(
+                    'StructuredProperty') and node.args):
+            kinds.pop(getattr(node.args[0], 'id', None), None)
+    return kinds
+
+
+def load_fields(path):
+    """The FIELDS table of conference.py: filter field -> property."""
+    with open(path) as source:
+        tree = ast.parse(source.read(), path)
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and
+                getattr(node.targets[0], 'id', None) == 'FIELDS'):
+            return sorted(value.s for value in node.value.values)
+    raise SystemExit('FIELDS not found in %s' % path)
+
+
+def source_files():
+    """Every module of the app: the top-level .py files (tools/,
+    benchmarks/ and tests/ never run in production)."""
+    return sorted(glob.glob(os.path.join(APP_ROOT, '*.py')))
+
+
+def queried_properties(kinds, fields):
+    """Return {kind: set(props)} referenced by queries in the app."""
+    queried = dict((kind, set()) for kind in kinds)
+    # _getQuery filters and sorts Conference on the FIELDS dynamically
+    queried['Conference'].update(fields)
+    queried['Conference'].add('name')
+    for path in source_files():
+        with open(path) as source:
+            tree = ast.parse(source.read(), path)
+        for call in ast.walk(tree):
+            if not isinstance(call, ast.Call):
+                continue
+            if getattr(call.func, 'attr', None) in SYNC_CALLS:
+                model = call.args[0] if call.args else None
+                if isinstance(model, ast.Name) and model.id in kinds:
+                    queried[model.id].add(SYNC_PROPERTY)
+                continue
+            if getattr(call.func, 'attr', None) not in QUERY_CALLS:
+                continue
+            arguments = list(call.args) + [kw.value for kw in call.keywords]
+            for argument in arguments:
+                for node in ast.walk(argument):
+                    if (isinstance(node, ast.Attribute) and
+                            isinstance(node.value, ast.Name) and
+                            node.value.id in kinds and
+                            node.attr in kinds[node.value.id]):
+                        queried[node.value.id].add(node.attr)
+    return queried
+
+
+def query_shapes(fields):
+    """Every (equality fields, inequality field) _getQuery can build."""
+    shapes = []
+    for inequality in [None] + fields:
+        others = [field for field in fields if field != inequality]
+        for size in range(len(others) + 1):
+            for equalities in itertools.combinations(others, size):
+                shapes.append((equalities, inequality))
+    return shapes
+
+
+def _suffix(inequality):
+    return (inequality, 'name') if inequality else ('name',)
+
+
+def covering_indexes(shapes):
+    """Minimal merge-join covering index set for _getQuery shapes."""
+    indexes = set()
+    for equalities, inequality in shapes:
+        suffix = _suffix(inequality)
+        if not equalities and len(suffix) > 1:
+            indexes.add(suffix)
+        for field in equalities:
+            indexes.add((field,) + suffix)
+    return sorted(indexes, key=lambda index: (len(index), index))
+
+
+def served(shape, indexes):
+    """Whether merging some of indexes (property tuples) serves shape."""
+    equalities, inequality = shape
+    suffix = _suffix(inequality)
+    if not equalities:
+        return len(suffix) == 1 or suffix in indexes
+    usable = [index[:-len(suffix)] for index in indexes
+              if index[-len(suffix):] == suffix and
+              set(index[:-len(suffix)]) <= set(equalities)]
+    return all(any(field in prefix for prefix in usable)
+               for field in equalities)
+
+
+def load_index_yaml(path):
+    """Parse index.yaml into [(kind, ancestor, ((prop, desc), ...))]."""
+    indexes = []
+    current = None
+    with open(path) as source:
+        for line in source:
+            text = line.split('#', 1)[0].rstrip()
+            stripped = text.strip()
+            if stripped.startswith('- kind:'):
+                current = [stripped.split(':', 1)[1].strip(), False, []]
+                indexes.append(current)
+            elif current is None:
+                continue
+            elif stripped.startswith('ancestor:'):
+                current[1] = stripped.split(':', 1)[1].strip() in (
+                    'yes', 'true')
+            elif stripped.startswith('- name:'):
+                current[2].append([stripped.split(':', 1)[1].strip(), False])
+            elif stripped.startswith('direction:'):
+                current[2][-1][1] = stripped.endswith('desc')
+    return [(kind, ancestor, tuple(tuple(prop) for prop in props))
+            for kind, ancestor, props in indexes]
+
+
+def propose_indexes(current, kinds, queried, conference_indexes):
+    """Conference indexes from the shapes; others kept if still valid."""
+    proposed = [('Conference', False,
+                 tuple((prop, False) for prop in index))
+                for index in conference_indexes]
+    # the announcement projects name over a seatsAvailable range
+    proposed.append(('Conference', False,
+                     (('seatsAvailable', False), ('name', False))))
+    for kind, ancestor, props in current:
+        if kind == 'Conference':
+            continue
+        names = [prop for prop, desc in props]
+        if all(name in queried.get(kind, ()) for name in names):
+            proposed.append((kind, ancestor, props))
+        else:
+            print('dropping %s index on %s: unqueried or unknown '
+                  'property' % (kind, ', '.join(names)))
+    unique = []
+    for index in proposed:
+        if index not in unique:
+            unique.append(index)
+    return unique
+
+
+def values(kinds, kind, prop, repeated_values):
+    repeated = kinds[kind].get(prop, (False, True))[0]
+    return repeated_values if repeated else 1
+
+
+def index_rows(kinds, index, repeated_values):
+    kind, ancestor, props = index
+    rows = 1
+    for prop, desc in props:
+        rows *= values(kinds, kind, prop, repeated_values)
+    return rows
+
+
+def write_cost(kinds, indexed, indexes, kind, repeated_values,
+               changed=None):
+    """Write ops for a new entity, or an update of the changed props."""
+    if changed is None:
+        props = indexed[kind]
+        composite = [index for index in indexes if index[0] == kind]
+        return (NEW_ENTITY_OPS +
+                NEW_INDEX_VALUE_OPS * sum(
+                    values(kinds, kind, prop, repeated_values)
+                    for prop in props) +
+                NEW_COMPOSITE_ROW_OPS * sum(
+                    index_rows(kinds, index, repeated_values)
+                    for index in composite))
+    props = [prop for prop in changed if prop in indexed[kind]]
+    composite = [index for index in indexes if index[0] == kind and
+                 any(prop in changed for prop, desc in index[2])]
+    return (UPDATE_ENTITY_OPS +
+            UPDATE_INDEX_VALUE_OPS * sum(
+                values(kinds, kind, prop, repeated_values)
+                for prop in props) +
+            UPDATE_COMPOSITE_ROW_OPS * sum(
+                index_rows(kinds, index, repeated_values)
+                for index in composite))
+
+
+def render_indexes(indexes):
+    lines = ['indexes:', '']
+    for kind, ancestor, props in indexes:
+        lines.append('- kind: %s' % kind)
+        if ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        for prop, desc in props:
+            lines.append('  - name: %s' % prop)
+            if desc:
+                lines.append('    direction: desc')
+        lines.append('')
+    return lines
+
+
+def write_index_yaml(path, indexes):
+    with open(path) as source:
+        text = source.read()
+    autogenerated = text[text.index(AUTOGENERATED):].split('\n')
+    # keep the marker and its explanation, drop the generated entries
+    tail = list(itertools.takewhile(
+        lambda line: not line.startswith('- kind:'), autogenerated))
+    with open(path, 'w') as output:
+        output.write('\n'.join(render_indexes(indexes) + tail).rstrip() +
+                     '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Minimal datastore index set for the conference API.')
+    parser.add_argument('--repeated', type=int, default=3,
+                        help='values assumed per repeated property')
+    parser.add_argument('--write', action='store_true',
+                        help='rewrite index.yaml with the proposal')
+    args = parser.parse_args()
+
+    kinds = load_models(os.path.join(APP_ROOT, 'models.py'))
+    fields = load_fields(os.path.join(APP_ROOT, 'conference.py'))
+    index_path = os.path.join(APP_ROOT, 'index.yaml')
+    current = load_index_yaml(index_path)
+
+    shapes = query_shapes(fields)
+    conference_indexes = covering_indexes(shapes)
+    print('_getQuery: %d query shapes over %s' % (
+        len(shapes), ', '.join(fields)))
+
+    queried = queried_properties(kinds, fields)
+    indexed_now = dict((kind, [prop for prop, (rep, indexed)
+                               in props.items() if indexed])
+                       for kind, props in kinds.items())
+    indexed_proposed = dict((kind, sorted(queried[kind]))
+                            for kind in kinds)
+    print('\nproperties to index (queried) / to unindex:')
+    for kind in sorted(kinds):
+        unindex = sorted(set(indexed_now[kind]) - queried[kind])
+        print('  %-12s %s / %s' % (
+            kind, ', '.join(indexed_proposed[kind]) or '-',
+            ', '.join(unindex) or '-'))
+
+    proposed = propose_indexes(current, kinds, queried, conference_indexes)
+    print('\ncomposite indexes: %d now, %d proposed (%d for Conference)' % (
+        len(current), len(proposed),
+        sum(1 for index in proposed if index[0] == 'Conference')))
+    have = [tuple(prop for prop, desc in index[2])
+            for index in current if index[0] == 'Conference']
+    unserved = [shape for shape in shapes if not served(shape, have)]
+    print('_getQuery shapes the current index.yaml cannot serve: %d' %
+          len(unserved))
+    for equalities, inequality in unserved:
+        print('  equal on %s, inequality on %s' % (
+            ', '.join(equalities) or '-', inequality or '-'))
+
+    print('\nwrite ops per put (%d values per repeated property):' %
+          args.repeated)
+    print('  %-34s %6s %9s' % ('', 'now', 'proposed'))
+    for kind in sorted(kinds):
+        print('  %-34s %6d %9d' % (
+            'new %s' % kind,
+            write_cost(kinds, indexed_now, current, kind, args.repeated),
+            write_cost(kinds, indexed_proposed, proposed, kind,
+                       args.repeated)))
+    for kind, changed in HOT_UPDATES:
+        print('  %-34s %6d %9d' % (
+            'update %s.%s' % (kind, '/'.join(changed)),
+            write_cost(kinds, indexed_now, current, kind, args.repeated,
+                       changed),
+            write_cost(kinds, indexed_proposed, proposed, kind,
+                       args.repeated, changed)))
+
+    if args.write:
+        write_index_yaml(index_path, proposed)
+        print('\nwrote %s' % index_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+"""loadgen.py
+
+Synthetic load generator and traffic replayer for the conference API.
+
+Generate mode builds a weighted mix of calls from the @endpoints.method
+definitions in conference.py (path, HTTP method and name are read from
+the source, so new endpoints are picked up automatically) and fires it
+open-loop at a target RPS against a running server, optionally in
+phases (e.g. a registration burst followed by a review spike). Replay
+mode re-sends a recorded JSON-lines request log, keeping its timing.
+
+Either way it reports per-endpoint throughput, latency percentiles and
+error, conflict (HTTP 409) and datastore contention rates.
+
+usage:
+  python tools/loadgen.py --url http://localhost:8080 --discover \\
+      --rps 50 --duration 60 [--mix mix.json] [--record log.jsonl]
+  python tools/loadgen.py --url http://localhost:8080 --replay log.jsonl
+
+mix.json (all keys optional):
+  {"weights": {"queryConferences": 30, ...},
+   "bodies": {"postReview": {"session_name": "{sessionName}", ...}},
+   "pools": {"websafeConferenceKey": ["..."], "sessionName": ["..."]},
+   "phases": [{"duration": 30, "rps": 20},
+              {"duration": 10, "rps": 80,
+               "weights": {"registerForConference": 1}}]}
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import ast
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from Queue import Queue
+from urllib2 import HTTPError, Request, urlopen
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_ROOT = '/_ah/api/conference/v1/'
+
+# The production traffic mix: polling reads dominate, writes come in
+# bursts. Endpoints not listed get no traffic unless mix.json adds them.
+DEFAULT_WEIGHTS = {
+    'queryConferences': 30,
+    'getConferenceSessions': 25,
+    'getConference': 10,
+    'getAnnouncement': 8,
+    'getFeaturedSpeaker': 5,
+    'getProfile': 5,
+    'getConferencesToAttend': 4,
+    'registerForConference': 4,
+    'getSessionsInWishlist': 3,
+    'postReview': 3,
+    'unregisterFromConference': 2,
+    'getReview': 1,
+}
+
+DEFAULT_BODIES = {
+    'queryConferences': {'filters': []},
+    'postReview': {'conference_name': 'loadgen',
+                   'session_name': '{sessionName}',
+                   'review': 'excellent'},
+    'getReview': {'session_name': '{sessionName}'},
+    'addSessionToWishlistByName': {'sessionName': '{sessionName}'},
+}
+
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+CONTENTION_MARKERS = ('contention', 'TransactionFailedError')
+
+
+def parse_endpoints(source_path):
+    """Return {name: (http_method, path)} for every @endpoints.method."""
+    with open(source_path) as source:
+        tree = ast.parse(source.read(), source_path)
+    found = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            if not (isinstance(decorator, ast.Call) and
+                    getattr(decorator.func, 'attr', None) == 'method'):
+                continue
+            options = dict((kw.arg, kw.value) for kw in decorator.keywords)
+            values = dict((key, getattr(value, 's', None))
+                          for key, value in options.items())
+            name = values.get('name') or node.name
+            found[name] = ((values.get('http_method') or 'POST').upper(),
+                           values.get('path') or name)
+    return found
+
+
+def fill(template, pools, rng):
+    """Replace {placeholders} in a str/dict/list from the value pools."""
+    if isinstance(template, dict):
+        return dict((key, fill(value, pools, rng))
+                    for key, value in template.items())
+    if isinstance(template, list):
+        return [fill(value, pools, rng) for value in template]
+    if isinstance(template, basestring):
+        def choose(match):
+            pool = pools.get(match.group(1))
+            if not pool:
+                raise KeyError(match.group(1))
+            return rng.choice(pool)
+        return PLACEHOLDER.sub(choose, template)
+    return template
+
+
+class CallMix(object):
+    """CallMix -- draws weighted random API calls"""
+
+    def __init__(self, endpoints, weights, bodies, pools, seed):
+        self.endpoints = endpoints
+        self.bodies = bodies
+        self.pools = pools
+        self.rng = random.Random(seed)
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        # skip calls whose path parameters we have no values for
+        self.choices = []
+        for name, weight in sorted(weights.items()):
+            if name not in self.endpoints or weight <= 0:
+                continue
+            try:
+                self.make(name)
+            except KeyError as missing:
+                print('skipping %s: no values for %s' % (name, missing))
+                continue
+            self.choices.append((name, weight))
+        self.total = sum(weight for name, weight in self.choices)
+        if not self.total:
+            raise SystemExit('No callable endpoints in the mix')
+
+    def make(self, name):
+        http_method, path = self.endpoints[name]
+        body = self.bodies.get(name)
+        return {
+            'name': name,
+            'method': http_method,
+            'path': fill(path, self.pools, self.rng),
+            'body': fill(body, self.pools, self.rng) if body else None,
+        }
+
+    def draw(self):
+        point = self.rng.uniform(0, self.total)
+        for name, weight in self.choices:
+            point -= weight
+            if point <= 0:
+                return self.make(name)
+        return self.make(self.choices[-1][0])
+
+
+class Stats(object):
+    """Stats -- thread-safe per-endpoint results"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+
+    def add(self, name, latency_ms, outcome):
+        with self.lock:
+            self.latencies[name].append(latency_ms)
+            self.outcomes[name][outcome] += 1
+
+    def report(self, elapsed):
+        def percentile(ordered, fraction):
+            return ordered[min(len(ordered) - 1,
+                               int(round(fraction * (len(ordered) - 1))))]
+        rows = {}
+        for name, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            outcomes = self.outcomes[name]
+            calls = len(ordered)
+            rows[name] = {
+                'calls': calls,
+                'rps': round(calls / elapsed, 2),
+                'p50_ms': round(percentile(ordered, 0.50), 1),
+                'p95_ms': round(percentile(ordered, 0.95), 1),
+                'p99_ms': round(percentile(ordered, 0.99), 1),
+                'error_rate': round(float(outcomes['error']) / calls, 4),
+                'conflict_rate': round(float(outcomes['conflict']) / calls,
+                                       4),
+                'contention_rate': round(
+                    float(outcomes['contention']) / calls, 4),
+            }
+        return rows
+
+
+def send(base_url, call, token, timeout):
+    """Issue one call; returns (latency ms, outcome)."""
+    data = json.dumps(call['body'] or {})
+    if call['method'] in ('GET', 'DELETE'):
+        data = None
+    request = Request(base_url + API_ROOT + call['path'], data=data)
+    request.get_method = lambda: call['method']
+    request.add_header('Content-Type', 'application/json')
+    if token:
+        request.add_header('Authorization', 'Bearer %s' % token)
+    started = time.time()
+    try:
+        urlopen(request, timeout=timeout).read()
+        outcome = 'ok'
+    except HTTPError as error:
+        body = error.read()
+        if error.code == 409:
+            outcome = 'conflict'
+        elif any(marker in body for marker in CONTENTION_MARKERS):
+            outcome = 'contention'
+        else:
+            outcome = 'error'
+    except Exception:
+        outcome = 'error'
+    return (time.time() - started) * 1000, outcome
+
+
+def run(base_url, schedule, args):
+    """Fire (offset seconds, call) pairs open-loop; returns Stats."""
+    stats = Stats()
+    work = Queue()
+
+    def worker():
+        while True:
+            call = work.get()
+            if call is None:
+                return
+            latency, outcome = send(base_url, call, args.token, args.timeout)
+            stats.add(call['name'], latency, outcome)
+
+    workers = [threading.Thread(target=worker) for _ in range(args.workers)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    recorder = open(args.record, 'w') if args.record else None
+    started = time.time()
+    for offset, call in schedule:
+        delay = started + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if work.qsize() > args.workers * 10:
+            # the server cannot keep up; shedding keeps the rate honest
+            stats.add(call['name'], 0, 'error')
+            continue
+        work.put(call)
+        if recorder:
+            recorder.write(json.dumps(dict(call, ts=offset)) + '\n')
+    for _ in workers:
+        work.put(None)
+    for thread in workers:
+        thread.join()
+    if recorder:
+        recorder.close()
+    return stats, time.time() - started
+
+
+def generated_schedule(mix, phases, default_weights):
+    offset = 0.0
+    for phase in phases:
+        mix.set_weights(phase.get('weights', default_weights))
+        end = offset + phase['duration']
+        interval = 1.0 / phase['rps']
+        while offset < end:
+            yield offset, mix.draw()
+            offset += interval
+
+
+def replay_schedule(path, speed):
+    with open(path) as log:
+        for line in log:
+            if line.strip():
+                call = json.loads(line)
+                call.setdefault('name', call['path'].split('/')[0])
+                yield call.pop('ts', 0) / speed, call
+
+
+def discover(base_url, token, timeout):
+    """Collect conference keys and session names from the server."""
+    pools = {'websafeConferenceKey': [], 'sessionName': []}
+
+    def call(method, path, body=None):
+        data = json.dumps(body) if body is not None else None
+        request = Request(base_url + API_ROOT + path, data=data)
+        request.get_method = lambda: method
+        request.add_header('Content-Type', 'application/json')
+        if token:
+            request.add_header('Authorization', 'Bearer %s' % token)
+        return json.loads(urlopen(request, timeout=timeout).read())
+
+    conferences = call('POST', 'conference/query', {'filters': []})
+    for conf in conferences.get('items', []):
+        pools['websafeConferenceKey'].append(conf['websafeKey'])
+        sessions = call('GET', 'conference/session/query/by_conference/%s'
+                        % conf['websafeKey'])
+        pools['sessionName'].extend(
+            session['name'] for session in sessions.get('items', []))
+    return pools
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load generator / replayer for the conference API.')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--mix', help='mix.json (see module docstring)')
+    parser.add_argument('--replay', help='JSON-lines request log')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed-up factor')
+    parser.add_argument('--record', help='write sent calls as a log')
+    parser.add_argument('--discover', action='store_true',
+                        help='fill key/name pools from the server')
+    parser.add_argument('--rps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--token', help='OAuth bearer token')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    if args.replay:
+        schedule = replay_schedule(args.replay, args.speed)
+    else:
+        config = {}
+        if args.mix:
+            with open(args.mix) as mix_file:
+                config = json.load(mix_file)
+        pools = config.get('pools', {})
+        if args.discover:
+            for key, values in discover(args.url, args.token,
+                                        args.timeout).items():
+                pools.setdefault(key, []).extend(values)
+        bodies = dict(DEFAULT_BODIES, **config.get('bodies', {}))
+        weights = config.get('weights', DEFAULT_WEIGHTS)
+        endpoints = parse_endpoints(os.path.join(APP_ROOT, 'conference.py'))
+        mix = CallMix(endpoints, weights, bodies, pools, args.seed)
+        phases = config.get('phases') or [
+            {'duration': args.duration, 'rps': args.rps}]
+        schedule = generated_schedule(mix, phases, weights)
+
+    stats, elapsed = run(args.url, schedule, args)
+    report = stats.report(elapsed)
+
+    print('%-28s %7s %7s %8s %8s %8s %7s %7s %7s' % (
+        'endpoint', 'calls', 'rps', 'p50', 'p95', 'p99', 'err',
+        '409', 'cont'))
+    for name, row in sorted(report.items()):
+        print('%-28s %7d %7.1f %8.1f %8.1f %8.1f %6.1f%% %6.1f%% %6.1f%%' % (
+            name, row['calls'], row['rps'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms'], row['error_rate'] * 100,
+            row['conflict_rate'] * 100, row['contention_rate'] * 100))
+    total = sum(row['calls'] for row in report.values())
+    print('total: %d calls in %.1fs (%.1f rps)' % (
+        total, elapsed, total / elapsed if elapsed else 0))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
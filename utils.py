@@ -3,9 +3,15 @@ import os
 import time
 import uuid
 
+import endpoints
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
 
+# Marker for context values that have not been resolved yet; None is a
+# legitimate resolved value (anonymous user, missing profile).
+_UNSET = object()
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -43,3 +49,68 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+class RequestContext(object):
+    """Per-request memo of the current user, user id and Profile.
+
+    A single API call used to resolve the caller several times over
+    (get_current_user, getUserId, Profile get). The context resolves each
+    one at most once and counts, in `saved`, the lookups served from the
+    memo instead of going back to the auth layer or the datastore.
+    """
+
+    def __init__(self):
+        self._user = _UNSET
+        self._user_id = _UNSET
+        self._profile = _UNSET
+        self.saved = {'user': 0, 'user_id': 0, 'profile': 0}
+
+    @property
+    def user(self):
+        """Current endpoints user, or None when not signed in."""
+        if self._user is _UNSET:
+            self._user = endpoints.get_current_user()
+        else:
+            self.saved['user'] += 1
+        return self._user
+
+    @property
+    def user_id(self):
+        """getUserId() of the current user, or None when not signed in."""
+        if self._user_id is _UNSET:
+            user = self.user
+            self._user_id = getUserId(user) if user else None
+        else:
+            self.saved['user_id'] += 1
+        return self._user_id
+
+    @property
+    def profile(self):
+        """Profile of the current user, or None if it does not exist yet.
+
+        Inside a transaction the Profile is always re-read so the
+        transaction sees (and locks) the committed entity; the memo is
+        only refreshed once that transaction commits.
+        """
+        if ndb.in_transaction():
+            profile = ndb.Key(Profile, self.user_id).get()
+            self._remember_on_commit(profile)
+            return profile
+        if self._profile is _UNSET:
+            self._profile = ndb.Key(Profile, self.user_id).get()
+        else:
+            self.saved['profile'] += 1
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        if ndb.in_transaction():
+            self._remember_on_commit(profile)
+        else:
+            self._profile = profile
+
+    def _remember_on_commit(self, profile):
+        def remember():
+            self._profile = profile
+        ndb.get_context().call_on_commit(remember)